@@ -18,11 +18,12 @@ setuptools.setup(
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*",
     install_requires=[
         "Django>=1.11",
-        "python-cas>=1.4.0",
+        "python-cas>=1.6.0",
         "djangorestframework-simplejwt>=4.1.0",
     ],
     extras_require = {
         ":python_version<='3.2'": ["mock"],
+        "async": ["httpx"],
     },
     packages=setuptools.find_packages(exclude=["demo-app",]),
     classifiers=[
@@ -1,3 +1,104 @@
 """
 Models used exlcusively during testing.
 """
+
+from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+
+
+class Note(models.Model):
+    """
+    Model with a foreign key to the User model.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="notes",
+        on_delete=models.CASCADE,
+    )
+    text = models.CharField(max_length=100, blank=True)
+
+
+class AuditedNote(models.Model):
+    """
+    Model with a foreign key to the User model, which
+    counts the number of times it has been saved.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="audited_notes",
+        on_delete=models.CASCADE,
+    )
+    num_saves = models.IntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        self.num_saves += 1
+        super(AuditedNote, self).save(*args, **kwargs)
+
+
+class Team(models.Model):
+    """
+    Model with a many-to-many relation to the User model.
+    """
+
+    name = models.CharField(max_length=30)
+    members = models.ManyToManyField(
+        settings.AUTH_USER_MODEL, related_name="teams"
+    )
+
+
+class Comment(models.Model):
+    """
+    Model with a generic foreign key.
+    """
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey("content_type", "object_id")
+
+
+class TeamComment(models.Model):
+    """
+    Model with a generic foreign key which may only refer to Teams.
+    """
+
+    content_type = models.ForeignKey(
+        ContentType,
+        limit_choices_to={"app_label": "tests", "model": "team"},
+        on_delete=models.CASCADE,
+    )
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey("content_type", "object_id")
+
+
+class Project(models.Model):
+    """
+    Model with a many-to-many relation to the User model,
+    through a custom model.
+    """
+
+    name = models.CharField(max_length=30)
+    members = models.ManyToManyField(
+        settings.AUTH_USER_MODEL,
+        related_name="projects",
+        through="Membership",
+    )
+
+
+class Membership(models.Model):
+    """
+    Custom through model of the Project members relation,
+    which allows a single row per user and project.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE
+    )
+    project = models.ForeignKey("Project", on_delete=models.CASCADE)
+    role = models.CharField(max_length=30, blank=True)
+
+    class Meta:
+        unique_together = ("user", "project")
@@ -0,0 +1,208 @@
+from unittest import skipUnless
+
+from django.contrib.auth.signals import user_login_failed
+from django.test import RequestFactory, TestCase, override_settings
+
+from tests.utils import StubCASServer
+from uniauth import health
+from uniauth.health import CASServerUnavailable
+from uniauth.models import Institution
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+try:
+    import httpx
+
+    from uniauth.async_backends import aauthenticate
+except ImportError:
+    httpx = None
+
+
+@skipUnless(httpx, "httpx is not installed")
+@override_settings(
+    AUTHENTICATION_BACKENDS=["uniauth.async_backends.AsyncCASBackend"],
+    UNIAUTH_CAS_RETRY_BACKOFF=0,
+)
+class AsyncCASBackendTests(TestCase):
+    """
+    Tests the AsyncCASBackend in async_backends.py
+    """
+
+    def setUp(self):
+        for name in (
+            "uniauth.cache._validated_tickets",
+            "uniauth.health._health",
+        ):
+            patcher = mock.patch.dict(name, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server = StubCASServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.inst = Institution.objects.create(
+            name="Stub Inst",
+            slug="stub-inst",
+            cas_server_url=self.server.url,
+        )
+
+    async def _aauthenticate(self, ticket, institution=None, request=None):
+        return await aauthenticate(
+            request,
+            institution=institution or self.inst,
+            ticket=ticket,
+            service="http://www.service.com/",
+        )
+
+    async def test_async_cas_backend_verification(self):
+        """
+        Ensure tickets are verified with the institution's CAS server
+        """
+        user = await self._aauthenticate("ST-john")
+        self.assertEqual(user.username, "cas-stub-inst-john")
+        self.assertEqual(
+            user.backend, "uniauth.async_backends.AsyncCASBackend"
+        )
+        user = await self._aauthenticate("ST-john", institution="stub-inst")
+        self.assertEqual(user.username, "cas-stub-inst-john")
+        self.assertEqual(await self._aauthenticate("bad-ticket"), None)
+        self.assertEqual(
+            await self._aauthenticate("ST-john", institution="dne"), None
+        )
+
+    async def test_async_cas_backend_reuses_connections(self):
+        """
+        Ensure verifications reuse the institution's pooled connection
+        """
+        for i in range(5):
+            user = await self._aauthenticate("ST-user%d" % i)
+            self.assertNotEqual(user, None)
+        self.assertEqual(self.server.num_requests, 5)
+        self.assertEqual(self.server.num_connections, 1)
+
+    async def test_async_cas_backend_retries_unavailable(self):
+        """
+        Ensure verification is retried if the server is unavailable,
+        and fails once the retries are exhausted
+        """
+        self.server.num_failures = 1
+        user = await self._aauthenticate("ST-john")
+        self.assertEqual(user.username, "cas-stub-inst-john")
+        self.assertEqual(self.server.num_requests, 2)
+        with override_settings(UNIAUTH_CAS_MAX_RETRIES=0):
+            self.server.num_failures = 1
+            self.assertEqual(await self._aauthenticate("ST-jane"), None)
+
+    async def test_async_cas_backend_gateway_error_not_retried(self):
+        """
+        Ensure verification is not retried after a gateway error,
+        as the server may have already validated the ticket
+        """
+        self.server.num_failures = 1
+        self.server.failure_status = 504
+        self.assertEqual(await self._aauthenticate("ST-john"), None)
+        self.assertEqual(self.server.num_requests, 1)
+
+    @override_settings(UNIAUTH_CAS_TICKET_CACHE_TIMEOUT=10)
+    async def test_async_cas_backend_duplicate_ticket(self):
+        """
+        Ensure a ticket validated moments ago resolves to the same
+        user without being verified again, but only for the session
+        which validated it
+        """
+        request = RequestFactory().get("/")
+        request.session = {}
+        user = await self._aauthenticate("ST-john", request=request)
+        self.assertEqual(
+            await self._aauthenticate("ST-john", request=request), user
+        )
+        self.assertEqual(self.server.num_requests, 1)
+        other_request = RequestFactory().get("/")
+        other_request.session = {}
+        await self._aauthenticate("ST-john", request=other_request)
+        self.assertEqual(self.server.num_requests, 2)
+
+    @override_settings(UNIAUTH_CAS_MAX_RETRIES=0)
+    async def test_async_cas_backend_unreachable(self):
+        """
+        Ensure backend returns None if the server cannot be reached
+        """
+        closed_server = StubCASServer()
+        closed_server.server_close()
+        self.inst.cas_server_url = closed_server.url
+        self.assertEqual(await self._aauthenticate("ST-john"), None)
+
+    @override_settings(UNIAUTH_CAS_MAX_RETRIES=0)
+    async def test_async_cas_backend_circuit_breaker_failed_probe(self):
+        """
+        Ensure a probe which fails to verify the ticket raises
+        CASServerUnavailable, and opens the circuit again
+        """
+        health._health.clear()
+        for i in range(10):
+            health.record_verification(self.inst, False, 0.1)
+        health._health["stub-inst"]["open_until"] = 0
+        self.server.num_failures = 1
+        with self.assertRaises(CASServerUnavailable):
+            await self._aauthenticate("ST-jack")
+        self.assertEqual(self.server.num_requests, 1)
+        with self.assertRaises(CASServerUnavailable):
+            await self._aauthenticate("ST-jack")
+        self.assertEqual(self.server.num_requests, 1)
+
+    async def test_async_cas_backend_circuit_breaker_probe_raises(self):
+        """
+        Ensure a probe which raises before reaching the server still
+        records its outcome, so later probes are let through
+        """
+        health._health.clear()
+        for i in range(10):
+            health.record_verification(self.inst, False, 0.1)
+        health._health["stub-inst"]["open_until"] = 0
+        with mock.patch(
+            "uniauth.async_backends.get_async_http_client",
+            side_effect=ValueError,
+        ):
+            with self.assertRaises(ValueError):
+                await self._aauthenticate("ST-jack")
+        self.assertFalse(health._health["stub-inst"]["probing"])
+
+        health._health["stub-inst"]["open_until"] = 0
+        user = await self._aauthenticate("ST-jack")
+        self.assertEqual(user.username, "cas-stub-inst-jack")
+
+    async def test_async_cas_backend_login_failed_signal(self):
+        """
+        Ensure user_login_failed is sent when no backend
+        authenticates the ticket, as with Django's authenticate
+        """
+        receiver = mock.Mock()
+        user_login_failed.connect(receiver)
+        self.addCleanup(user_login_failed.disconnect, receiver)
+        await self._aauthenticate("ST-john")
+        self.assertFalse(receiver.called)
+
+        self.assertEqual(await self._aauthenticate("bad-ticket"), None)
+        self.assertEqual(receiver.call_count, 1)
+        kwargs = receiver.call_args[1]
+        self.assertEqual(kwargs["request"], None)
+        self.assertEqual(
+            kwargs["credentials"],
+            {
+                "institution": self.inst,
+                "ticket": "bad-ticket",
+                "service": "http://www.service.com/",
+            },
+        )
+
+    @override_settings(AUTHENTICATION_BACKENDS=["uniauth.backends.CASBackend"])
+    async def test_async_cas_backend_sync_fallback(self):
+        """
+        Ensure synchronous CASBackends are used if there is
+        no AsyncCASBackend
+        """
+        user = await self._aauthenticate("ST-john")
+        self.assertEqual(user.username, "cas-stub-inst-john")
+        self.assertEqual(user.backend, "uniauth.backends.CASBackend")
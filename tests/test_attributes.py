@@ -0,0 +1,269 @@
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import RequestFactory, TestCase, override_settings
+
+from uniauth.attributes import (
+    filter_cas_attributes,
+    get_cas_attributes,
+    get_users_cas_attributes,
+    persist_cas_attributes,
+    store_cas_attributes,
+)
+from uniauth.backends import CASBackend
+from uniauth.models import (
+    Institution,
+    InstitutionAccount,
+    InstitutionAccountAttributes,
+)
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+ATTRIBUTES = {
+    "mail": "john@example.com",
+    "displayName": "John Doe",
+    "memberOf": ["group%d" % i for i in range(100)],
+}
+
+
+class FilterCASAttributesTests(TestCase):
+    """
+    Tests the filter_cas_attributes method in attributes.py
+    """
+
+    def test_filter_cas_attributes_all(self):
+        """
+        Ensure all attributes are kept by default
+        """
+        self.assertEqual(filter_cas_attributes(ATTRIBUTES), ATTRIBUTES)
+
+    @override_settings(UNIAUTH_CAS_ATTRIBUTES=["mail", "dne"])
+    def test_filter_cas_attributes_whitelist(self):
+        """
+        Ensure only the whitelisted attributes are kept
+        """
+        self.assertEqual(
+            filter_cas_attributes(ATTRIBUTES), {"mail": "john@example.com"}
+        )
+
+    @override_settings(UNIAUTH_CAS_ATTRIBUTES_MAX_SIZE=100)
+    def test_filter_cas_attributes_max_size(self):
+        """
+        Ensure the largest attributes are dropped if the
+        attributes exceed the maximum size
+        """
+        self.assertEqual(
+            filter_cas_attributes(ATTRIBUTES),
+            {"mail": "john@example.com", "displayName": "John Doe"},
+        )
+        with override_settings(UNIAUTH_CAS_ATTRIBUTES_MAX_SIZE=2):
+            self.assertEqual(filter_cas_attributes(ATTRIBUTES), {})
+
+
+class StoreCASAttributesTests(TestCase):
+    """
+    Tests the store_cas_attributes and get_cas_attributes
+    methods in attributes.py
+    """
+
+    def _get_request(self, session=None):
+        request = RequestFactory().get("/")
+        request.session = {} if session is None else session
+        return request
+
+    def test_store_cas_attributes_session(self):
+        """
+        Ensure attributes are stored in the session by default
+        """
+        request = self._get_request()
+        self.assertEqual(get_cas_attributes(request), {})
+        store_cas_attributes(request, ATTRIBUTES)
+        self.assertEqual(request.session["attributes"], ATTRIBUTES)
+        next_request = self._get_request(request.session)
+        self.assertEqual(get_cas_attributes(next_request), ATTRIBUTES)
+
+    @override_settings(
+        UNIAUTH_CACHE_ALIAS="default", UNIAUTH_CAS_ATTRIBUTES_STORE="cache"
+    )
+    def test_store_cas_attributes_cache(self):
+        """
+        Ensure only the cache key of the attributes is stored in
+        the session, and the attributes are loaded once on access
+        """
+        caches["default"].clear()
+        request = self._get_request()
+        store_cas_attributes(request, ATTRIBUTES)
+        self.assertEqual(list(request.session), ["attributes-key"])
+        self.assertEqual(get_cas_attributes(request), ATTRIBUTES)
+
+        next_request = self._get_request(request.session)
+        # Attributes are not loaded until they are accessed
+        self.assertFalse(hasattr(next_request, "_cas_attributes"))
+        self.assertEqual(get_cas_attributes(next_request), ATTRIBUTES)
+        caches["default"].delete(request.session["attributes-key"])
+        self.assertEqual(get_cas_attributes(next_request), ATTRIBUTES)
+
+        # Storing new attributes replaces the cached ones
+        key = request.session["attributes-key"]
+        store_cas_attributes(next_request, {"mail": "jane@example.com"})
+        self.assertNotEqual(next_request.session["attributes-key"], key)
+        self.assertEqual(
+            get_cas_attributes(self._get_request(next_request.session)),
+            {"mail": "jane@example.com"},
+        )
+        caches["default"].clear()
+
+
+@override_settings(UNIAUTH_PERSIST_CAS_ATTRIBUTES=True)
+class PersistCASAttributesTests(TestCase):
+    """
+    Tests the persist_cas_attributes and get_users_cas_attributes
+    methods in attributes.py
+    """
+
+    def setUp(self):
+        for name in (
+            "uniauth.cache._account_users",
+            "uniauth.cache._validated_tickets",
+            "uniauth.health._health",
+        ):
+            patcher = mock.patch.dict(name, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.inst = Institution.objects.create(
+            name="Test Inst",
+            slug="test-inst",
+            cas_server_url="https://fed.testinst.edu/",
+        )
+        self.inst2 = Institution.objects.create(
+            name="Other Inst",
+            slug="other-inst",
+            cas_server_url="https://fed.other.edu/",
+        )
+        self.user = User.objects.create(username="john@example.com")
+        self.account = InstitutionAccount.objects.create(
+            profile=self.user.uniauth_profile,
+            institution=self.inst,
+            cas_id="john123",
+        )
+
+    def test_persist_cas_attributes(self):
+        """
+        Ensure attributes are only written when they change
+        """
+        self.assertTrue(
+            persist_cas_attributes(self.inst, "john123", {"role": "staff"})
+        )
+        stored = InstitutionAccountAttributes.objects.get()
+        self.assertEqual(stored.account, self.account)
+        self.assertEqual(stored.get_attributes(), {"role": "staff"})
+
+        with self.assertNumQueries(1):
+            self.assertFalse(
+                persist_cas_attributes(self.inst, "john123", {"role": "staff"})
+            )
+        self.assertTrue(
+            persist_cas_attributes(self.inst, "john123", {"role": "faculty"})
+        )
+        self.assertEqual(
+            self.account.cas_attributes.get_attributes(), {"role": "faculty"}
+        )
+        self.assertEqual(InstitutionAccountAttributes.objects.count(), 1)
+
+    def test_persist_cas_attributes_no_account(self):
+        """
+        Ensure nothing is written for unlinked or unknown accounts,
+        or accounts which never had attributes
+        """
+        self.assertFalse(
+            persist_cas_attributes(self.inst2, "john123", {"role": "staff"})
+        )
+        self.assertFalse(persist_cas_attributes(self.inst, "john123", {}))
+        self.assertFalse(InstitutionAccountAttributes.objects.exists())
+
+    @override_settings(UNIAUTH_PERSIST_CAS_ATTRIBUTES=False)
+    def test_persist_cas_attributes_disabled(self):
+        """
+        Ensure nothing is written if persisting attributes is disabled
+        """
+        with self.assertNumQueries(0):
+            self.assertFalse(
+                persist_cas_attributes(self.inst, "john123", {"role": "staff"})
+            )
+
+    @override_settings(UNIAUTH_CAS_ATTRIBUTES=["role"])
+    @mock.patch("cas.CASClientV2.verify_ticket")
+    def test_cas_backend_persists_attributes(self, mock_verify_ticket):
+        """
+        Ensure the CASBackend persists the filtered attributes
+        of linked accounts only
+        """
+        backend = CASBackend()
+        mock_verify_ticket.return_value = (
+            "john123",
+            {"role": "staff", "mail": "john@example.com"},
+            None,
+        )
+        request = RequestFactory().get("/")
+        request.session = {}
+        user = backend.authenticate(
+            request,
+            institution=self.inst,
+            ticket="ST-1",
+            service="http://www.service.com/",
+        )
+        self.assertEqual(user, self.user)
+        self.assertEqual(
+            self.account.cas_attributes.get_attributes(), {"role": "staff"}
+        )
+
+        mock_verify_ticket.return_value = ("jane987", {"role": "staff"}, None)
+        backend.authenticate(
+            request,
+            institution=self.inst,
+            ticket="ST-2",
+            service="http://www.service.com/",
+        )
+        self.assertEqual(InstitutionAccountAttributes.objects.count(), 1)
+
+    def test_get_users_cas_attributes(self):
+        """
+        Ensure the attributes of many users are loaded at once
+        """
+        user2 = User.objects.create(username="jane@example.com")
+        user3 = User.objects.create(username="bob@example.com")
+        InstitutionAccount.objects.create(
+            profile=user2.uniauth_profile,
+            institution=self.inst,
+            cas_id="jane987",
+        )
+        InstitutionAccount.objects.create(
+            profile=self.user.uniauth_profile,
+            institution=self.inst2,
+            cas_id="jd",
+        )
+        persist_cas_attributes(self.inst, "john123", {"role": "staff"})
+        persist_cas_attributes(self.inst2, "jd", {"role": "student"})
+        persist_cas_attributes(self.inst, "jane987", {"role": "faculty"})
+
+        with self.assertNumQueries(1):
+            attributes = get_users_cas_attributes([self.user, user2, user3])
+        self.assertEqual(
+            attributes,
+            {
+                self.user.pk: {
+                    "test-inst": {"role": "staff"},
+                    "other-inst": {"role": "student"},
+                },
+                user2.pk: {"test-inst": {"role": "faculty"}},
+            },
+        )
+        with self.assertNumQueries(1):
+            attributes = get_users_cas_attributes(
+                User.objects.all(), institution=self.inst2
+            )
+        self.assertEqual(
+            attributes, {self.user.pk: {"other-inst": {"role": "student"}}}
+        )
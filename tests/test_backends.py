@@ -1,12 +1,17 @@
 from django.contrib.auth.models import User
 from django.test import RequestFactory, TestCase, override_settings
 
+from tests.utils import StubCASServer
+from uniauth import health
 from uniauth.backends import (
     CASBackend,
     LinkedEmailBackend,
     UsernameOrLinkedEmailBackend,
 )
+from uniauth.cas_client import get_cas_session
+from uniauth.health import CASServerUnavailable
 from uniauth.models import Institution, InstitutionAccount, LinkedEmail
+from uniauth.signals import password_check_completed
 
 try:
     import mock
@@ -20,6 +25,13 @@ class CASBackendTests(TestCase):
     """
 
     def setUp(self):
+        for name in (
+            "uniauth.cache._validated_tickets",
+            "uniauth.health._health",
+        ):
+            patcher = mock.patch.dict(name, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
         self.factory = RequestFactory()
         self.inst = Institution.objects.create(
             name="Test Inst",
@@ -154,6 +166,43 @@ class CASBackendTests(TestCase):
             {"ticket": "ticket0123", "service": "http://someservice.gov/"},
         )
 
+    @mock.patch("cas.CASClientV2.verify_ticket")
+    def test_cas_backend_existing_user_queries(self, mock_verify_ticket):
+        """
+        Ensure the user of an existing account is found with a
+        single query, and the cached user is invalidated when
+        the account is removed
+        """
+        backend = CASBackend()
+        user = User.objects.create(username="johndoe@gmail.com")
+        account = InstitutionAccount.objects.create(
+            profile=user.uniauth_profile,
+            institution=self.inst,
+            cas_id="john123",
+        )
+        mock_verify_ticket.return_value = ("john123", {}, None)
+
+        for i in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(
+                    backend.authenticate(
+                        None,
+                        institution=self.inst,
+                        ticket="ticket%d" % i,
+                        service="http://www.service.com/",
+                    ),
+                    user,
+                )
+
+        account.delete()
+        user = backend.authenticate(
+            None,
+            institution=self.inst,
+            ticket="ticket2",
+            service="http://www.service.com/",
+        )
+        self.assertEqual(user.username, "cas-test-inst-john123")
+
     @mock.patch("cas.CASClientV2.verify_ticket")
     def test_cas_backend_missing_request(self, mock_verify_ticket):
         """
@@ -205,12 +254,192 @@ class CASBackendTests(TestCase):
         user = backend.authenticate(
             None,
             institution=self.inst,
-            ticket="fake-ticket",
+            ticket="bad-ticket",
             service="http://www.service.com/",
         )
         self.assertEqual(user, None)
         self.assertEqual(User.objects.count(), prev_num_users)
 
+    @mock.patch("cas.CASClientV2.verify_ticket")
+    def test_cas_backend_institution_slug(self, mock_verify_ticket):
+        """
+        Ensure the institution may be provided by slug
+        """
+        backend = CASBackend()
+        mock_verify_ticket.return_value = ("newuser", {}, None)
+        user = backend.authenticate(
+            None,
+            institution="other-inst",
+            ticket="fake-ticket",
+            service="http://www.service.com/",
+        )
+        self.assertEqual(user.username, "cas-other-inst-newuser")
+        user = backend.authenticate(
+            None,
+            institution="dne",
+            ticket="fake-ticket",
+            service="http://www.service.com/",
+        )
+        self.assertEqual(user, None)
+
+
+@override_settings(UNIAUTH_CAS_RETRY_BACKOFF=0)
+class CASBackendServerTests(TestCase):
+    """
+    Tests the CASBackend in backends.py against a stub CAS server
+    """
+
+    def setUp(self):
+        for name in (
+            "uniauth.cache._validated_tickets",
+            "uniauth.health._health",
+        ):
+            patcher = mock.patch.dict(name, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server = StubCASServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.inst = Institution.objects.create(
+            name="Stub Inst",
+            slug="stub-inst",
+            cas_server_url=self.server.url,
+        )
+
+    def _authenticate(self, ticket, request=None):
+        return CASBackend().authenticate(
+            request,
+            institution=self.inst,
+            ticket=ticket,
+            service="http://www.service.com/",
+        )
+
+    def test_cas_backend_server_verification(self):
+        """
+        Ensure tickets are verified with the institution's CAS server
+        """
+        user = self._authenticate("ST-john")
+        self.assertEqual(user.username, "cas-stub-inst-john")
+        self.assertEqual(self._authenticate("bad-ticket"), None)
+
+    def test_cas_backend_server_reuses_connections(self):
+        """
+        Ensure verifications reuse the institution's pooled connection
+        """
+        for i in range(5):
+            self.assertNotEqual(self._authenticate("ST-user%d" % i), None)
+        self.assertEqual(self.server.num_requests, 5)
+        self.assertEqual(self.server.num_connections, 1)
+        self.assertIs(get_cas_session(self.inst), get_cas_session(self.inst))
+
+    def test_cas_backend_server_retries_unavailable(self):
+        """
+        Ensure verification is retried if the server is unavailable,
+        and fails once the retries are exhausted
+        """
+        self.server.num_failures = 1
+        user = self._authenticate("ST-john")
+        self.assertEqual(user.username, "cas-stub-inst-john")
+        self.assertEqual(self.server.num_requests, 2)
+        with override_settings(UNIAUTH_CAS_MAX_RETRIES=0):
+            self.server.num_failures = 1
+            self.assertEqual(self._authenticate("ST-jane"), None)
+
+    def test_cas_backend_server_gateway_error_not_retried(self):
+        """
+        Ensure verification is not retried after a gateway error,
+        as the server may have already validated the ticket
+        """
+        self.server.num_failures = 1
+        self.server.failure_status = 502
+        self.assertEqual(self._authenticate("ST-john"), None)
+        self.assertEqual(self.server.num_requests, 1)
+
+    @override_settings(UNIAUTH_CAS_TICKET_CACHE_TIMEOUT=10)
+    def test_cas_backend_server_duplicate_ticket(self):
+        """
+        Ensure a ticket validated moments ago resolves to the same
+        user without being verified again, but only for the session
+        which validated it
+        """
+        request = RequestFactory().get("/")
+        request.session = {}
+        user = self._authenticate("ST-john", request)
+        self.assertEqual(user.username, "cas-stub-inst-john")
+        self.assertEqual(self._authenticate("ST-john", request), user)
+        self.assertEqual(self.server.num_requests, 1)
+
+        # Ensure a replay from another session is verified again,
+        # which the CAS server would reject
+        other_request = RequestFactory().get("/")
+        other_request.session = {}
+        self._authenticate("ST-john", other_request)
+        self.assertEqual(self.server.num_requests, 2)
+        self._authenticate("ST-john")
+        self.assertEqual(self.server.num_requests, 3)
+
+        # Ensure results are not reused if the cache is disabled
+        with override_settings(UNIAUTH_CAS_TICKET_CACHE_TIMEOUT=0):
+            self._authenticate("ST-jane", request)
+            self._authenticate("ST-jane", request)
+        self.assertEqual(self.server.num_requests, 5)
+
+    @override_settings(
+        UNIAUTH_CAS_BREAKER_MIN_REQUESTS=2, UNIAUTH_CAS_MAX_RETRIES=0
+    )
+    def test_cas_backend_server_circuit_breaker(self):
+        """
+        Ensure verification fails fast once the server has failed
+        too often, until a probe finds it has recovered
+        """
+        self.server.num_failures = 3
+        self.assertEqual(self._authenticate("ST-john"), None)
+        self.assertEqual(self._authenticate("ST-jane"), None)
+        self.assertRaises(CASServerUnavailable, self._authenticate, "ST-jack")
+        self.assertEqual(self.server.num_requests, 2)
+
+        # Simulate the cooldown passing: a failed probe is reported
+        # as the server being unavailable, like the rejections
+        health._health["stub-inst"]["open_until"] = 0
+        self.assertRaises(CASServerUnavailable, self._authenticate, "ST-jack")
+        self.assertEqual(self.server.num_requests, 3)
+        health._health["stub-inst"]["open_until"] = 0
+        user = self._authenticate("ST-jack")
+        self.assertEqual(user.username, "cas-stub-inst-jack")
+        self.assertEqual(self.server.num_requests, 4)
+
+    @override_settings(
+        UNIAUTH_CAS_BREAKER_MIN_REQUESTS=2, UNIAUTH_CAS_MAX_RETRIES=0
+    )
+    def test_cas_backend_server_circuit_breaker_probe_raises(self):
+        """
+        Ensure a probe which raises before reaching the server still
+        records its outcome, so later probes are let through
+        """
+        self.server.num_failures = 2
+        self._authenticate("ST-john")
+        self._authenticate("ST-jane")
+        health._health["stub-inst"]["open_until"] = 0
+        with mock.patch(
+            "uniauth.backends.get_cas_client", side_effect=ValueError
+        ):
+            self.assertRaises(ValueError, self._authenticate, "ST-jack")
+        self.assertFalse(health._health["stub-inst"]["probing"])
+
+        health._health["stub-inst"]["open_until"] = 0
+        user = self._authenticate("ST-jack")
+        self.assertEqual(user.username, "cas-stub-inst-jack")
+
+    @override_settings(UNIAUTH_CAS_MAX_RETRIES=0)
+    def test_cas_backend_server_unreachable(self):
+        """
+        Ensure backend returns None if the server cannot be reached
+        """
+        closed_server = StubCASServer()
+        closed_server.server_close()
+        self.inst.cas_server_url = closed_server.url
+        self.assertEqual(self._authenticate("ST-john"), None)
+
 
 class EmailBackendTests(TestCase):
     """
@@ -299,6 +528,12 @@ class LinkedEmailBackendTests(EmailBackendTests):
         )
         self.assertEqual(user, self.mary)
 
+        # Log in with differently cased email
+        user = backend.authenticate(
+            None, email="Alternate@GMAIL.com", password="marypass"
+        )
+        self.assertEqual(user, self.mary)
+
         # Log in with shared email address
         user = backend.authenticate(
             None, email="sharedjones@gmail.com", password="mspass"
@@ -476,3 +711,151 @@ class UsernameOrLinkedEmailBackendTests(EmailBackendTests):
             None, username="tmp-0123_456", password="tmppass"
         )
         self.assertEqual(user, None)
+
+
+@override_settings(UNIAUTH_ALLOW_SHARED_EMAILS=True)
+class EmailBackendQueryTests(EmailBackendTests):
+    """
+    Tests the number of queries and password checks
+    performed by the *EmailBackends
+    """
+
+    def _run_test(self, backend, credentials, password, expected_user):
+        with mock.patch.object(
+            User, "check_password", autospec=True
+        ) as mock_check:
+            mock_check.side_effect = lambda u, p: u.password == p
+            with self.assertNumQueries(1):
+                user = backend.authenticate(
+                    None, email=credentials, password=password
+                )
+            self.assertEqual(user, expected_user)
+        return mock_check
+
+    def test_email_backends_query_counts(self):
+        """
+        Ensure each authenticate call resolves its candidate
+        users in a single query, checking each user once
+        """
+        # Link the same address to a profile twice
+        LinkedEmail.objects.create(
+            profile=self.mary.uniauth_profile,
+            address="Alternate@Gmail.com",
+            is_verified=True,
+        )
+        mary_hash = self.mary.password
+        for backend in (LinkedEmailBackend(), UsernameOrLinkedEmailBackend()):
+            mock_check = self._run_test(
+                backend, "alternate@gmail.com", mary_hash, self.mary
+            )
+            self.assertEqual(mock_check.call_count, 1)
+            mock_check = self._run_test(
+                backend, "alternate@gmail.com", "wrong", None
+            )
+            self.assertEqual(mock_check.call_count, 1)
+            mock_check = self._run_test(
+                backend, "sharedjones@gmail.com", "wrong", None
+            )
+            self.assertEqual(mock_check.call_count, 2)
+            self._run_test(backend, "dne@gmail.com", "wrong", None)
+
+        # Ensure usernames are resolved in the same single query
+        self._run_test(
+            UsernameOrLinkedEmailBackend(),
+            "marysue@outlook.com",
+            mary_hash,
+            self.mary,
+        )
+
+        # Ensure the returned user can be logged in without
+        # loading the rest of its fields
+        user = LinkedEmailBackend()._get_users(User, "johndoe@gmail.com")[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(user.username, "johndoe@gmail.com")
+            self.assertTrue(user.is_active)
+
+    @override_settings(UNIAUTH_MAX_LOGIN_CANDIDATES=2)
+    def test_email_backends_candidate_limit(self):
+        """
+        Ensure no more than the maximum number of candidates are
+        checked, in order of username, primary email, then linked
+        """
+        shared = "shared@example.com"
+        linked = [
+            User.objects.create_user(
+                username="linked%d" % i,
+                email="linked%d@example.com" % i,
+                password="linkedpass",
+            )
+            for i in range(3)
+        ]
+        for user in linked:
+            LinkedEmail.objects.create(
+                profile=user.uniauth_profile, address=shared, is_verified=True
+            )
+        primary = User.objects.create_user(
+            username="primary", email=shared, password="primarypass"
+        )
+        named = User.objects.create_user(
+            username=shared, email="other@example.com", password="namedpass"
+        )
+        LinkedEmail.objects.create(
+            profile=named.uniauth_profile, address=shared, is_verified=True
+        )
+
+        backend = UsernameOrLinkedEmailBackend()
+        candidates = list(backend._get_users(User, shared))
+        self.assertEqual(candidates, [named, primary] + linked)
+        user = backend.authenticate(
+            None, username=shared, password="namedpass"
+        )
+        self.assertEqual(user, named)
+        user = backend.authenticate(
+            None, username=shared, password="primarypass"
+        )
+        self.assertEqual(user, primary)
+        user = backend.authenticate(
+            None, username=shared, password="linkedpass"
+        )
+        self.assertEqual(user, None)
+
+        backend = LinkedEmailBackend()
+        candidates = list(backend._get_users(User, shared))
+        self.assertEqual(candidates, [primary] + linked + [named])
+        user = backend.authenticate(None, email=shared, password="linkedpass")
+        self.assertEqual(user, linked[0])
+        user = backend.authenticate(None, email=shared, password="namedpass")
+        self.assertEqual(user, None)
+        with self.settings(UNIAUTH_MAX_LOGIN_CANDIDATES=0):
+            user = backend.authenticate(
+                None, email=shared, password="namedpass"
+            )
+            self.assertEqual(user, named)
+
+    def test_email_backends_timing_signal(self):
+        """
+        Ensure the password_check_completed signal is sent
+        after each authentication attempt
+        """
+        handler = mock.Mock()
+        password_check_completed.connect(handler)
+        try:
+            backend = LinkedEmailBackend()
+            backend.authenticate(
+                None, email="sharedjones@gmail.com", password="mrpass"
+            )
+            backend.authenticate(None, email="dne@gmail.com", password="x")
+        finally:
+            password_check_completed.disconnect(handler)
+
+        self.assertEqual(handler.call_count, 2)
+        kwargs = handler.call_args_list[0][1]
+        self.assertEqual(kwargs["sender"], LinkedEmailBackend)
+        self.assertEqual(kwargs["num_candidates"], 2)
+        self.assertEqual(kwargs["num_checked"], 1)
+        self.assertTrue(kwargs["succeeded"])
+        self.assertTrue(kwargs["duration"] > 0)
+        kwargs = handler.call_args_list[1][1]
+        self.assertEqual(kwargs["num_candidates"], 0)
+        self.assertEqual(kwargs["num_checked"], 0)
+        self.assertFalse(kwargs["succeeded"])
@@ -0,0 +1,220 @@
+"""
+Benchmarks for Uniauth's hot paths.
+
+These are skipped unless the UNIAUTH_RUN_BENCHMARKS environment
+variable is set, as they create large amounts of data:
+
+    UNIAUTH_RUN_BENCHMARKS=1 python runtests.py
+"""
+
+import os
+import sys
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TransactionTestCase
+
+from tests.utils import StubCASServer
+from uniauth.backends import LinkedEmailBackend
+from uniauth.cas_client import get_cas_client
+from uniauth.models import Institution, LinkedEmail, UserProfile
+from uniauth.utils import choose_username
+
+RUN_BENCHMARKS = bool(os.environ.get("UNIAUTH_RUN_BENCHMARKS"))
+
+
+def _report(name, seconds, iterations):
+    """
+    Writes the average time per iteration of a benchmark to stderr
+    """
+    sys.stderr.write(
+        "\n[benchmark] %s: %.3f ms per call (%d calls)\n"
+        % (name, 1000.0 * seconds / iterations, iterations)
+    )
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, "UNIAUTH_RUN_BENCHMARKS is not set")
+class LinkedEmailLookupBenchmarks(TransactionTestCase):
+    """
+    Benchmarks the linked email lookups used on every login
+    """
+
+    num_emails = int(
+        os.environ.get("UNIAUTH_BENCHMARK_LINKED_EMAILS", 1000000)
+    )
+    num_profiles = 1000
+    num_lookups = 200
+
+    def setUp(self):
+        User.objects.bulk_create(
+            [User(username="user%d" % i) for i in range(self.num_profiles)]
+        )
+        UserProfile.objects.bulk_create(
+            [UserProfile(user=user) for user in User.objects.all()]
+        )
+        profile_pks = list(UserProfile.objects.values_list("pk", flat=True))
+        batch = []
+        for i in range(self.num_emails):
+            address = "Person.%d@Example.com" % i
+            batch.append(
+                LinkedEmail(
+                    profile_id=profile_pks[i % len(profile_pks)],
+                    address=address,
+                    normalized_address=address.lower(),
+                    is_verified=True,
+                )
+            )
+            if len(batch) >= 10000:
+                LinkedEmail.objects.bulk_create(batch)
+                batch = []
+        LinkedEmail.objects.bulk_create(batch)
+
+    def test_linked_email_login_query(self):
+        """
+        Compares the login candidate query against the
+        unindexed case-insensitive lookup it replaced
+        """
+        step = max(self.num_emails // self.num_lookups, 1)
+        emails = [
+            "person.%d@example.com" % i
+            for i in range(0, self.num_emails, step)
+        ]
+        backend = LinkedEmailBackend()
+
+        start = time.time()
+        for email in emails:
+            self.assertEqual(len(list(backend._get_users(User, email))), 1)
+        _report(
+            "login query, %d linked emails" % self.num_emails,
+            time.time() - start,
+            len(emails),
+        )
+
+        start = time.time()
+        for email in emails:
+            users = User.objects.filter(
+                uniauth_profile__linked_emails__address__iexact=email,
+                uniauth_profile__linked_emails__is_verified=True,
+            )
+            self.assertEqual(len(list(users)), 1)
+        _report(
+            "iexact query, %d linked emails" % self.num_emails,
+            time.time() - start,
+            len(emails),
+        )
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, "UNIAUTH_RUN_BENCHMARKS is not set")
+class ChooseUsernameBenchmarks(TransactionTestCase):
+    """
+    Benchmarks choosing a username for an email address
+    many existing usernames are derived from
+    """
+
+    num_collisions = int(
+        os.environ.get("UNIAUTH_BENCHMARK_USERNAME_COLLISIONS", 10000)
+    )
+    num_calls = 100
+    email = "popular@example.com"
+
+    def setUp(self):
+        usernames = [self.email] + [
+            "%s_%03d" % (self.email, i)
+            for i in range(2, self.num_collisions + 1)
+        ]
+        for i in range(0, len(usernames), 10000):
+            User.objects.bulk_create(
+                [User(username=x) for x in usernames[i : i + 10000]]
+            )
+
+    def test_choose_username(self):
+        """
+        Compares choose_username against probing each
+        candidate suffix with its own query
+        """
+        expected = "%s_%03d" % (self.email, self.num_collisions + 1)
+
+        start = time.time()
+        for i in range(self.num_calls):
+            self.assertEqual(choose_username(self.email), expected)
+        _report(
+            "choose_username, %d collisions" % self.num_collisions,
+            time.time() - start,
+            self.num_calls,
+        )
+
+        def probe(email):
+            num = 1
+            suffix = ""
+            while User.objects.filter(username=email + suffix).exists():
+                num += 1
+                suffix = "_" + str(num).zfill(3)
+            return email + suffix
+
+        num_probe_calls = max(self.num_calls // 20, 1)
+        start = time.time()
+        for i in range(num_probe_calls):
+            self.assertEqual(probe(self.email), expected)
+        _report(
+            "probing choose_username, %d collisions" % self.num_collisions,
+            time.time() - start,
+            num_probe_calls,
+        )
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, "UNIAUTH_RUN_BENCHMARKS is not set")
+class CASTicketVerificationBenchmarks(SimpleTestCase):
+    """
+    Benchmarks verifying tickets concurrently with a stub CAS server
+    """
+
+    num_verifications = 2000
+    num_threads = 8
+
+    def _verify_all(self, get_client):
+        def verify(i):
+            username, attributes, pgtiou = get_client().verify_ticket(
+                "ST-user%d" % i
+            )
+            self.assertEqual(username, "user%d" % i)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            list(executor.map(verify, range(self.num_verifications)))
+        return time.time() - start
+
+    def test_verify_ticket(self):
+        """
+        Compares verifying tickets with the pooled sessions
+        against opening a new session for each verification
+        """
+        service_url = "http://www.service.com/"
+        with StubCASServer() as server:
+            inst = Institution(slug="stub-inst", cas_server_url=server.url)
+            elapsed = self._verify_all(
+                lambda: get_cas_client(inst, service_url)
+            )
+            _report(
+                "verify_ticket, pooled sessions, %d threads (%d connections)"
+                % (self.num_threads, server.num_connections),
+                elapsed,
+                self.num_verifications,
+            )
+
+            def get_unpooled_client():
+                client = get_cas_client(inst, service_url)
+                client.session = requests.Session()
+                return client
+
+            num_connections = server.num_connections
+            elapsed = self._verify_all(get_unpooled_client)
+            _report(
+                "verify_ticket, new session per call, %d threads "
+                "(%d connections)"
+                % (self.num_threads, server.num_connections - num_connections),
+                elapsed,
+                self.num_verifications,
+            )
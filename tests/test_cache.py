@@ -0,0 +1,390 @@
+from django.core.cache import caches
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from uniauth.cache import (
+    INSTITUTIONS_VERSION_KEY,
+    _account_users,
+    _validated_tickets,
+    acquire_rate_limit,
+    cache_account_user,
+    cache_validated_ticket,
+    clear_institution_cache,
+    get_account_user,
+    get_institution,
+    get_institution_links,
+    get_institutions,
+    get_ticket_session_id,
+    get_validated_ticket,
+    invalidate_account_user,
+)
+from uniauth.models import Institution
+from uniauth.views import _get_global_context
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+class InstitutionRegistryTests(TestCase):
+    """
+    Tests the institution registry in cache.py
+    """
+
+    def setUp(self):
+        Institution.objects.all().delete()
+        self.inst1 = Institution.objects.create(
+            name="Test Uni",
+            slug="test-uni",
+            cas_server_url="https://cas.testuni.edu",
+        )
+        self.inst2 = Institution.objects.create(
+            name="Other Inst",
+            slug="other-inst",
+            cas_server_url="https://fed.other-inst.edu",
+        )
+        clear_institution_cache()
+
+    def test_institution_registry_caches_queries(self):
+        """
+        Ensure institutions are only loaded from the database once
+        """
+        with self.assertNumQueries(1):
+            get_institutions()
+            get_institution_links()
+            get_institutions()
+        request = RequestFactory().get("/accounts/login/")
+        with self.assertNumQueries(0):
+            _get_global_context(request)
+            links = get_institution_links()
+        expected_links = [
+            (
+                "Other Inst",
+                "other-inst",
+                "/accounts/cas-login/other-inst/",
+                "/accounts/link-from-profile/other-inst/",
+            ),
+            (
+                "Test Uni",
+                "test-uni",
+                "/accounts/cas-login/test-uni/",
+                "/accounts/link-from-profile/test-uni/",
+            ),
+        ]
+        self.assertEqual(sorted(links), expected_links)
+
+    def test_institution_registry_invalidated_by_signals(self):
+        """
+        Ensure the registry is refreshed when institutions change
+        """
+        get_institutions()
+        Institution.objects.create(
+            name="New Inst",
+            slug="new-inst",
+            cas_server_url="https://cas.newinst.edu",
+        )
+        slugs = sorted(x[1] for x in get_institution_links())
+        self.assertEqual(slugs, ["new-inst", "other-inst", "test-uni"])
+
+        self.inst1.name = "Renamed Uni"
+        self.inst1.save()
+        names = sorted(x.name for x in get_institutions())
+        self.assertEqual(names, ["New Inst", "Other Inst", "Renamed Uni"])
+
+        self.inst2.delete()
+        slugs = sorted(x[1] for x in get_institution_links())
+        self.assertEqual(slugs, ["new-inst", "test-uni"])
+
+    def test_institution_registry_returns_copies(self):
+        """
+        Ensure callers modifying the returned lists do not
+        affect the cached values
+        """
+        get_institution_links().pop()
+        get_institutions().pop()
+        self.assertEqual(len(get_institution_links()), 2)
+        self.assertEqual(len(get_institutions()), 2)
+
+    @override_settings(UNIAUTH_CACHE_ALIAS="default")
+    def test_institution_registry_shared_invalidation(self):
+        """
+        Ensure invalidations made by other processes through
+        the shared cache are respected
+        """
+        clear_institution_cache()
+        get_institutions()
+        with self.assertNumQueries(0):
+            get_institutions()
+
+        # Simulate another process invalidating the registry
+        caches["default"].set(INSTITUTIONS_VERSION_KEY, "other", None)
+        with self.assertNumQueries(1):
+            get_institutions()
+            get_institutions()
+
+        # Ensure local invalidations are broadcast
+        clear_institution_cache()
+        self.assertNotEqual(
+            caches["default"].get(INSTITUTIONS_VERSION_KEY), "other"
+        )
+
+
+class InstitutionLookupTests(TestCase):
+    """
+    Tests the get_institution method in cache.py
+    """
+
+    def setUp(self):
+        Institution.objects.all().delete()
+        self.inst = Institution.objects.create(
+            name="Test Uni",
+            slug="test-uni",
+            cas_server_url="https://cas.testuni.edu",
+        )
+        clear_institution_cache()
+
+    def test_get_institution_correct(self):
+        """
+        Ensure institutions are found by slug, and unknown slugs
+        raise DoesNotExist without querying the database again
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(get_institution("test-uni"), self.inst)
+            self.assertEqual(get_institution("test-uni"), self.inst)
+            for i in range(5):
+                self.assertRaises(
+                    Institution.DoesNotExist, get_institution, "dne-%d" % i
+                )
+        Institution.objects.create(
+            name="DNE 0", slug="dne-0", cas_server_url="https://cas.dne.edu"
+        )
+        self.assertEqual(get_institution("dne-0").name, "DNE 0")
+
+    @override_settings(UNIAUTH_INSTITUTION_CACHE_TIMEOUT=60)
+    @mock.patch("uniauth.cache.time.time")
+    def test_get_institution_timeout(self, mock_time):
+        """
+        Ensure the cached institutions expire after the timeout
+        """
+        mock_time.return_value = 1000.0
+        get_institution("test-uni")
+        # Bypass the signals, as another process would
+        Institution.objects.filter(pk=self.inst.pk).update(name="Renamed")
+        mock_time.return_value = 1059.0
+        with self.assertNumQueries(0):
+            self.assertEqual(get_institution("test-uni").name, "Test Uni")
+        mock_time.return_value = 1060.0
+        with self.assertNumQueries(1):
+            self.assertEqual(get_institution("test-uni").name, "Renamed")
+
+    def test_cas_login_unknown_institution(self):
+        """
+        Ensure the CAS views 404 for unknown slugs without
+        querying for the institution each time
+        """
+        get_institution("test-uni")
+        url = reverse("uniauth:cas-login", args=["dne"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class AcquireRateLimitTests(TestCase):
+    """
+    Tests the acquire_rate_limit method in cache.py
+    """
+
+    @mock.patch.dict("uniauth.cache._rate_limits", clear=True)
+    @mock.patch("uniauth.cache.time.time")
+    def test_acquire_rate_limit_local(self, mock_time):
+        """
+        Ensure actions are limited per process when no
+        shared cache is configured
+        """
+        mock_time.return_value = 1000.0
+        self.assertTrue(acquire_rate_limit("action", 10))
+        self.assertFalse(acquire_rate_limit("action", 10))
+        self.assertTrue(acquire_rate_limit("other-action", 10))
+        mock_time.return_value = 1010.0
+        self.assertTrue(acquire_rate_limit("action", 10))
+
+    @override_settings(UNIAUTH_CACHE_ALIAS="default")
+    @mock.patch.dict("uniauth.cache._rate_limits", clear=True)
+    def test_acquire_rate_limit_shared(self):
+        """
+        Ensure actions are limited across processes when
+        a shared cache is configured
+        """
+        caches["default"].clear()
+        self.assertTrue(acquire_rate_limit("action", 10))
+        # Simulate another process attempting the same action
+        with mock.patch.dict("uniauth.cache._rate_limits", clear=True):
+            self.assertFalse(acquire_rate_limit("action", 10))
+        caches["default"].clear()
+
+
+class ValidatedTicketTests(TestCase):
+    """
+    Tests the validated ticket cache in cache.py
+    """
+
+    def setUp(self):
+        self.inst = Institution.objects.create(
+            name="Test Inst",
+            slug="test-inst",
+            cas_server_url="https://fed.testinst.edu/",
+        )
+        self.service = "http://www.service.com/"
+
+    @override_settings(UNIAUTH_CAS_TICKET_CACHE_TIMEOUT=10)
+    @mock.patch.dict("uniauth.cache._validated_tickets", clear=True)
+    @mock.patch("uniauth.cache.time.time")
+    def test_validated_ticket_local(self, mock_time):
+        """
+        Ensure validated tickets are cached per institution,
+        ticket, service and session until they expire
+        """
+        mock_time.return_value = 1000.0
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-1", self.service, "s1"), None
+        )
+        cache_validated_ticket(
+            self.inst, "ST-1", self.service, "s1", "john", {"mail": "j@a.com"}
+        )
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-1", self.service, "s1"),
+            ("john", {"mail": "j@a.com"}),
+        )
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-1", self.service, "s2"), None
+        )
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-1", self.service, None), None
+        )
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-2", self.service, "s1"), None
+        )
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-1", "http://other.com/", "s1"),
+            None,
+        )
+
+        # Expired entries are discarded when others are cached
+        mock_time.return_value = 1010.0
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-1", self.service, "s1"), None
+        )
+        cache_validated_ticket(
+            self.inst, "ST-2", self.service, "s1", "jane", None
+        )
+        self.assertEqual(len(_validated_tickets), 1)
+
+        # Nothing is cached without a session
+        cache_validated_ticket(
+            self.inst, "ST-3", self.service, None, "x", None
+        )
+        self.assertEqual(len(_validated_tickets), 1)
+
+    @mock.patch.dict("uniauth.cache._validated_tickets", clear=True)
+    def test_validated_ticket_disabled(self):
+        """
+        Ensure nothing is cached if the timeout is 0, the default
+        """
+        request = RequestFactory().get("/")
+        request.session = {}
+        self.assertEqual(get_ticket_session_id(request), None)
+        self.assertEqual(request.session, {})
+        cache_validated_ticket(
+            self.inst, "ST-1", self.service, "s1", "john", None
+        )
+        self.assertEqual(
+            get_validated_ticket(self.inst, "ST-1", self.service, "s1"), None
+        )
+
+    @override_settings(UNIAUTH_CAS_TICKET_CACHE_TIMEOUT=10)
+    def test_get_ticket_session_id(self):
+        """
+        Ensure each session is given its own id, which is kept
+        """
+        request = RequestFactory().get("/")
+        self.assertEqual(get_ticket_session_id(request), None)
+        request.session = {}
+        session_id = get_ticket_session_id(request)
+        self.assertNotEqual(session_id, None)
+        self.assertEqual(get_ticket_session_id(request), session_id)
+        request.session = {}
+        self.assertNotEqual(get_ticket_session_id(request), session_id)
+
+    @override_settings(
+        UNIAUTH_CACHE_ALIAS="default", UNIAUTH_CAS_TICKET_CACHE_TIMEOUT=10
+    )
+    @mock.patch.dict("uniauth.cache._validated_tickets", clear=True)
+    def test_validated_ticket_shared(self):
+        """
+        Ensure validated tickets are shared across processes
+        when a shared cache is configured
+        """
+        caches["default"].clear()
+        cache_validated_ticket(
+            self.inst, "ST-1", self.service, "s1", "john", None
+        )
+        # Simulate another process receiving the same ticket
+        with mock.patch.dict("uniauth.cache._validated_tickets", clear=True):
+            self.assertEqual(
+                tuple(
+                    get_validated_ticket(self.inst, "ST-1", self.service, "s1")
+                ),
+                ("john", None),
+            )
+            self.assertEqual(
+                get_validated_ticket(self.inst, "ST-1", self.service, "s2"),
+                None,
+            )
+        caches["default"].clear()
+
+
+class AccountUserCacheTests(TestCase):
+    """
+    Tests the InstitutionAccount user cache in cache.py
+    """
+
+    @mock.patch.dict("uniauth.cache._account_users", clear=True)
+    @mock.patch("uniauth.cache.time.time")
+    def test_account_user_local(self, mock_time):
+        """
+        Ensure account users are cached until they expire,
+        are invalidated, or are the least recently used
+        """
+        mock_time.return_value = 1000.0
+        self.assertEqual(get_account_user(1, "john"), None)
+        cache_account_user(1, "john", 10)
+        cache_account_user(2, "john", 20)
+        self.assertEqual(get_account_user(1, "john"), 10)
+        self.assertEqual(get_account_user(2, "john"), 20)
+        invalidate_account_user(2, "john")
+        self.assertEqual(get_account_user(2, "john"), None)
+
+        with mock.patch("uniauth.cache.ACCOUNT_USER_CACHE_SIZE", 2):
+            cache_account_user(3, "jane", 30)
+            get_account_user(1, "john")
+            cache_account_user(4, "jack", 40)
+            self.assertEqual(len(_account_users), 2)
+            self.assertEqual(get_account_user(3, "jane"), None)
+
+        mock_time.return_value = 1300.0
+        self.assertEqual(get_account_user(1, "john"), None)
+
+    @override_settings(UNIAUTH_CACHE_ALIAS="default")
+    @mock.patch.dict("uniauth.cache._account_users", clear=True)
+    def test_account_user_shared(self):
+        """
+        Ensure account users are cached and invalidated across
+        processes when a shared cache is configured
+        """
+        caches["default"].clear()
+        cache_account_user(1, "john", 10)
+        self.assertEqual(len(_account_users), 0)
+        self.assertEqual(get_account_user(1, "john"), 10)
+        invalidate_account_user(1, "john")
+        self.assertEqual(get_account_user(1, "john"), None)
+        caches["default"].clear()
@@ -1,12 +1,24 @@
 import os
 import sys
+import tempfile
+from datetime import timedelta
+from io import StringIO
 
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.test import TestCase, override_settings
+from django.utils import timezone
 
-from uniauth.models import Institution, LinkedEmail, UserProfile
+from uniauth.health import record_verification
+from uniauth.models import (
+    Institution,
+    InstitutionAccount,
+    LinkedEmail,
+    MergeJob,
+    UserProfile,
+)
 
 try:
     import mock
@@ -124,11 +136,86 @@ class AddInstitutionCommandTests(TestCase):
         )
 
 
+class CASHealthCommandTests(TestCase):
+    """
+    Tests the cas_health management command
+    """
+
+    @mock.patch.dict("uniauth.health._health", clear=True)
+    @mock.patch("uniauth.health.HEALTH_PUBLISH_INTERVAL", 0)
+    def test_cas_health_command_correct(self):
+        """
+        Ensure the command reports each institution's health
+        """
+        self.assertRaisesRegex(
+            CommandError, "UNIAUTH_CACHE_ALIAS", call_command, "cas_health"
+        )
+        inst = Institution.objects.create(
+            name="Test Inst",
+            slug="test-inst",
+            cas_server_url="https://fed.testinst.edu/",
+        )
+        Institution.objects.create(
+            name="Other Inst",
+            slug="other-inst",
+            cas_server_url="https://fed.other.edu/",
+        )
+        with override_settings(UNIAUTH_CACHE_ALIAS="default"):
+            caches["default"].clear()
+            record_verification(inst, True, 0.2)
+            record_verification(inst, False, 0.4)
+            out = StringIO()
+            call_command("cas_health", stdout=out)
+            caches["default"].clear()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1].split()[:3], ["other-inst", "closed", "0"])
+        self.assertEqual(
+            lines[2].split(),
+            ["test-inst", "closed", "2", "50.0%", "300", "ms", "0"],
+        )
+
+
+class EstimateMergeCommandTests(TestCase):
+    """
+    Tests the estimate_merge management command
+    """
+
+    def test_estimate_merge_command_correct(self):
+        """
+        Ensure the command reports the rows that would be
+        moved without merging the users
+        """
+        primary = User.objects.create(username="primary")
+        alias = User.objects.create(username="alias")
+        LinkedEmail.objects.create(
+            profile=alias.uniauth_profile, address="alias@example.com"
+        )
+        self.assertRaisesRegex(
+            CommandError,
+            "dne",
+            call_command,
+            "estimate_merge",
+            "primary",
+            "dne",
+        )
+
+        out = StringIO()
+        call_command("estimate_merge", "primary", "alias", stdout=out)
+        output = out.getvalue()
+        self.assertIn("uniauth_profile.linked_emails", output)
+        self.assertIn("uniauth.LinkedEmail: 1", output)
+        self.assertTrue(User.objects.filter(username="alias").exists())
+        self.assertEqual(primary.uniauth_profile.linked_emails.count(), 0)
+
+
 class FlushTmpUsersTests(TestCase):
     """
     Tests the flush_tmp_users management command
     """
 
+    def setUp(self):
+        sys.stdout = open(os.devnull, "w")
+
     @mock.patch("uniauth.management.commands.flush_tmp_users.get_input")
     @mock.patch(
         "uniauth.management.commands.flush_tmp_users.flush_old_tmp_users"
@@ -158,6 +245,138 @@ class FlushTmpUsersTests(TestCase):
         call_command("flush_tmp_users")
         mock_flush.assert_called_with(days=1)
 
+    @mock.patch("uniauth.management.commands.flush_tmp_users.get_input")
+    def test_flush_tmp_users_command_batched(self, mock_get_input):
+        """
+        Ensure the batching options are respected, and progress
+        is saved to and resumed from the progress file
+        """
+        old_date = timezone.now() - timedelta(days=3)
+        for i in range(5):
+            User.objects.create(username="tmp-%d" % i, date_joined=old_date)
+        User.objects.create(username="tmp-new")
+        tmp_users = User.objects.filter(username__startswith="tmp-")
+
+        # Ensure dry runs delete nothing, and do not prompt
+        call_command("flush_tmp_users", "--dry-run", "--batch-size=2")
+        self.assertEqual(tmp_users.count(), 6)
+        mock_get_input.assert_not_called()
+
+        # Ensure flushing resumes from the progress file
+        progress_file = os.path.join(tempfile.mkdtemp(), "flush-progress.txt")
+        with open(progress_file, "w") as f:
+            f.write(str(User.objects.get(username="tmp-1").pk))
+        mock_get_input.return_value = "yes"
+        call_command(
+            "flush_tmp_users",
+            "--batch-size=2",
+            "--progress-file=%s" % progress_file,
+        )
+        self.assertEqual(
+            sorted(tmp_users.values_list("username", flat=True)),
+            ["tmp-0", "tmp-1", "tmp-new"],
+        )
+        self.assertFalse(os.path.exists(progress_file))
+
+        # Ensure --noinput skips the prompt
+        mock_get_input.reset_mock()
+        call_command("flush_tmp_users", "--noinput", "--batch-size=1")
+        mock_get_input.assert_not_called()
+        self.assertEqual(
+            list(tmp_users.values_list("username", flat=True)), ["tmp-new"]
+        )
+        self.assertRaisesRegex(
+            CommandError,
+            "batch-size",
+            call_command,
+            "flush_tmp_users",
+            "--noinput",
+            "--batch-size=0",
+        )
+
+
+class MergeUsersCommandTests(TestCase):
+    """
+    Tests the merge_users management command
+    """
+
+    def setUp(self):
+        for username in ["p1", "p2", "p3", "a1", "a2", "a3"]:
+            User.objects.create(username=username)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def _write_file(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def _usernames(self):
+        return sorted(User.objects.values_list("username", flat=True))
+
+    def test_merge_users_command_correct(self):
+        """
+        Ensure pairs are read from CSV and JSONL files and
+        merged, and that failures are reported
+        """
+        path = self._write_file("pairs.csv", "primary,alias\np1,a1\np2,a2\n")
+        self.assertRaisesRegex(
+            CommandError,
+            "batch-size",
+            call_command,
+            "merge_users",
+            path,
+            "--noinput",
+            "--batch-size=0",
+        )
+        call_command("merge_users", path, "--noinput", stdout=StringIO())
+        self.assertEqual(self._usernames(), ["a3", "p1", "p2", "p3"])
+
+        path = self._write_file(
+            "pairs.jsonl",
+            '{"primary": "p3", "alias": "a3"}\n'
+            '{"primary": "dne", "alias": "p1"}\n',
+        )
+        err = StringIO()
+        call_command(
+            "merge_users", path, "--noinput", stdout=StringIO(), stderr=err
+        )
+        self.assertEqual(self._usernames(), ["p1", "p2", "p3"])
+        self.assertIn("Line 2", err.getvalue())
+
+    def test_merge_users_command_resume(self):
+        """
+        Ensure merging resumes from the progress file, and that
+        workers only merge their share of the pairs
+        """
+        path = self._write_file("pairs.csv", "p1,a1\np2,a2\np3,a3\n")
+        progress_file = os.path.join(self.tmp_dir, "progress.txt")
+        with open(progress_file, "w") as f:
+            f.write("1")
+        call_command(
+            "merge_users",
+            path,
+            "--noinput",
+            "--batch-size=1",
+            "--progress-file=%s" % progress_file,
+            stdout=StringIO(),
+        )
+        self.assertEqual(self._usernames(), ["a1", "p1", "p2", "p3"])
+        self.assertFalse(os.path.exists(progress_file))
+
+        User.objects.create(username="a2")
+        User.objects.create(username="a3")
+        for index in range(2):
+            call_command(
+                "merge_users",
+                path,
+                "--noinput",
+                "--workers=2",
+                "--worker-index=%d" % index,
+                stdout=StringIO(),
+            )
+        self.assertEqual(self._usernames(), ["p1", "p2", "p3"])
+
 
 class MigrateCASCommandTests(TestCase):
     """
@@ -209,6 +428,80 @@ class MigrateCASCommandTests(TestCase):
             "cas-example-inst-marysue",
         ]
         self.assertEqual(sorted(actual_usernames), expected_usernames)
+        accounts = InstitutionAccount.objects.order_by("cas_id")
+        self.assertEqual(
+            [(x.profile.user.username, x.cas_id) for x in accounts],
+            [
+                ("cas-example-inst-exid123", "exid123"),
+                ("cas-example-inst-johndoe", "johndoe"),
+                ("cas-example-inst-marysue", "marysue"),
+            ],
+        )
+
+    @mock.patch("uniauth.management.commands.migrate_cas.get_input")
+    def test_migrate_cas_command_batched(self, mock_get_input):
+        """
+        Ensures users are migrated in batches without prompting
+        when --noinput is provided, and existing accounts are kept
+        """
+        institution = Institution.objects.get(slug="example-inst")
+        InstitutionAccount.objects.create(
+            profile=self.adam.uniauth_profile,
+            institution=institution,
+            cas_id="johndoe",
+        )
+        out = StringIO()
+        call_command(
+            "migrate_cas",
+            "example-inst",
+            "--noinput",
+            "--batch-size=2",
+            stdout=out,
+        )
+        mock_get_input.assert_not_called()
+        self.assertEqual(UserProfile.objects.count(), 4)
+        self.assertIn("Migrated 2 users, linking 1 accounts", out.getvalue())
+        self.assertIn("Migrated 1 users, linking 1 accounts", out.getvalue())
+        self.assertEqual(
+            InstitutionAccount.objects.get(cas_id="johndoe").profile,
+            self.adam.uniauth_profile,
+        )
+        self.assertTrue(
+            User.objects.filter(username="cas-example-inst-johndoe").exists()
+        )
+        self.assertRaisesRegex(
+            CommandError,
+            "batch-size",
+            call_command,
+            "migrate_cas",
+            "example-inst",
+            "--noinput",
+            "--batch-size=0",
+        )
+
+    def test_migrate_cas_command_long_username(self):
+        """
+        Ensures users whose prefixed username would be too long
+        are reported and skipped, without failing their batch
+        """
+        long_username = "a" * 140
+        User.objects.create(username=long_username)
+        UserProfile.objects.filter(user__username=long_username).delete()
+        out = StringIO()
+        call_command(
+            "migrate_cas",
+            "example-inst",
+            "--noinput",
+            "--batch-size=10",
+            stdout=out,
+        )
+        self.assertIn(long_username, out.getvalue())
+        self.assertIn("1 users could not be migrated", out.getvalue())
+        self.assertEqual(UserProfile.objects.count(), 4)
+        self.assertTrue(User.objects.filter(username=long_username).exists())
+        self.assertFalse(
+            UserProfile.objects.filter(user__username=long_username).exists()
+        )
 
 
 class MigrateCustomCommandTests(TestCase):
@@ -261,6 +554,150 @@ class MigrateCustomCommandTests(TestCase):
         )
         self.assertEqual(self.john.uniauth_profile.linked_emails.count(), 0)
 
+    @mock.patch("uniauth.management.commands.migrate_custom.get_input")
+    def test_migrate_custom_command_batched(self, mock_get_input):
+        """
+        Ensures users are migrated in batches within the provided
+        primary key range, and skipped users are written to a file
+        """
+        skipped_file = os.path.join(tempfile.mkdtemp(), "skipped.txt")
+        call_command(
+            "migrate_custom",
+            "--noinput",
+            "--batch-size=1",
+            "--max-pk=%d" % self.john.pk,
+            "--skipped-file=%s" % skipped_file,
+            stdout=StringIO(),
+        )
+        mock_get_input.assert_not_called()
+        self.assertEqual(UserProfile.objects.count(), 2)
+        self.assertFalse(UserProfile.objects.filter(user=self.mary).exists())
+        with open(skipped_file) as f:
+            self.assertEqual(f.read(), "exid123\n")
+
+        call_command(
+            "migrate_custom",
+            "--noinput",
+            "--min-pk=%d" % self.mary.pk,
+            stdout=StringIO(),
+        )
+        self.assertEqual(UserProfile.objects.count(), 3)
+        email = LinkedEmail.objects.get(profile__user=self.mary)
+        self.assertEqual(email.normalized_address, "mary.sue@gmail.com")
+        self.assertTrue(email.is_verified)
+
+
+class ProvisionUsersCommandTests(TestCase):
+    """
+    Tests the provision_users management command
+    """
+
+    def setUp(self):
+        Institution.objects.create(
+            name="Test Uni",
+            slug="test-uni",
+            cas_server_url="https://cas.testuni.edu",
+        )
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def _write_file(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_provision_users_command_correct(self):
+        """
+        Ensure users are read from CSV and JSONL files and
+        created, and that skipped users are reported
+        """
+        path = self._write_file(
+            "users.csv",
+            "username,email,linked_emails,institution_accounts\n"
+            "jd,jd@a.com,jd@b.com;jd@c.com,test-uni:jd1\n"
+            "mary,mary@a.com,,\n",
+        )
+        call_command("provision_users", path, stdout=StringIO())
+        john = User.objects.get(username="jd")
+        self.assertEqual(john.uniauth_profile.linked_emails.count(), 3)
+        self.assertEqual(john.uniauth_profile.accounts.get().cas_id, "jd1")
+        self.assertTrue(User.objects.filter(username="mary").exists())
+
+        path = self._write_file(
+            "users.jsonl",
+            '{"username": "adam", "institution_accounts": [["test-uni", "a1"]]}\n'
+            '{"username": "jd"}\n',
+        )
+        err = StringIO()
+        call_command("provision_users", path, stdout=StringIO(), stderr=err)
+        self.assertEqual(
+            User.objects.get(username="adam").uniauth_profile.accounts.count(),
+            1,
+        )
+        self.assertIn("Line 2", err.getvalue())
+        self.assertRaisesRegex(
+            CommandError,
+            "batch-size",
+            call_command,
+            "provision_users",
+            path,
+            "--batch-size=0",
+        )
+
+
+class RetryMergeJobsCommandTests(TestCase):
+    """
+    Tests the retry_merge_jobs management command
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="primary")
+        self.alias_pks = []
+        for i in range(4):
+            self.alias_pks.append(User.objects.create(username="a%d" % i).pk)
+
+    def _create_job(self, i, status, minutes_ago=0):
+        job = MergeJob.objects.create(
+            idempotency_key=str(i),
+            profile=self.user.uniauth_profile,
+            alias_user_pk=str(self.alias_pks[i]),
+            status=status,
+        )
+        MergeJob.objects.filter(pk=job.pk).update(
+            updated=timezone.now() - timedelta(minutes=minutes_ago)
+        )
+        return job
+
+    def test_retry_merge_jobs_command_correct(self):
+        """
+        Ensure failed and stale jobs are run again, and other
+        jobs are left alone
+        """
+        self._create_job(0, MergeJob.STATUS_FAILED)
+        self._create_job(1, MergeJob.STATUS_RUNNING, minutes_ago=90)
+        self._create_job(2, MergeJob.STATUS_RUNNING, minutes_ago=10)
+        self._create_job(3, MergeJob.STATUS_PENDING, minutes_ago=90)
+        self.assertRaises(
+            CommandError, call_command, "retry_merge_jobs", "--stale-minutes=0"
+        )
+
+        out = StringIO()
+        call_command("retry_merge_jobs", "--dry-run", stdout=out)
+        self.assertIn("Found 3 merge jobs", out.getvalue())
+        self.assertEqual(User.objects.count(), 5)
+
+        out = StringIO()
+        call_command("retry_merge_jobs", stdout=out)
+        self.assertIn("Retried 3 merge jobs: 3 succeeded", out.getvalue())
+        self.assertEqual(
+            sorted(User.objects.values_list("username", flat=True)),
+            ["a2", "primary"],
+        )
+        self.assertEqual(
+            MergeJob.objects.get(idempotency_key="2").status,
+            MergeJob.STATUS_RUNNING,
+        )
+
 
 class RemoveInsitutionCommandTests(TestCase):
     """
@@ -0,0 +1,140 @@
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from uniauth.health import (
+    CASServerUnavailable,
+    check_circuit,
+    get_circuit_open_until,
+    get_published_stats,
+    record_verification,
+)
+from uniauth.models import Institution
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+@override_settings(
+    UNIAUTH_CAS_BREAKER_COOLDOWN=30,
+    UNIAUTH_CAS_BREAKER_FAILURE_RATE=0.5,
+    UNIAUTH_CAS_BREAKER_MIN_REQUESTS=4,
+)
+class CircuitBreakerTests(TestCase):
+    """
+    Tests the circuit breaker in health.py
+    """
+
+    def setUp(self):
+        patcher = mock.patch.dict("uniauth.health._health", clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.inst = Institution.objects.create(
+            name="Test Inst",
+            slug="test-inst",
+            cas_server_url="https://fed.testinst.edu/",
+        )
+        self.inst2 = Institution.objects.create(
+            name="Other Inst",
+            slug="other-inst",
+            cas_server_url="https://fed.other.edu/",
+        )
+
+    def _verify(self, institution, succeeded):
+        check_circuit(institution)
+        record_verification(institution, succeeded, 0.1)
+
+    @mock.patch("uniauth.health.time.time")
+    def test_circuit_opens_and_closes(self, mock_time):
+        """
+        Ensure the circuit opens once enough verifications fail,
+        and closes again after a successful probe
+        """
+        mock_time.return_value = 1000.0
+        self._verify(self.inst, True)
+        self._verify(self.inst, False)
+        self._verify(self.inst, True)
+        self.assertEqual(get_circuit_open_until(self.inst), None)
+        self._verify(self.inst, False)
+        self.assertEqual(get_circuit_open_until(self.inst), 1030.0)
+        self.assertRaises(CASServerUnavailable, check_circuit, self.inst)
+        # Other institutions are unaffected
+        self._verify(self.inst2, True)
+
+        # Only one probe is let through after the cooldown
+        mock_time.return_value = 1030.0
+        check_circuit(self.inst)
+        self.assertRaises(CASServerUnavailable, check_circuit, self.inst)
+        record_verification(self.inst, True, 0.1)
+        self.assertEqual(get_circuit_open_until(self.inst), None)
+        self._verify(self.inst, False)
+        self._verify(self.inst, True)
+
+    @mock.patch("uniauth.health.time.time")
+    def test_circuit_failed_probe(self, mock_time):
+        """
+        Ensure the circuit is opened again if the probe fails
+        """
+        mock_time.return_value = 1000.0
+        for i in range(4):
+            self._verify(self.inst, False)
+        self.assertRaises(CASServerUnavailable, check_circuit, self.inst)
+        mock_time.return_value = 1030.0
+        self._verify(self.inst, False)
+        self.assertEqual(get_circuit_open_until(self.inst), 1060.0)
+        self.assertRaises(CASServerUnavailable, check_circuit, self.inst)
+
+    @override_settings(UNIAUTH_CAS_BREAKER_FAILURE_RATE=None)
+    def test_circuit_disabled(self):
+        """
+        Ensure the circuit never opens if the breaker is disabled
+        """
+        for i in range(10):
+            self._verify(self.inst, False)
+        self.assertEqual(get_circuit_open_until(self.inst), None)
+
+    @override_settings(UNIAUTH_CACHE_ALIAS="default")
+    @mock.patch("uniauth.health.HEALTH_PUBLISH_INTERVAL", 0)
+    def test_circuit_shared(self):
+        """
+        Ensure open circuits and statistics are shared across
+        processes when a shared cache is configured
+        """
+        caches["default"].clear()
+        for i in range(4):
+            self._verify(self.inst, i % 2 == 0)
+        # Simulate another process verifying tickets
+        with mock.patch.dict("uniauth.health._health", clear=True):
+            self.assertRaises(CASServerUnavailable, check_circuit, self.inst)
+            self.assertNotEqual(get_circuit_open_until(self.inst), None)
+            self._verify(self.inst2, True)
+        stats = get_published_stats(self.inst, 5)
+        self.assertEqual(stats.requests, 4)
+        self.assertEqual(stats.failures, 2)
+        self.assertAlmostEqual(stats.latency, 0.4)
+        self.assertEqual(get_published_stats(self.inst2, 5).requests, 1)
+        caches["default"].clear()
+
+    @override_settings(UNIAUTH_CACHE_ALIAS="default")
+    @mock.patch("uniauth.health.time.time")
+    def test_circuit_published_stats(self, mock_time):
+        """
+        Ensure rejected verifications are counted, and statistics
+        are published as soon as the circuit opens or closes
+        """
+        caches["default"].clear()
+        mock_time.return_value = 1000.0
+        for i in range(4):
+            self._verify(self.inst, False)
+        stats = get_published_stats(self.inst, 5)
+        self.assertEqual((stats.requests, stats.failures), (4, 4))
+        for i in range(3):
+            self.assertRaises(CASServerUnavailable, check_circuit, self.inst)
+
+        # Rejections are published with the next totals
+        mock_time.return_value = 1030.0
+        self._verify(self.inst, True)
+        stats = get_published_stats(self.inst, 5)
+        self.assertEqual((stats.requests, stats.rejections), (5, 3))
+        caches["default"].clear()
@@ -0,0 +1,186 @@
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from uniauth.jobs import (
+    MERGE_FAILED_ERROR,
+    retry_merge_job,
+    run_merge_job,
+    schedule_merge,
+)
+from uniauth.models import Institution, InstitutionAccount, MergeJob
+from uniauth.views import _link_unlinked_account
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+@override_settings(UNIAUTH_MERGE_EXECUTOR="uniauth.jobs.run_merge_job")
+class MergeJobTests(TestCase):
+    """
+    Tests the merge job functions in jobs.py
+    """
+
+    def setUp(self):
+        self.institution = Institution.objects.create(
+            name="Test Uni",
+            slug="test-uni",
+            cas_server_url="https://cas.testuni.edu",
+        )
+        self.user = User.objects.create(username="johndoe")
+        self.unlinked_user = User.objects.create(username="cas-test-uni-jd1")
+
+    def test_schedule_merge_runs_on_commit(self):
+        """
+        Ensures the merge is only performed once the
+        transaction scheduling it commits
+        """
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            job = schedule_merge(self.user, self.unlinked_user)
+            self.assertEqual(job.status, MergeJob.STATUS_PENDING)
+            self.assertTrue(User.objects.filter(pk=job.alias_user_pk))
+        self.assertEqual(len(callbacks), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, MergeJob.STATUS_SUCCEEDED)
+        self.assertFalse(User.objects.filter(username="cas-test-uni-jd1"))
+
+    def test_schedule_merge_idempotent(self):
+        """
+        Ensures scheduling the same merge twice reuses the job,
+        and only runs it again if it failed
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            job1 = schedule_merge(self.user, self.unlinked_user, "key1")
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            job2 = schedule_merge(self.user, self.unlinked_user, "key1")
+        self.assertEqual(job1.pk, job2.pk)
+        self.assertEqual(len(callbacks), 0)
+        self.assertEqual(MergeJob.objects.count(), 1)
+
+        MergeJob.objects.filter(pk=job1.pk).update(
+            status=MergeJob.STATUS_FAILED, error="Oops"
+        )
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            job3 = schedule_merge(self.user, self.unlinked_user, "key1")
+        self.assertEqual(job1.pk, job3.pk)
+        self.assertEqual(len(callbacks), 1)
+        job3.refresh_from_db()
+        self.assertEqual(job3.status, MergeJob.STATUS_SUCCEEDED)
+        self.assertEqual(job3.error, "")
+
+    def test_run_merge_job_failure(self):
+        """
+        Ensures failed merges are recorded on the job, and that
+        jobs that are not pending are not run
+        """
+        with mock.patch("uniauth.jobs._submit"):
+            job = schedule_merge(self.user, self.unlinked_user)
+        with mock.patch(
+            "uniauth.jobs.merge_model_instances",
+            side_effect=ValueError("Merge failed"),
+        ):
+            job = run_merge_job(job.pk)
+        self.assertEqual(job.status, MergeJob.STATUS_FAILED)
+        self.assertEqual(job.error, MERGE_FAILED_ERROR)
+        self.assertTrue(User.objects.filter(username="cas-test-uni-jd1"))
+
+        with mock.patch("uniauth.jobs.merge_model_instances") as merge:
+            job = run_merge_job(job.pk)
+        self.assertFalse(merge.called)
+        self.assertEqual(job.status, MergeJob.STATUS_FAILED)
+
+    def test_retry_merge_job(self):
+        """
+        Ensures failed and stale jobs are run again, while jobs
+        that are running or already succeeded are left alone
+        """
+        from datetime import timedelta
+
+        from django.utils import timezone
+
+        with mock.patch("uniauth.jobs._submit"):
+            job = schedule_merge(self.user, self.unlinked_user)
+        MergeJob.objects.filter(pk=job.pk).update(
+            status=MergeJob.STATUS_RUNNING
+        )
+        stale_before = timezone.now() - timedelta(hours=1)
+        job = retry_merge_job(job.pk, stale_before=stale_before)
+        self.assertEqual(job.status, MergeJob.STATUS_RUNNING)
+
+        MergeJob.objects.filter(pk=job.pk).update(
+            updated=stale_before - timedelta(minutes=1)
+        )
+        job = retry_merge_job(job.pk, stale_before=stale_before)
+        self.assertEqual(job.status, MergeJob.STATUS_SUCCEEDED)
+        self.assertFalse(User.objects.filter(username="cas-test-uni-jd1"))
+        with mock.patch("uniauth.jobs.merge_model_instances") as merge:
+            job = retry_merge_job(job.pk)
+        self.assertFalse(merge.called)
+
+    @override_settings(UNIAUTH_DEFER_MERGES=True)
+    def test_link_unlinked_account_deferred(self):
+        """
+        Ensures the institution account is linked immediately
+        when merges are deferred, and the merge is run later
+        """
+        request = RequestFactory().get("/", HTTP_IDEMPOTENCY_KEY="abc")
+        request.session = {}
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            job = _link_unlinked_account(
+                request, self.user, self.unlinked_user
+            )
+            account = InstitutionAccount.objects.get(cas_id="jd1")
+            self.assertEqual(account.profile, self.user.uniauth_profile)
+            self.assertTrue(User.objects.filter(username="cas-test-uni-jd1"))
+
+            # A retried request reuses the linked account and the job
+            retried_job = _link_unlinked_account(
+                request, self.user, self.unlinked_user
+            )
+            self.assertEqual(retried_job.pk, job.pk)
+            self.assertEqual(InstitutionAccount.objects.count(), 1)
+        self.assertEqual(job.idempotency_key, "%s:abc" % self.user.pk)
+        self.assertEqual(request.session["merge-job-id"], job.pk)
+        for callback in callbacks:
+            callback()
+        self.assertFalse(User.objects.filter(username="cas-test-uni-jd1"))
+
+    def test_merge_status(self):
+        """
+        Ensures the merge status view only reports the
+        jobs of the current user
+        """
+        with mock.patch("uniauth.jobs._submit"):
+            job = schedule_merge(self.user, self.unlinked_user)
+        url = reverse("uniauth:merge-status", args=[job.pk])
+        other_user = User.objects.create(username="janedoe")
+
+        self.client.force_login(other_user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(), {"id": job.pk, "status": MergeJob.STATUS_PENDING}
+        )
+
+        # Errors are never exposed to the user
+        MergeJob.objects.filter(pk=job.pk).update(
+            status=MergeJob.STATUS_FAILED, error=MERGE_FAILED_ERROR
+        )
+        response = self.client.get(url)
+        self.assertEqual(
+            response.json(), {"id": job.pk, "status": MergeJob.STATUS_FAILED}
+        )
+
+        # The job scheduled in the session is used if no id is provided
+        url = reverse("uniauth:merge-status")
+        self.assertEqual(self.client.get(url).status_code, 404)
+        session = self.client.session
+        session["merge-job-id"] = job.pk
+        session.save()
+        self.assertEqual(self.client.get(url).json()["id"], job.pk)
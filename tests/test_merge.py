@@ -1,9 +1,32 @@
-from django.contrib.auth.models import User
+from django.apps import apps
+from django.contrib.auth.models import Group, User
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-from uniauth.merge import merge_model_instances
+from tests.models import (
+    AuditedNote,
+    Comment,
+    Membership,
+    Note,
+    Project,
+    Team,
+    TeamComment,
+)
+from uniauth.merge import (
+    _get_generic_fields,
+    _get_generic_fields_for,
+    estimate_merge,
+    get_merge_plan,
+    merge_model_instances,
+)
 from uniauth.models import Institution, InstitutionAccount, LinkedEmail
 
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
 
 class MergeModelInstancesTests(TestCase):
     """
@@ -207,3 +230,282 @@ class MergeModelInstancesTests(TestCase):
         ]
         self._check_emails(emails, expected_emails)
         self._check_accounts(accounts, expected_accounts)
+
+
+class BulkMergeTests(TestCase):
+    """
+    Tests that merge_model_instances moves related rows
+    for all kinds of relations
+    """
+
+    def setUp(self):
+        self.primary = User.objects.create(username="primary")
+        self.alias = User.objects.create(username="alias")
+        for i in range(5):
+            Note.objects.create(user=self.alias, text="note %d" % i)
+            AuditedNote.objects.create(user=self.alias)
+            Comment.objects.create(content_object=self.alias)
+        self.team1 = Team.objects.create(name="team1")
+        self.team2 = Team.objects.create(name="team2")
+        self.team1.members.add(self.primary, self.alias)
+        self.team2.members.add(self.alias)
+        self.group = Group.objects.create(name="group")
+        self.alias.groups.add(self.group)
+
+    def _check_merged(self):
+        self.assertFalse(User.objects.filter(username="alias").exists())
+        self.assertEqual(self.primary.notes.count(), 5)
+        self.assertEqual(self.primary.audited_notes.count(), 5)
+        self.assertEqual(
+            Comment.objects.filter(object_id=self.primary.pk).count(), 5
+        )
+        self.assertEqual(
+            sorted(self.primary.teams.values_list("name", flat=True)),
+            ["team1", "team2"],
+        )
+        self.assertEqual(list(self.primary.groups.all()), [self.group])
+
+    def test_merge_model_instances_bulk(self):
+        """
+        Ensure related rows are moved with set-based queries,
+        without calling save() on them
+        """
+        merge_model_instances(self.primary, [self.alias])
+        self._check_merged()
+        self.assertEqual(
+            set(AuditedNote.objects.values_list("num_saves", flat=True)),
+            set([1]),
+        )
+
+    def test_merge_model_instances_bulk_query_count(self):
+        """
+        Ensure the number of queries does not grow with
+        the number of related rows
+        """
+        with CaptureQueriesContext(connection) as small_merge:
+            merge_model_instances(self.primary, [self.alias])
+        primary2 = User.objects.create(username="primary2")
+        alias2 = User.objects.create(username="alias2")
+        for i in range(50):
+            Note.objects.create(user=alias2)
+            AuditedNote.objects.create(user=alias2)
+            Comment.objects.create(content_object=alias2)
+        Team.objects.create(name="team3").members.add(alias2)
+        alias2.groups.add(self.group)
+        with CaptureQueriesContext(connection) as large_merge:
+            merge_model_instances(primary2, [alias2])
+        self.assertEqual(len(large_merge), len(small_merge))
+
+    def _check_shared_through_merged(self):
+        shared = Project.objects.create(name="shared")
+        other = Project.objects.create(name="other")
+        Membership.objects.create(
+            user=self.primary, project=shared, role="owner"
+        )
+        Membership.objects.create(user=self.alias, project=shared)
+        Membership.objects.create(
+            user=self.alias, project=other, role="editor"
+        )
+        merge_model_instances(self.primary, [self.alias])
+        self.assertEqual(
+            sorted(
+                Membership.objects.values_list(
+                    "user__username", "project__name", "role"
+                )
+            ),
+            [("primary", "other", "editor"), ("primary", "shared", "owner")],
+        )
+
+    def test_merge_model_instances_shared_through(self):
+        """
+        Ensure rows of custom through models are moved, except those
+        for objects the primary object is already related to, which
+        would violate the through model's unique constraint
+        """
+        self._check_shared_through_merged()
+
+    @override_settings(UNIAUTH_MERGE_SAVE_MODELS=["tests.Membership"])
+    def test_merge_model_instances_shared_through_save_models(self):
+        """
+        Ensure shared related objects are also handled when the
+        through model is re-pointed with save()
+        """
+        self._check_shared_through_merged()
+
+    @override_settings(UNIAUTH_MERGE_SAVE_MODELS=["tests.AuditedNote"])
+    def test_merge_model_instances_save_models(self):
+        """
+        Ensure models listed in UNIAUTH_MERGE_SAVE_MODELS are
+        re-pointed with save()
+        """
+        merge_model_instances(self.primary, [self.alias])
+        self._check_merged()
+        self.assertEqual(
+            set(AuditedNote.objects.values_list("num_saves", flat=True)),
+            set([2]),
+        )
+
+
+class GenericFieldsTests(TestCase):
+    """
+    Tests the generic foreign key lookups in merge.py
+    """
+
+    def test_get_generic_fields_cached(self):
+        """
+        Ensure the models are only inspected once
+        """
+        with mock.patch.dict(
+            "uniauth.merge._generic_fields",
+            {"all": None, "by_content_type": {}},
+        ):
+            with mock.patch(
+                "uniauth.merge.apps.get_models", wraps=apps.get_models
+            ) as mock_get_models:
+                fields = _get_generic_fields()
+                self.assertIs(_get_generic_fields(), fields)
+                user = User.objects.create(username="user")
+                _get_generic_fields_for(User)
+                _get_generic_fields_for(User)
+                self.assertEqual(mock_get_models.call_count, 1)
+        self.assertIn(Comment.content_object, fields)
+        self.assertIn(TeamComment.content_object, fields)
+
+    def test_get_generic_fields_for_correct(self):
+        """
+        Ensure generic foreign keys are filtered by the
+        content types they may refer to
+        """
+        user = User.objects.create(username="user")
+        team = Team.objects.create(name="team")
+        user_fields = _get_generic_fields_for(User)
+        team_fields = _get_generic_fields_for(Team)
+        self.assertIn(Comment.content_object, user_fields)
+        self.assertNotIn(TeamComment.content_object, user_fields)
+        self.assertIn(Comment.content_object, team_fields)
+        self.assertIn(TeamComment.content_object, team_fields)
+        with self.assertNumQueries(0):
+            self.assertEqual(_get_generic_fields_for(User), user_fields)
+
+    def test_merge_model_instances_skips_generic_fields(self):
+        """
+        Ensure models whose generic foreign keys cannot refer to
+        the merged model are not queried during the merge
+        """
+        primary = User.objects.create(username="primary")
+        alias = User.objects.create(username="alias")
+        Comment.objects.create(content_object=alias)
+        _get_generic_fields_for(User)
+        with CaptureQueriesContext(connection) as queries:
+            merge_model_instances(primary, [alias])
+        sql = " ".join(x["sql"] for x in queries.captured_queries)
+        self.assertIn(Comment._meta.db_table, sql)
+        self.assertNotIn(TeamComment._meta.db_table, sql)
+        self.assertEqual(
+            Comment.objects.filter(object_id=primary.pk).count(), 1
+        )
+
+
+class GetMergePlanTests(TestCase):
+    """
+    Tests the get_merge_plan method in merge.py
+    """
+
+    def test_get_merge_plan_correct(self):
+        """
+        Ensure the plan lists each kind of relation
+        """
+        plan = get_merge_plan(User)
+        self.assertEqual(plan.model, User)
+        many_to_many = dict((x.accessor_name, x) for x in plan.many_to_many)
+        self.assertEqual(
+            sorted(many_to_many),
+            ["groups", "projects", "teams", "user_permissions"],
+        )
+        self.assertIsNone(many_to_many["teams"].field_name)
+        self.assertEqual(many_to_many["projects"].field_name, "user")
+        self.assertEqual(many_to_many["projects"].target_field_name, "project")
+        self.assertEqual(many_to_many["teams"].through, Team.members.through)
+        one_to_many = dict((x.accessor_name, x) for x in plan.one_to_many)
+        self.assertEqual(one_to_many["notes"].field_name, "user")
+        self.assertEqual(one_to_many["notes"].related_model, Note)
+        to_one = [x.accessor_name for x in plan.to_one]
+        self.assertIn("uniauth_profile", to_one)
+        self.assertIn(Comment.content_object, plan.generic)
+        self.assertNotIn(TeamComment.content_object, plan.generic)
+
+    def test_get_merge_plan_cached(self):
+        """
+        Ensure plans are computed once per model, and are immutable
+        """
+        plan = get_merge_plan(User)
+        self.assertIs(get_merge_plan(User), plan)
+        self.assertIsNot(get_merge_plan(Team), plan)
+        self.assertRaises(AttributeError, setattr, plan, "model", Team)
+        self.assertIsInstance(plan.one_to_many, tuple)
+
+
+class EstimateMergeTests(TestCase):
+    """
+    Tests the estimate_merge method in merge.py
+    """
+
+    def setUp(self):
+        self.primary = User.objects.create(username="primary")
+        self.alias = User.objects.create(username="alias")
+        LinkedEmail.objects.create(
+            profile=self.alias.uniauth_profile, address="alias@example.com"
+        )
+        for i in range(3):
+            Note.objects.create(user=self.alias)
+            Comment.objects.create(content_object=self.alias)
+        Team.objects.create(name="team1").members.add(self.alias)
+
+    def test_estimate_merge_correct(self):
+        """
+        Ensure the estimated rows match the related rows
+        of the alias, including recursive merges
+        """
+        estimates = dict(
+            ((x.kind, x.path), x)
+            for x in estimate_merge(self.primary, [self.alias])
+        )
+        self.assertEqual(estimates[("one_to_many", "notes")].rows, 3)
+        self.assertEqual(estimates[("one_to_many", "notes")].queries, 1)
+        self.assertEqual(
+            estimates[("generic", "tests.Comment.content_object")].rows, 3
+        )
+        self.assertEqual(estimates[("many_to_many", "teams")].rows, 1)
+        self.assertEqual(
+            estimates[("many_to_many", "teams")].model, "tests.Team_members"
+        )
+        self.assertEqual(
+            estimates[("one_to_many", "uniauth_profile.linked_emails")].rows,
+            1,
+        )
+        self.assertEqual(estimates[("delete", "user")].model, "auth.User")
+        self.assertEqual(
+            estimates[("delete", "uniauth_profile")].model,
+            "uniauth.UserProfile",
+        )
+
+    @override_settings(UNIAUTH_MERGE_SAVE_MODELS=["tests.Note"])
+    def test_estimate_merge_save_models(self):
+        """
+        Ensure re-pointing rows with save() is estimated
+        to take a query per row
+        """
+        estimates = estimate_merge(self.primary, [self.alias])
+        notes = [x for x in estimates if x.path == "notes"][0]
+        self.assertEqual(notes.queries, 4)
+
+    def test_estimate_merge_read_only(self):
+        """
+        Ensure estimating a merge does not write anything
+        """
+        with CaptureQueriesContext(connection) as queries:
+            estimate_merge(self.primary, [self.alias])
+        for query in queries:
+            self.assertTrue(query["sql"].startswith("SELECT"), query["sql"])
+        self.assertTrue(User.objects.filter(username="alias").exists())
+        self.assertEqual(self.alias.notes.count(), 3)
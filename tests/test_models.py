@@ -1,3 +1,4 @@
+import time
 from datetime import timedelta
 
 from django.conf import settings
@@ -15,6 +16,11 @@ from uniauth.models import (
     UserProfile,
 )
 
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
 
 class ModelSignalTests(TestCase):
     """
@@ -79,6 +85,56 @@ class ModelSignalTests(TestCase):
                 User.objects.filter(username="tmp-%d-days-ago" % i).exists()
             )
 
+    @override_settings(
+        PASSWORD_RESET_TIMEOUT_DAYS=1,
+        UNIAUTH_TMP_USER_SWEEP_BATCH_SIZE=2,
+        UNIAUTH_TMP_USER_SWEEP_INTERVAL=60,
+        UNIAUTH_TMP_USER_SWEEP_MODE="throttled",
+    )
+    def test_clear_old_tmp_users_signal_throttled(self):
+        """
+        Ensure throttled sweeps delete at most one batch of
+        old temporary users, at most once per interval
+        """
+        User.objects.all().delete()
+        for i in range(5):
+            User.objects.create(username="tmp-old-%d" % i)
+        old_date = timezone.now() - timedelta(days=5)
+        User.objects.update(date_joined=old_date)
+
+        with mock.patch.dict("uniauth.cache._rate_limits", clear=True):
+            User.objects.create(username="first-user")
+            self.assertEqual(
+                User.objects.filter(username__startswith="tmp-").count(), 3
+            )
+            User.objects.create(username="second-user")
+            self.assertEqual(
+                User.objects.filter(username__startswith="tmp-").count(), 3
+            )
+
+            # Once the interval has passed, the next batch is deleted
+            later = time.time() + 61
+            with mock.patch("uniauth.cache.time.time") as mock_time:
+                mock_time.return_value = later
+                User.objects.create(username="third-user")
+        self.assertEqual(
+            User.objects.filter(username__startswith="tmp-").count(), 1
+        )
+
+    @override_settings(UNIAUTH_TMP_USER_SWEEP_MODE="command")
+    def test_clear_old_tmp_users_signal_command(self):
+        """
+        Ensure no users are deleted on creation when the
+        sweep is left to the flush_tmp_users command
+        """
+        User.objects.all().delete()
+        User.objects.create(username="tmp-old")
+        old_date = timezone.now() - timedelta(days=30)
+        User.objects.update(date_joined=old_date)
+        with self.assertNumQueries(2):
+            User.objects.create(username="new-user")
+        self.assertTrue(User.objects.filter(username="tmp-old").exists())
+
 
 class UserProfileModelTests(TestCase):
     """
@@ -141,6 +197,26 @@ class LinkedEmailModelTests(TestCase):
         )
         self.assertEqual(result, linked_email)
 
+    def test_linked_email_normalized_address(self):
+        """
+        Ensure the normalized address is kept in sync on save
+        """
+        user = User.objects.create(username="new-user")
+        linked_email = LinkedEmail.objects.create(
+            profile=user.uniauth_profile, address="John.Doe@Example.com"
+        )
+        self.assertEqual(
+            LinkedEmail.objects.get(pk=linked_email.pk).normalized_address,
+            "john.doe@example.com",
+        )
+        linked_email.address = "JANE@example.COM"
+        linked_email.save(update_fields=["address"])
+        self.assertEqual(
+            LinkedEmail.objects.get(pk=linked_email.pk).normalized_address,
+            "jane@example.com",
+        )
+        self.assertEqual(LinkedEmail.normalize_address(None), None)
+
     def test_linked_email_model_clean(self):
         """
         Ensure the model prevents saving invalid states
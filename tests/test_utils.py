@@ -1,23 +1,45 @@
 from random import randint
 
 from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, IntegrityError
 from django.test import RequestFactory, TestCase, override_settings
 
 from tests.utils import assert_urls_equivalent, pretty_str
+from uniauth.merge import merge_model_instances
+from uniauth.models import (
+    Institution,
+    InstitutionAccount,
+    InstitutionAccountAttributes,
+    LinkedEmail,
+    MergeJob,
+    UserProfile,
+)
 from uniauth.utils import (
     DEFAULT_SETTING_VALUES,
     choose_username,
     decode_pk,
+    delete_in_batches,
     encode_pk,
     flush_old_tmp_users,
+    flush_old_tmp_users_in_batches,
     get_account_username_split,
     get_random_username,
     get_redirect_url,
     get_service_url,
     get_setting,
+    get_settings,
     is_tmp_user,
+    merge_users_in_batches,
+    provision_users_in_batches,
+    save_with_unique_username,
 )
 
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
 
 class ChooseUsernameTests(TestCase):
     """
@@ -52,6 +74,70 @@ class ChooseUsernameTests(TestCase):
                 "Emails vs Usernames: %s" % zip_str
             )
 
+    def test_choose_username_single_query(self):
+        """
+        Ensure the next suffix is found with a single query,
+        ignoring suffixes that are not numerical
+        """
+        User.objects.create(username="repeat@gmail.com")
+        for suffix in ["_002", "_003", "_009", "_abcd", "x_100"]:
+            User.objects.create(username="repeat@gmail.com" + suffix)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                choose_username("repeat@gmail.com"), "repeat@gmail.com_010"
+            )
+        User.objects.create(username="repeat@gmail.com_1000")
+        self.assertEqual(
+            choose_username("repeat@gmail.com"), "repeat@gmail.com_1001"
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(choose_username("new@gmail.com"), "new@gmail.com")
+
+        # The email is used if it is free, even if suffixes are taken
+        User.objects.create(username="gone@gmail.com_002")
+        self.assertEqual(choose_username("gone@gmail.com"), "gone@gmail.com")
+
+        # Special characters in the email are matched literally
+        User.objects.create(username="a.b+c@gmail.com")
+        User.objects.create(username="aXb+c@gmail.com_005")
+        self.assertEqual(
+            choose_username("a.b+c@gmail.com"), "a.b+c@gmail.com_002"
+        )
+
+
+class DeleteInBatchesTests(TestCase):
+    """
+    Tests the delete_in_batches method in utils.py
+    """
+
+    def setUp(self):
+        for i in range(7):
+            User.objects.create(username="tmp-%d" % i)
+        User.objects.create(username="a-real-user")
+
+    def test_delete_in_batches_deletes_all(self):
+        """
+        Ensure all matching objects are deleted in bounded chunks
+        """
+        queryset = User.objects.filter(username__startswith="tmp-")
+        num_deleted = delete_in_batches(queryset, 3)
+        self.assertEqual(num_deleted, 7)
+        self.assertEqual(
+            list(User.objects.values_list("username", flat=True)),
+            ["a-real-user"],
+        )
+
+    def test_delete_in_batches_max_batches(self):
+        """
+        Ensure no more than max_batches chunks are deleted
+        """
+        queryset = User.objects.filter(username__startswith="tmp-")
+        num_deleted = delete_in_batches(queryset, 3, max_batches=2)
+        self.assertEqual(num_deleted, 6)
+        self.assertEqual(queryset.count(), 1)
+        self.assertEqual(delete_in_batches(queryset, 3, max_batches=0), 0)
+        self.assertEqual(queryset.count(), 1)
+
 
 class EncodeDecodePkTests(TestCase):
     """
@@ -131,6 +217,116 @@ class FlushOldTmpUsersTests(TestCase):
         self.assertIn(self.real, remaining_users)
 
 
+class FlushOldTmpUsersInBatchesTests(TestCase):
+    """
+    Tests the flush_old_tmp_users_in_batches method in utils.py
+    """
+
+    def setUp(self):
+        from datetime import timedelta
+
+        from django.utils import timezone
+
+        old_date = timezone.now() - timedelta(days=2)
+        self.real = User.objects.create(
+            username="a-real-user", date_joined=old_date
+        )
+        self.new = User.objects.create(username="tmp-new")
+        self.old = []
+        for i in range(5):
+            user = User.objects.create(
+                username="tmp-old-%d" % i,
+                email="old%d@example.com" % i,
+                date_joined=old_date,
+            )
+            self.old.append(user)
+
+    def test_flush_old_tmp_users_in_batches_correct(self):
+        """
+        Ensure old temporary users and their related rows are
+        deleted in chunks of the requested size
+        """
+        batches = list(flush_old_tmp_users_in_batches(days=1, batch_size=2))
+        expected_batches = [
+            (self.old[1].pk, 2),
+            (self.old[3].pk, 2),
+            (self.old[4].pk, 1),
+        ]
+        self.assertEqual(batches, expected_batches)
+        self.assertEqual(
+            sorted(User.objects.values_list("username", flat=True)),
+            ["a-real-user", "tmp-new"],
+        )
+        self.assertEqual(UserProfile.objects.count(), 2)
+        self.assertFalse(
+            LinkedEmail.objects.filter(address__startswith="old").exists()
+        )
+
+    def test_flush_old_tmp_users_in_batches_resume(self):
+        """
+        Ensure only users after start_pk are deleted
+        """
+        batches = flush_old_tmp_users_in_batches(
+            days=1, batch_size=10, start_pk=self.old[2].pk
+        )
+        self.assertEqual(list(batches), [(self.old[4].pk, 2)])
+        self.assertEqual(
+            User.objects.filter(username__startswith="tmp-old").count(), 3
+        )
+
+    def test_flush_old_tmp_users_in_batches_dry_run(self):
+        """
+        Ensure nothing is deleted during a dry run
+        """
+        batches = flush_old_tmp_users_in_batches(
+            days=1, batch_size=3, dry_run=True
+        )
+        self.assertEqual(
+            list(batches), [(self.old[2].pk, 3), (self.old[4].pk, 2)]
+        )
+        self.assertEqual(User.objects.count(), 7)
+        self.assertEqual(LinkedEmail.objects.count(), 5)
+
+    @mock.patch.dict("uniauth.cache._account_users", clear=True)
+    def test_flush_old_tmp_users_in_batches_related_rows(self):
+        """
+        Ensure the users' accounts, account attributes and merge
+        jobs are deleted with raw queries, using a fixed number
+        of queries, and the accounts' cached users are invalidated
+        """
+        from uniauth.cache import cache_account_user, get_account_user
+
+        inst = Institution.objects.create(
+            name="Test Uni",
+            slug="test-uni",
+            cas_server_url="https://cas.testuni.edu",
+        )
+        for i, user in enumerate(self.old):
+            account = InstitutionAccount.objects.create(
+                profile=user.uniauth_profile, institution=inst, cas_id=str(i)
+            )
+            InstitutionAccountAttributes.objects.create(account=account)
+            MergeJob.objects.create(
+                idempotency_key=str(i),
+                profile=user.uniauth_profile,
+                alias_user_pk=str(self.real.pk),
+            )
+            cache_account_user(inst.pk, str(i), user.pk)
+
+        # 2 to find the users, 2 for the savepoint, 3 raw deletes of
+        # the related rows, 2 to find and delete the accounts, 1 raw
+        # delete of the profiles, and 10 for the collector to delete
+        # the users and their other relations
+        with self.assertNumQueries(20):
+            batches = list(flush_old_tmp_users_in_batches(days=1))
+        self.assertEqual(batches, [(self.old[4].pk, 5)])
+        self.assertEqual(InstitutionAccount.objects.count(), 0)
+        self.assertEqual(InstitutionAccountAttributes.objects.count(), 0)
+        self.assertEqual(MergeJob.objects.count(), 0)
+        self.assertEqual(UserProfile.objects.count(), 2)
+        self.assertEqual(get_account_user(inst.pk, "0"), None)
+
+
 class GetAccountUsernameSplitTests(TestCase):
     """
     Tests the get_account_username_split method in utils.py
@@ -379,6 +575,44 @@ class GetSettingTests(TestCase):
         _run_test("")
 
 
+class GetSettingsTests(TestCase):
+    """
+    Tests the get_settings method in utils.py
+    """
+
+    def test_get_settings_cached(self):
+        """
+        Ensure the settings are only resolved again
+        once one of Uniauth's settings changes
+        """
+        values = get_settings()
+        self.assertIs(get_settings(), values)
+        self.assertEqual(values.UNIAUTH_MAX_LINKED_EMAILS, 20)
+        with self.settings(SOME_OTHER_SETTING=True):
+            self.assertIs(get_settings(), values)
+        with self.settings(UNIAUTH_MAX_LINKED_EMAILS=5):
+            self.assertEqual(get_settings().UNIAUTH_MAX_LINKED_EMAILS, 5)
+            self.assertEqual(get_setting("UNIAUTH_MAX_LINKED_EMAILS"), 5)
+        self.assertEqual(get_settings().UNIAUTH_MAX_LINKED_EMAILS, 20)
+
+    def test_get_settings_validated(self):
+        """
+        Ensure invalid configurations are rejected
+        """
+        invalid_settings = [
+            {
+                "UNIAUTH_LOGIN_DISPLAY_STANDARD": False,
+                "UNIAUTH_LOGIN_DISPLAY_CAS": False,
+            },
+            {"UNIAUTH_TMP_USER_SWEEP_MODE": "sometimes"},
+            {"UNIAUTH_MERGE_MAX_WORKERS": 0},
+        ]
+        for values in invalid_settings:
+            with self.settings(**values):
+                self.assertRaises(ImproperlyConfigured, get_settings)
+        get_settings()
+
+
 class IsTmpUserTests(TestCase):
     """
     Tests the is_tmp_user method in utils.py
@@ -444,3 +678,328 @@ class IsTmpUserTests(TestCase):
         with self.settings(UNIAUTH_ALLOW_STANDALONE_ACCOUNTS=False):
             for user in users:
                 self.assertFalse(is_tmp_user(user))
+
+
+class MergeUsersInBatchesTests(TestCase):
+    """
+    Tests the merge_users_in_batches method in utils.py
+    """
+
+    def setUp(self):
+        self.inst = Institution.objects.create(
+            name="Test Uni",
+            slug="test-uni",
+            cas_server_url="https://cas.testuni.edu",
+        )
+        self.primary1 = User.objects.create(username="primary1")
+        self.primary2 = User.objects.create(username="primary2")
+        for username in ["cas-test-uni-id1", "cas-test-uni-id2", "other"]:
+            user = User.objects.create(username=username)
+            LinkedEmail.objects.create(
+                profile=user.uniauth_profile, address=username + "@a.com"
+            )
+
+    def test_merge_users_in_batches_correct(self):
+        """
+        Ensure users are merged in chunks, with failures reported
+        and already merged pairs skipped
+        """
+        pairs = [
+            (1, "primary1", "cas-test-uni-id1"),
+            (2, "primary2", "cas-test-uni-id2"),
+            (3, "dne", "other"),
+            (4, "primary1", "cas-test-uni-id1"),
+            (5, "primary1", "primary1"),
+        ]
+        batches = list(merge_users_in_batches(pairs, batch_size=2))
+        self.assertEqual(
+            [x[:3] for x in batches], [(2, 2, 0), (4, 0, 1), (5, 0, 0)]
+        )
+        self.assertEqual([x[0] for x in batches[1][3]], [3])
+        self.assertEqual([x[0] for x in batches[2][3]], [5])
+        self.assertEqual(
+            sorted(User.objects.values_list("username", flat=True)),
+            ["other", "primary1", "primary2"],
+        )
+
+        # Ensure the institution accounts were linked as well
+        accounts = InstitutionAccount.objects.order_by("cas_id")
+        self.assertEqual(
+            [(x.profile.user, x.cas_id) for x in accounts],
+            [(self.primary1, "id1"), (self.primary2, "id2")],
+        )
+        self.assertEqual(
+            list(
+                self.primary1.uniauth_profile.linked_emails.values_list(
+                    "address", flat=True
+                )
+            ),
+            ["cas-test-uni-id1@a.com"],
+        )
+
+    def test_merge_users_in_batches_database_error(self):
+        """
+        Ensure a database error while merging a pair only rolls
+        back that pair, and the rest of the chunk is committed
+        """
+        pairs = [
+            (1, "primary1", "cas-test-uni-id1"),
+            (2, "primary2", "cas-test-uni-id2"),
+            (3, "primary2", "other"),
+        ]
+
+        def failing_merge(primary_object, alias_objects, *args, **kwargs):
+            merge_model_instances(
+                primary_object, alias_objects, *args, **kwargs
+            )
+            if getattr(alias_objects[0], "username", None) == (
+                "cas-test-uni-id2"
+            ):
+                raise DatabaseError("Simulated failure")
+
+        with mock.patch(
+            "uniauth.merge.merge_model_instances", side_effect=failing_merge
+        ):
+            batches = list(merge_users_in_batches(pairs))
+        self.assertEqual(batches[0][1:3], (2, 0))
+        self.assertEqual(batches[0][3], [(2, "Simulated failure")])
+        self.assertEqual(
+            sorted(User.objects.values_list("username", flat=True)),
+            ["cas-test-uni-id2", "primary1", "primary2"],
+        )
+        self.assertEqual(
+            list(InstitutionAccount.objects.values_list("cas_id", flat=True)),
+            ["id1"],
+        )
+
+    def test_merge_users_in_batches_unexpected_error(self):
+        """
+        Ensure unexpected errors are raised instead of being
+        reported as failed pairs
+        """
+        pairs = [(1, "primary1", "cas-test-uni-id1")]
+        with mock.patch(
+            "uniauth.merge.merge_model_instances", side_effect=TypeError
+        ):
+            with self.assertRaises(TypeError):
+                list(merge_users_in_batches(pairs))
+        self.assertTrue(
+            User.objects.filter(username="cas-test-uni-id1").exists()
+        )
+
+
+class ProvisionUsersInBatchesTests(TestCase):
+    """
+    Tests the provision_users_in_batches method in utils.py
+    """
+
+    def setUp(self):
+        self.inst = Institution.objects.create(
+            name="Test Uni",
+            slug="test-uni",
+            cas_server_url="https://cas.testuni.edu",
+        )
+        self.existing = User.objects.create(
+            username="existing", email="existing@example.com"
+        )
+
+    def test_provision_users_in_batches_correct(self):
+        """
+        Ensure users are created with their profiles, linked
+        emails and accounts, and conflicting records are skipped
+        """
+        records = [
+            (
+                1,
+                {
+                    "email": "John@example.com",
+                    "password": "pass",
+                    "first_name": "John",
+                    "linked_emails": ["john@other.com"],
+                    "institution_accounts": [("test-uni", "jd1")],
+                },
+            ),
+            (2, {"username": "mary", "email": "mary@example.com"}),
+            (3, {"username": "existing"}),
+            (4, {"username": "john2", "email": "John@example.com"}),
+            (5, {"username": "a", "institution_accounts": [("dne", "a")]}),
+            (
+                6,
+                {
+                    "username": "b",
+                    "institution_accounts": [("test-uni", "jd1")],
+                },
+            ),
+            (7, {"username": "c", "dne": "field"}),
+        ]
+        batches = list(provision_users_in_batches(records, batch_size=3))
+        self.assertEqual([x[:2] for x in batches], [(3, 2), (6, 0), (7, 0)])
+        self.assertEqual(
+            sorted(x[0] for batch in batches for x in batch[2]),
+            [3, 4, 5, 6, 7],
+        )
+
+        john = User.objects.get(username="John@example.com")
+        self.assertEqual(john.first_name, "John")
+        self.assertTrue(john.check_password("pass"))
+        self.assertFalse(
+            User.objects.get(username="mary").has_usable_password()
+        )
+        self.assertEqual(
+            sorted(
+                john.uniauth_profile.linked_emails.values_list(
+                    "address", "normalized_address", "is_verified"
+                )
+            ),
+            [
+                ("John@example.com", "john@example.com", True),
+                ("john@other.com", "john@other.com", True),
+            ],
+        )
+        self.assertEqual(
+            list(
+                john.uniauth_profile.accounts.values_list("cas_id", flat=True)
+            ),
+            ["jd1"],
+        )
+        self.assertEqual(UserProfile.objects.count(), 3)
+
+    @override_settings(UNIAUTH_ALLOW_SHARED_EMAILS=False)
+    def test_provision_users_in_batches_shared_emails(self):
+        """
+        Ensure records with linked emails verified for other users
+        are skipped if shared emails are not allowed
+        """
+        records = [
+            (1, {"username": "a", "linked_emails": ["existing@example.com"]}),
+            (2, {"username": "b", "linked_emails": ["shared@example.com"]}),
+            (3, {"username": "c", "linked_emails": ["shared@example.com"]}),
+        ]
+        batches = list(provision_users_in_batches(records))
+        self.assertEqual(batches[0][1], 1)
+        self.assertEqual([x[0] for x in batches[0][2]], [1, 3])
+
+    @override_settings(UNIAUTH_ALLOW_SHARED_EMAILS=False)
+    def test_provision_users_in_batches_email_case(self):
+        """
+        Ensure emails differing from taken ones only by case are
+        considered taken
+        """
+        records = [
+            (1, {"username": "a", "email": "Existing@Example.com"}),
+            (2, {"username": "b", "linked_emails": ["EXISTING@example.com"]}),
+            (3, {"username": "c", "linked_emails": ["Shared@example.com"]}),
+            (4, {"username": "d", "linked_emails": ["shared@EXAMPLE.com"]}),
+            (5, {"username": "e", "email": "new@example.com"}),
+        ]
+        batches = list(provision_users_in_batches(records))
+        self.assertEqual(batches[0][1], 2)
+        self.assertEqual([x[0] for x in batches[0][2]], [1, 2, 4])
+
+    def test_provision_users_in_batches_long_cas_id(self):
+        """
+        Ensure records with CAS IDs too long to store are skipped,
+        without failing the rest of the chunk
+        """
+        records = [
+            (
+                1,
+                {
+                    "username": "a",
+                    "institution_accounts": [("test-uni", "a" * 31)],
+                },
+            ),
+            (
+                2,
+                {"username": "b", "institution_accounts": [("test-uni", "b")]},
+            ),
+        ]
+        batches = list(provision_users_in_batches(records))
+        self.assertEqual(batches[0][1], 1)
+        self.assertEqual([x[0] for x in batches[0][2]], [1])
+        self.assertFalse(User.objects.filter(username="a").exists())
+
+    def test_provision_users_in_batches_invalid_records(self):
+        """
+        Ensure records with fields of the wrong type or invalid
+        email addresses are skipped and reported, without failing
+        the rest of the chunk
+        """
+        records = [
+            (1, {"username": "a", "linked_emails": "a@example.com"}),
+            (2, {"username": 2}),
+            (3, {"username": "c", "email": ["c@example.com"]}),
+            (4, {"username": "d", "linked_emails": [None, 4]}),
+            (5, {"username": "e", "email": "not-an-email"}),
+            (6, {"username": "f", "linked_emails": ["f@"]}),
+            (7, {"username": "g", "institution_accounts": "test-uni:g"}),
+            (8, {"username": "h", "institution_accounts": [["test-uni"]]}),
+            (9, {"username": "i", "institution_accounts": [["test-uni", 9]]}),
+            (10, ["j"]),
+            (
+                11,
+                {
+                    "username": "k",
+                    "email": " k@example.com ",
+                    "linked_emails": [None, "", "k2@example.com"],
+                },
+            ),
+        ]
+        batches = list(provision_users_in_batches(records))
+        self.assertEqual(batches[0][1], 1)
+        self.assertEqual(
+            [x[0] for x in batches[0][2]], [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+        )
+        self.assertEqual(
+            batches[0][2][0], (1, "Linked emails must be a list.")
+        )
+        self.assertEqual(
+            batches[0][2][4],
+            (5, "'not-an-email' is not a valid email address."),
+        )
+        self.assertEqual(
+            sorted(User.objects.values_list("username", flat=True)),
+            ["existing", "k"],
+        )
+        self.assertEqual(
+            sorted(
+                LinkedEmail.objects.filter(
+                    profile__user__username="k"
+                ).values_list("address", flat=True)
+            ),
+            ["k2@example.com", "k@example.com"],
+        )
+
+
+class SaveWithUniqueUsernameTests(TestCase):
+    """
+    Tests the save_with_unique_username method in utils.py
+    """
+
+    def test_save_with_unique_username_retries(self):
+        """
+        Ensure a new username is chosen if the first one
+        is taken before the user is saved
+        """
+        User.objects.create(username="taken@example.com")
+        user = User.objects.create(username="tmp-user")
+        with mock.patch(
+            "uniauth.utils.choose_username",
+            side_effect=["taken@example.com", "taken@example.com_002"],
+        ) as mock_choose_username:
+            save_with_unique_username(user, "taken@example.com")
+        self.assertEqual(mock_choose_username.call_count, 2)
+        user.refresh_from_db()
+        self.assertEqual(user.username, "taken@example.com_002")
+
+        other = User.objects.create(username="tmp-other")
+        with mock.patch(
+            "uniauth.utils.choose_username", return_value="taken@example.com"
+        ):
+            self.assertRaises(
+                IntegrityError,
+                save_with_unique_username,
+                other,
+                "taken@example.com",
+                max_attempts=2,
+            )
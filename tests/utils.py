@@ -1,4 +1,5 @@
 import json
+import threading
 from contextlib import contextmanager
 
 try:
@@ -6,6 +7,28 @@ try:
 except ImportError:
     from urllib.parse import parse_qs, urlparse
 
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+CAS_SUCCESS_RESPONSE = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+  <cas:authenticationSuccess>
+    <cas:user>%s</cas:user>
+    <cas:attributes>
+      <cas:mail>%s@example.com</cas:mail>
+    </cas:attributes>
+  </cas:authenticationSuccess>
+</cas:serviceResponse>"""
+
+CAS_FAILURE_RESPONSE = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+  <cas:authenticationFailure code="INVALID_TICKET">
+    Ticket %s not recognized
+  </cas:authenticationFailure>
+</cas:serviceResponse>"""
+
 
 def assert_urls_equivalent(actual, expected, assert_equal_fn):
     """
@@ -26,3 +49,76 @@ def pretty_str(list_or_dict):
     that looks good when printed to the console
     """
     return json.dumps(list_or_dict, indent=2)
+
+
+class _StubCASHandler(BaseHTTPRequestHandler):
+    """
+    Answers serviceValidate requests for the StubCASServer
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.num_connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.num_requests += 1
+            fail = self.server.num_failures > 0
+            if fail:
+                self.server.num_failures -= 1
+        if fail:
+            self._respond(self.server.failure_status, "Unavailable")
+            return
+        ticket = parse_qs(urlparse(self.path).query).get("ticket", [""])[0]
+        if ticket.startswith("ST-"):
+            username = ticket[3:]
+            self._respond(200, CAS_SUCCESS_RESPONSE % (username, username))
+        else:
+            self._respond(200, CAS_FAILURE_RESPONSE % ticket)
+
+    def _respond(self, status, body):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubCASServer(ThreadingMixIn, HTTPServer):
+    """
+    Minimal CAS server running in a background thread, which
+    validates any ticket of the form "ST-<username>".
+
+    The server answers the next num_failures requests with the
+    failure_status status (503 by default), and counts the requests
+    and connections made.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _StubCASHandler)
+        self.lock = threading.Lock()
+        self.num_connections = 0
+        self.num_requests = 0
+        self.num_failures = 0
+        self.failure_status = 503
+        self.url = "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -6,3 +6,5 @@ admin.site.register(models.UserProfile)
 admin.site.register(models.LinkedEmail)
 admin.site.register(models.Institution)
 admin.site.register(models.InstitutionAccount)
+admin.site.register(models.InstitutionAccountAttributes)
+admin.site.register(models.MergeJob)
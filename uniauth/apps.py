@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class UniauthConfig(AppConfig):
     default_auto_field = "django.db.models.AutoField"
     name = "uniauth"
+
+    def ready(self):
+        """
+        Validates Uniauth's settings once the app is loaded, so
+        misconfigurations are reported on startup.
+        """
+        from uniauth.utils import get_settings
+
+        get_settings()
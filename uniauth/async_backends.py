@@ -0,0 +1,234 @@
+"""
+Asynchronous CAS authentication, used by the views in async_views.py.
+
+Tickets are verified with httpx, which must be installed, so waiting
+on a slow CAS server does not tie up a worker thread. Like the
+synchronous sessions in cas_client.py, the httpx clients are pooled
+per institution (and per event loop), and use the UNIAUTH_CAS_*
+settings for their pool size, timeouts and retries.
+"""
+
+import asyncio
+import inspect
+import logging
+import weakref
+from timeit import default_timer
+from urllib.parse import urljoin
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import load_backend
+from django.contrib.auth.signals import user_login_failed
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from uniauth.backends import CASBackend
+from uniauth.cache import (
+    cache_validated_ticket,
+    get_institution,
+    get_ticket_session_id,
+    get_validated_ticket,
+)
+from uniauth.cas_client import RETRY_STATUSES, get_cas_client
+from uniauth.health import (
+    CASServerUnavailable,
+    check_circuit,
+    record_verification,
+)
+from uniauth.models import Institution
+from uniauth.utils import get_setting
+
+try:
+    import httpx
+except ImportError:
+    raise ImproperlyConfigured(
+        "The asynchronous CAS views require httpx to be installed."
+    )
+
+logger = logging.getLogger(__name__)
+
+# Maps each event loop to its clients, keyed by institution
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client(institution):
+    """
+    Returns the pooled httpx client used to talk to the provided
+    institution's CAS server from the running event loop, creating
+    it if necessary.
+    """
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    key = (institution.slug, institution.cas_server_url)
+    client = clients.get(key)
+    if client is None:
+        pool_size = get_setting("UNIAUTH_CAS_POOL_SIZE")
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                get_setting("UNIAUTH_CAS_READ_TIMEOUT"),
+                connect=get_setting("UNIAUTH_CAS_CONNECT_TIMEOUT"),
+            ),
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+            ),
+            # The transport only retries failed connection attempts
+            transport=httpx.AsyncHTTPTransport(
+                retries=get_setting("UNIAUTH_CAS_MAX_RETRIES")
+            ),
+        )
+        clients[key] = client
+    return client
+
+
+async def averify_ticket(institution, service_url, ticket):
+    """
+    Verifies the provided ticket with the institution's CAS server
+    without blocking, and returns the (username, attributes, pgtiou)
+    tuple CASClient.verify_ticket would.
+
+    Raises an httpx.HTTPError if the server could not be reached,
+    timed out, or responded with an error status.
+    """
+    http_client = get_async_http_client(institution)
+    cas_client = get_cas_client(institution, service_url)
+    url = urljoin(cas_client.server_url, cas_client.url_suffix)
+    params = {"ticket": ticket, "service": service_url}
+    max_retries = get_setting("UNIAUTH_CAS_MAX_RETRIES")
+    backoff = get_setting("UNIAUTH_CAS_RETRY_BACKOFF")
+    for attempt in range(max_retries + 1):
+        response = await http_client.get(url, params=params)
+        if response.status_code not in RETRY_STATUSES:
+            break
+        if attempt < max_retries:
+            await asyncio.sleep(backoff * (2**attempt))
+    response.raise_for_status()
+    return cas_client.verify_response(response.content)
+
+
+class AsyncCASBackend(CASBackend):
+    """
+    CASBackend which can also verify tickets asynchronously,
+    via its aauthenticate method. Use it in place of CASBackend
+    in the AUTHENTICATION_BACKENDS setting with the async views.
+    """
+
+    async def aauthenticate(self, request, institution, ticket, service):
+        # Resolve institution slugs through the institution cache
+        if not isinstance(institution, Institution):
+            try:
+                institution = await sync_to_async(get_institution)(institution)
+            except Institution.DoesNotExist:
+                return None
+
+        # Reuse the result of validating the ticket moments ago, if any
+        session_id = await sync_to_async(get_ticket_session_id)(request)
+        validated = await sync_to_async(get_validated_ticket)(
+            institution, ticket, service, session_id
+        )
+        if validated is not None:
+            username, attributes = validated
+            return await sync_to_async(self._get_user)(
+                request, institution, username, attributes
+            )
+
+        # Attempt to verify the ticket with the institution's CAS
+        # server, unless its circuit is open because it is failing.
+        # Every attempt must record its outcome, even if it raises,
+        # or a half-open circuit would wait on its probe forever.
+        probing = await sync_to_async(check_circuit)(institution)
+        succeeded = False
+        start_time = default_timer()
+        try:
+            username, attributes, pgtiou = await averify_ticket(
+                institution, service, ticket
+            )
+            succeeded = True
+        except httpx.HTTPError:
+            logger.warning(
+                "Could not verify ticket with the CAS server for '%s'",
+                institution.slug,
+                exc_info=True,
+            )
+            # A failed probe opens the circuit again
+            if probing:
+                raise CASServerUnavailable(institution)
+            return None
+        finally:
+            await sync_to_async(record_verification)(
+                institution, succeeded, default_timer() - start_time
+            )
+        if username:
+            await sync_to_async(cache_validated_ticket)(
+                institution, ticket, service, session_id, username, attributes
+            )
+
+        return await sync_to_async(self._get_user)(
+            request, institution, username, attributes
+        )
+
+
+async def aauthenticate(request, institution, ticket, service):
+    """
+    Authenticates the CAS ticket with each backend in the
+    AUTHENTICATION_BACKENDS setting, like Django's authenticate,
+    and returns the first user returned, or None if there is no
+    such user (in which case user_login_failed is sent).
+
+    On Django 5 and later, this defers to Django's aauthenticate.
+    Otherwise, AsyncCASBackends verify the ticket asynchronously,
+    while other backends are run in a thread.
+    """
+    credentials = {
+        "institution": institution,
+        "ticket": ticket,
+        "service": service,
+    }
+    if django.VERSION >= (5,):
+        return await auth.aauthenticate(request, **credentials)
+
+    for backend_path in settings.AUTHENTICATION_BACKENDS:
+        backend = load_backend(backend_path)
+        try:
+            inspect.signature(backend.authenticate).bind(
+                request, **credentials
+            )
+        except TypeError:
+            # This backend doesn't accept these credentials
+            continue
+        try:
+            if isinstance(backend, AsyncCASBackend):
+                user = await backend.aauthenticate(request, **credentials)
+            else:
+                user = await sync_to_async(backend.authenticate)(
+                    request, **credentials
+                )
+        except PermissionDenied:
+            # This backend says to stop in our tracks
+            break
+        if user is not None:
+            user.backend = backend_path
+            return user
+
+    # The credentials supplied are invalid to all backends
+    await sync_to_async(user_login_failed.send)(
+        sender=auth.__name__,
+        credentials=auth._clean_credentials(credentials),
+        request=request,
+    )
+    return None
+
+
+@receiver(setting_changed)
+def clear_async_http_clients(setting=None, **kwargs):
+    """
+    Discards all pooled httpx clients, so they are created again
+    on next use. Called whenever a CAS setting changes.
+
+    The clients can only be closed from their own event loop, so
+    they are left to be closed when garbage collected instead.
+    """
+    if setting is None or setting.startswith("UNIAUTH_CAS_"):
+        _clients.clear()
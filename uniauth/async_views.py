@@ -0,0 +1,77 @@
+"""
+Asynchronous variants of the views that verify CAS tickets.
+
+These verify tickets without blocking a worker thread, which keeps
+slow CAS servers from starving other requests when served over ASGI.
+The rest of each view runs in a thread, as the synchronous view does.
+They require httpx to be installed, and verify tickets with the
+AsyncCASBackend, which should be listed in the AUTHENTICATION_BACKENDS
+setting in place of CASBackend. The URL confs use them when the
+UNIAUTH_USE_ASYNC_CAS_VIEWS setting is True.
+"""
+
+from asgiref.sync import sync_to_async
+
+from uniauth.async_backends import aauthenticate
+from uniauth.health import CASServerUnavailable
+from uniauth.views import (
+    _begin_cas_login,
+    _begin_link_from_profile,
+    _cas_unavailable,
+    _finish_cas_login,
+    _finish_link_from_profile,
+)
+
+
+async def cas_login(request, institution):
+    """
+    Asynchronous variant of views.cas_login.
+    """
+    institution, next_url, service_url, response = await sync_to_async(
+        _begin_cas_login
+    )(request, institution)
+    if response is not None:
+        return response
+
+    # A ticket was provided, so attempt to authenticate with it
+    try:
+        user = await aauthenticate(
+            request,
+            institution=institution,
+            ticket=request.GET["ticket"],
+            service=service_url,
+        )
+    except CASServerUnavailable:
+        return await sync_to_async(_cas_unavailable)(
+            request, institution, next_url
+        )
+    return await sync_to_async(_finish_cas_login)(
+        request, institution, next_url, user
+    )
+
+
+async def link_from_profile(request, institution):
+    """
+    Asynchronous variant of views.link_from_profile.
+    """
+    institution, next_url, service_url, response = await sync_to_async(
+        _begin_link_from_profile
+    )(request, institution)
+    if response is not None:
+        return response
+
+    # A ticket was provided, so attempt to authenticate with it
+    try:
+        user = await aauthenticate(
+            request,
+            institution=institution,
+            ticket=request.GET["ticket"],
+            service=service_url,
+        )
+    except CASServerUnavailable:
+        return await sync_to_async(_cas_unavailable)(
+            request, institution, next_url
+        )
+    return await sync_to_async(_finish_link_from_profile)(
+        request, next_url, user
+    )
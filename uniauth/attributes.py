@@ -0,0 +1,187 @@
+"""
+Stores the attributes CAS servers return when verifying a ticket.
+
+Only the attributes named by UNIAUTH_CAS_ATTRIBUTES are kept, up to
+UNIAUTH_CAS_ATTRIBUTES_MAX_SIZE bytes. Depending on
+UNIAUTH_CAS_ATTRIBUTES_STORE, they are kept in the session itself,
+or in the cache named by UNIAUTH_CACHE_ALIAS with only their key in
+the session, so large attributes do not weigh down every request.
+Use get_cas_attributes to read them, which loads them lazily.
+
+If UNIAUTH_PERSIST_CAS_ATTRIBUTES is True, the latest attributes of
+each linked InstitutionAccount are also saved to the database, so
+they outlive the session. Use get_users_cas_attributes to load them
+for many users at once.
+"""
+
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from uniauth.cache import _get_shared_cache
+from uniauth.models import InstitutionAccount, InstitutionAccountAttributes
+from uniauth.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Session keys under which the attributes, or their cache key, are stored
+SESSION_ATTRIBUTES_KEY = "attributes"
+SESSION_ATTRIBUTES_CACHE_KEY = "attributes-key"
+
+
+def _get_size(value):
+    """
+    Returns the size of the provided value once serialized.
+    """
+    return len(json.dumps(value, separators=(",", ":")))
+
+
+def filter_cas_attributes(attributes):
+    """
+    Returns the provided CAS attributes, without those not named
+    by UNIAUTH_CAS_ATTRIBUTES (if set), and without the largest
+    ones if they would exceed UNIAUTH_CAS_ATTRIBUTES_MAX_SIZE.
+    """
+    names = get_setting("UNIAUTH_CAS_ATTRIBUTES")
+    if names is not None:
+        attributes = dict((k, v) for k, v in attributes.items() if k in names)
+    max_size = get_setting("UNIAUTH_CAS_ATTRIBUTES_MAX_SIZE")
+    if max_size is None or _get_size(attributes) <= max_size:
+        return attributes
+
+    # Keep the smallest attributes that fit, dropping the rest
+    kept = {}
+    size = 2
+    sizes = sorted((_get_size({k: v}) - 1, k) for k, v in attributes.items())
+    for attribute_size, name in sizes:
+        if size + attribute_size > max_size:
+            logger.warning(
+                "Dropped the CAS attribute '%s', which does not fit in "
+                "UNIAUTH_CAS_ATTRIBUTES_MAX_SIZE",
+                name,
+            )
+            continue
+        kept[name] = attributes[name]
+        size += attribute_size
+    return kept
+
+
+def store_cas_attributes(request, attributes):
+    """
+    Filters the provided CAS attributes, and stores them for the
+    provided request's session.
+    """
+    attributes = filter_cas_attributes(attributes)
+    request.session.pop(SESSION_ATTRIBUTES_KEY, None)
+    previous_key = request.session.pop(SESSION_ATTRIBUTES_CACHE_KEY, None)
+    shared_cache = _get_shared_cache()
+    if previous_key is not None and shared_cache is not None:
+        shared_cache.delete(previous_key)
+    request._cas_attributes = attributes
+    if not attributes:
+        return
+    if get_setting("UNIAUTH_CAS_ATTRIBUTES_STORE") == "cache":
+        key = "uniauth:cas-attributes:%s" % get_random_string(32)
+        shared_cache.set(key, attributes, settings.SESSION_COOKIE_AGE)
+        request.session[SESSION_ATTRIBUTES_CACHE_KEY] = key
+    else:
+        request.session[SESSION_ATTRIBUTES_KEY] = attributes
+
+
+def get_cas_attributes(request):
+    """
+    Returns the attributes returned by the CAS server the current
+    session was authenticated with, or an empty dict if there are
+    none. The attributes are loaded once per request, when first
+    accessed.
+    """
+    attributes = getattr(request, "_cas_attributes", None)
+    if attributes is None:
+        attributes = request.session.get(SESSION_ATTRIBUTES_KEY)
+        key = request.session.get(SESSION_ATTRIBUTES_CACHE_KEY)
+        shared_cache = _get_shared_cache()
+        if attributes is None and key is not None and shared_cache:
+            attributes = shared_cache.get(key)
+        attributes = attributes or {}
+        request._cas_attributes = attributes
+    return attributes
+
+
+def persist_cas_attributes(institution, cas_id, attributes):
+    """
+    Saves the provided CAS attributes for the InstitutionAccount
+    with the CAS ID at the institution, if persisting attributes is
+    enabled and the account exists. The attributes are only written
+    if they differ from the stored ones, as compared by their hash.
+
+    Returns whether the stored attributes were changed.
+    """
+    if not get_setting("UNIAUTH_PERSIST_CAS_ATTRIBUTES"):
+        return False
+    attributes = filter_cas_attributes(attributes or {})
+    data = json.dumps(attributes, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    # Load the account along with the hash of its stored attributes
+    row = (
+        InstitutionAccount.objects.filter(
+            institution=institution, cas_id=cas_id
+        )
+        .values_list("pk", "cas_attributes__attributes_hash")
+        .first()
+    )
+    if row is None:
+        return False
+    account_id, stored_digest = row
+    if stored_digest == digest or (stored_digest is None and not attributes):
+        return False
+
+    values = {
+        "attributes": data,
+        "attributes_hash": digest,
+        "updated": timezone.now(),
+    }
+    queryset = InstitutionAccountAttributes.objects.filter(
+        account_id=account_id
+    )
+    if stored_digest is None:
+        try:
+            with transaction.atomic():
+                InstitutionAccountAttributes.objects.create(
+                    account_id=account_id, **values
+                )
+            return True
+        except IntegrityError:
+            # Another request stored the attributes first
+            pass
+    queryset.update(**values)
+    return True
+
+
+def get_users_cas_attributes(users, institution=None):
+    """
+    Returns the persisted CAS attributes of the provided users (or
+    user primary keys, or queryset of users) in a single query, as
+    a dict mapping each user's primary key to a dict of attributes
+    by institution slug. Users without any persisted attributes
+    are omitted.
+
+    If an institution is provided, only attributes for accounts
+    at that institution are returned.
+    """
+    queryset = InstitutionAccountAttributes.objects.filter(
+        account__profile__user__in=users
+    )
+    if institution is not None:
+        queryset = queryset.filter(account__institution=institution)
+    result = {}
+    for user_id, slug, data in queryset.values_list(
+        "account__profile__user_id", "account__institution__slug", "attributes"
+    ):
+        result.setdefault(user_id, {})[slug] = json.loads(data)
+    return result
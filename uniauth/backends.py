@@ -1,10 +1,37 @@
-from cas import CASClient
+import logging
+from timeit import default_timer
+
+import requests
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
-from django.db.models import Q
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Case, IntegerField, Q, When
+
+from uniauth.attributes import persist_cas_attributes, store_cas_attributes
+from uniauth.cache import (
+    cache_account_user,
+    cache_validated_ticket,
+    get_account_user,
+    get_institution,
+    get_ticket_session_id,
+    get_validated_ticket,
+)
+from uniauth.cas_client import get_cas_client
+from uniauth.health import (
+    CASServerUnavailable,
+    check_circuit,
+    record_verification,
+)
+from uniauth.models import (
+    Institution,
+    InstitutionAccount,
+    LinkedEmail,
+    UserProfile,
+)
+from uniauth.signals import password_check_completed
+from uniauth.utils import get_setting
 
-from uniauth.models import InstitutionAccount, UserProfile
-from uniauth.utils import is_tmp_user
+logger = logging.getLogger(__name__)
 
 
 class CASBackend(ModelBackend):
@@ -14,35 +41,98 @@ class CASBackend(ModelBackend):
     returns either the authenticated Uniauth user (if
     one already exists), or a newly created user with
     a temporary username otherwise.
+
+    The institution may be provided as an Institution
+    instance, or as the slug of one. Raises CASServerUnavailable
+    if the circuit for the institution's CAS server is open, or
+    if the probe of its half-open circuit fails.
     """
 
     def authenticate(self, request, institution, ticket, service):
-        user_model = get_user_model()
+        # Resolve institution slugs through the institution cache
+        if not isinstance(institution, Institution):
+            try:
+                institution = get_institution(institution)
+            except Institution.DoesNotExist:
+                return None
 
-        # Attempt to verify the ticket with the institution's CAS server
-        client = CASClient(
-            version=2,
-            service_url=service,
-            server_url=institution.cas_server_url,
+        # If the ticket was just validated (such as when the browser
+        # retries the callback), reuse the result, as the CAS server
+        # would reject the already used ticket
+        session_id = get_ticket_session_id(request)
+        validated = get_validated_ticket(
+            institution, ticket, service, session_id
         )
-        username, attributes, pgtiou = client.verify_ticket(ticket)
+        if validated is not None:
+            username, attributes = validated
+            return self._get_user(request, institution, username, attributes)
+
+        # Attempt to verify the ticket with the institution's CAS
+        # server, unless its circuit is open because it is failing.
+        # Every attempt must record its outcome, even if it raises,
+        # or a half-open circuit would wait on its probe forever.
+        probing = check_circuit(institution)
+        succeeded = False
+        start_time = default_timer()
+        try:
+            client = get_cas_client(institution, service)
+            username, attributes, pgtiou = client.verify_ticket(ticket)
+            succeeded = True
+        except requests.RequestException:
+            logger.warning(
+                "Could not verify ticket with the CAS server for '%s'",
+                institution.slug,
+                exc_info=True,
+            )
+            # A failed probe opens the circuit again
+            if probing:
+                raise CASServerUnavailable(institution)
+            return None
+        finally:
+            record_verification(
+                institution, succeeded, default_timer() - start_time
+            )
+        if username:
+            cache_validated_ticket(
+                institution, ticket, service, session_id, username, attributes
+            )
+
+        return self._get_user(request, institution, username, attributes)
 
-        # Add the attributes returned by the CAS server to the session
+    def _get_user(self, request, institution, username, attributes):
+        """
+        Returns the user for the provided CAS username of the
+        institution, or None if the ticket failed to verify.
+        """
+        user_model = get_user_model()
+
+        # Store the attributes returned by the CAS server for the session
         if request and attributes:
-            request.session["attributes"] = attributes
+            store_cas_attributes(request, attributes)
 
         # If no username was returned, verification failed
         if not username:
             return None
 
-        # Attempt to find a user possessing an account
-        # with that username for the institution
-        try:
-            user = InstitutionAccount.objects.get(
-                cas_id=username, institution=institution
-            ).profile.user
-        except InstitutionAccount.DoesNotExist:
-            user = None
+        # Attempt to find a user possessing an account with that
+        # username for the institution, first by the cached user
+        user = None
+        user_id = get_account_user(institution.pk, username)
+        if user_id is not None:
+            user = user_model._default_manager.filter(pk=user_id).first()
+        if user is None:
+            account = (
+                InstitutionAccount.objects.select_related("profile__user")
+                .filter(cas_id=username, institution=institution)
+                .first()
+            )
+            if account is not None:
+                user = account.profile.user
+                cache_account_user(institution.pk, username, user.pk)
+
+        # Keep the attributes of linked accounts up to date
+        if user is not None:
+            persist_cas_attributes(institution, username, attributes)
 
         # If such a user does not exist, get or create
         # one with a deterministic, CAS username
@@ -61,24 +151,81 @@ class LinkedEmailBackend(ModelBackend):
     with any email address linked to the account, along
     with their password.
 
+    At most UNIAUTH_MAX_LOGIN_CANDIDATES matching users have
+    their password checked per attempt, with users whose
+    primary email matches checked before the others.
+
     Note: 'username' is still supported as an argument for
     authenticate to facilitate easier swapping of this
     backend with the UsernameOrLinkedEmailBackend, and
     other authentication schemes using a username argument.
     """
 
+    def _get_user_fields(self, user_model):
+        """
+        Returns the names of the User fields loaded for candidate
+        users: those needed to check their password, and to log
+        them in afterwards without further queries
+        """
+        field_names = [
+            user_model._meta.pk.name,
+            "password",
+            user_model.USERNAME_FIELD,
+        ]
+        for field_name in ("username", "is_active"):
+            try:
+                user_model._meta.get_field(field_name)
+                field_names.append(field_name)
+            except FieldDoesNotExist:
+                pass
+        return field_names
+
+    def _get_priority_cases(self, user_model, email):
+        """
+        Returns the When clauses used to order candidate users,
+        giving users whose primary email matches priority 1.
+        Users matching none of the clauses have priority 2.
+        """
+        email_field = user_model.get_email_field_name()
+        try:
+            user_model._meta.get_field(email_field)
+        except FieldDoesNotExist:
+            return []
+        return [When(**{email_field + "__iexact": email, "then": 1})]
+
+    def _order_users(self, user_model, queryset, email):
+        """
+        Returns the provided queryset of candidate users in the
+        order their passwords should be checked
+        """
+        cases = self._get_priority_cases(user_model, email)
+        if not cases:
+            return queryset.order_by("pk")
+        priority = Case(*cases, default=2, output_field=IntegerField())
+        return queryset.annotate(uniauth_priority=priority).order_by(
+            "uniauth_priority", "pk"
+        )
+
     def _get_users(self, user_model, email):
         """
-        Query for users with a verified linked email
-        address matching the provided email value
+        Query for distinct users with a verified linked
+        email address matching the provided email value
         """
-        return user_model._default_manager.filter(
-            uniauth_profile__linked_emails__address__iexact=email,
-            uniauth_profile__linked_emails__is_verified=True,
-        ).all()
+        queryset = (
+            user_model._default_manager.filter(
+                uniauth_profile__linked_emails__normalized_address=(
+                    LinkedEmail.normalize_address(email)
+                ),
+                uniauth_profile__linked_emails__is_verified=True,
+            )
+            .distinct()
+            .only(*self._get_user_fields(user_model))
+        )
+        return self._order_users(user_model, queryset, email)
 
     def authenticate(self, request, email=None, password=None, **kwargs):
         user_model = get_user_model()
+        start_time = default_timer()
 
         # If email field was not provided, check for
         # alternative names, or for a "username" field
@@ -92,20 +239,37 @@ class LinkedEmailBackend(ModelBackend):
                 if email is None:
                     email = kwargs.get(user_model.USERNAME_FIELD)
 
-        # Get the user(s) who own the provided email address
+        # Get the user(s) who own the provided email address,
+        # up to the maximum number of candidates per attempt
         users = self._get_users(user_model, email)
+        max_candidates = get_setting("UNIAUTH_MAX_LOGIN_CANDIDATES")
+        if max_candidates > 0:
+            users = users[:max_candidates]
+        users = list(users)
 
         # If there were no matching users, run the password
         # hasher once, to guard against timing attacks
+        matched_user = None
+        num_checked = 0
         if not users:
             user_model().set_password(password)
-            return None
 
         # Otherwise, check the password for each matched user
         for user in users:
+            num_checked += 1
             if user.check_password(password):
-                return user
-        return None
+                matched_user = user
+                break
+
+        password_check_completed.send(
+            sender=self.__class__,
+            request=request,
+            num_candidates=len(users),
+            num_checked=num_checked,
+            duration=default_timer() - start_time,
+            succeeded=matched_user is not None,
+        )
+        return matched_user
 
 
 class UsernameOrLinkedEmailBackend(LinkedEmailBackend):
@@ -113,19 +277,50 @@ class UsernameOrLinkedEmailBackend(LinkedEmailBackend):
     Authenticaton backend allowing users to authenticate
     with their username, or any email address linked to
     the account, along with their password.
+
+    Users whose username matches are checked first, followed
+    by users whose primary email matches, then the others.
     """
 
+    def _get_priority_cases(self, user_model, username):
+        """
+        Returns the When clauses used to order candidate users,
+        giving users whose username matches priority 0.
+        """
+        username_field = user_model.USERNAME_FIELD
+        cases = super(UsernameOrLinkedEmailBackend, self)._get_priority_cases(
+            user_model, username
+        )
+        return [When(**{username_field: username, "then": 0})] + cases
+
     def _get_users(self, user_model, username):
         """
-        Query for verified users with a username or linked
-        email address matching the provided username value
+        Query for distinct, non-temporary users with a username
+        or verified linked email address matching the provided
+        username value
         """
         username_field = user_model.USERNAME_FIELD
-        matched_users = user_model._default_manager.filter(
-            (Q(**{username_field: username}))
-            | (
-                Q(uniauth_profile__linked_emails__address__iexact=username)
-                & Q(uniauth_profile__linked_emails__is_verified=True)
+        matched_users = (
+            user_model._default_manager.filter(
+                (Q(**{username_field: username}))
+                | (
+                    Q(
+                        uniauth_profile__linked_emails__normalized_address=(
+                            LinkedEmail.normalize_address(username)
+                        )
+                    )
+                    & Q(uniauth_profile__linked_emails__is_verified=True)
+                )
             )
-        ).all()
-        return filter(lambda x: not is_tmp_user(x), matched_users)
+            .distinct()
+            .only(*self._get_user_fields(user_model))
+        )
+
+        # Exclude temporary users (see utils.is_tmp_user)
+        if "username" in self._get_user_fields(user_model):
+            matched_users = matched_users.exclude(username__startswith="tmp-")
+            if not get_setting("UNIAUTH_ALLOW_STANDALONE_ACCOUNTS"):
+                matched_users = matched_users.exclude(
+                    username__startswith="cas-"
+                )
+        return self._order_users(user_model, matched_users, username)
@@ -0,0 +1,381 @@
+"""
+Process-local caches for data Uniauth reads on nearly every request.
+
+Entries are invalidated by model signals (see models.py). If the
+UNIAUTH_CACHE_ALIAS setting names one of the project's CACHES, that
+cache is also used to propagate invalidations to other processes.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import get_script_prefix, get_urlconf, reverse
+from django.urls.exceptions import NoReverseMatch
+from django.utils.crypto import constant_time_compare, get_random_string
+
+from uniauth.utils import get_setting
+
+# Key under which the current institution registry version is
+# stored in the shared cache, if one is configured
+INSTITUTIONS_VERSION_KEY = "uniauth:institutions:version"
+
+_institutions_lock = threading.Lock()
+_institutions = {"version": None, "generation": 0, "registry": None}
+
+_rate_limits_lock = threading.Lock()
+_rate_limits = {}
+
+# Maximum number of account users each process caches
+ACCOUNT_USER_CACHE_SIZE = 10000
+
+# Users of recently resolved InstitutionAccounts, least recently used first
+_account_users_lock = threading.Lock()
+_account_users = OrderedDict()
+
+# Session key under which the id binding validated tickets
+# to the session that validated them is stored
+SESSION_TICKET_ID_KEY = "cas-ticket-session-id"
+
+# Recently validated CAS tickets, in the order they expire
+_validated_tickets_lock = threading.Lock()
+_validated_tickets = OrderedDict()
+
+
+def _get_shared_cache():
+    """
+    Returns the cache specified by UNIAUTH_CACHE_ALIAS,
+    or None if cross-process invalidation is disabled.
+    """
+    alias = get_setting("UNIAUTH_CACHE_ALIAS")
+    return caches[alias] if alias else None
+
+
+def _get_reversed_url_or_none(view_name, slug):
+    """
+    Returns the reverse lookup URL of the provided view with
+    the provided slug argument. Returns None if the view is
+    not accessible under the current configuration.
+    """
+    try:
+        return reverse("uniauth:%s" % view_name, args=[slug])
+    except NoReverseMatch:
+        return None
+
+
+def _get_institution_registry():
+    """
+    Returns the cached institution registry, loading it from
+    the database first if it is empty, has been invalidated
+    by another process, or is older than the number of
+    seconds in UNIAUTH_INSTITUTION_CACHE_TIMEOUT.
+
+    The registry is a dict containing a tuple of all
+    Institutions, the same Institutions indexed by slug,
+    and a dict of computed link tuples (see below).
+    """
+    from uniauth.models import Institution
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        version = shared_cache.get(INSTITUTIONS_VERSION_KEY)
+        if version != _institutions["version"]:
+            with _institutions_lock:
+                _institutions["registry"] = None
+                _institutions["generation"] += 1
+                _institutions["version"] = version
+
+    registry = _institutions["registry"]
+    if registry is not None and registry["expires"] is not None:
+        if registry["expires"] <= time.time():
+            registry = None
+
+    if registry is None:
+        generation = _institutions["generation"]
+        institutions = tuple(Institution.objects.all())
+        timeout = get_setting("UNIAUTH_INSTITUTION_CACHE_TIMEOUT")
+        registry = {
+            "objects": institutions,
+            "by_slug": dict((x.slug, x) for x in institutions),
+            "links": {},
+            "expires": None if timeout is None else time.time() + timeout,
+        }
+        # Only cache the registry if it was not invalidated while loading
+        with _institutions_lock:
+            if _institutions["generation"] == generation:
+                _institutions["registry"] = registry
+    return registry
+
+
+def acquire_rate_limit(name, interval):
+    """
+    Returns whether the action with the provided name may run
+    now, given it should run at most once every interval seconds.
+
+    The limit is enforced per process, and across processes
+    as well if UNIAUTH_CACHE_ALIAS is set.
+    """
+    now = time.time()
+    with _rate_limits_lock:
+        if _rate_limits.get(name, 0) > now:
+            return False
+        _rate_limits[name] = now + interval
+    shared_cache = _get_shared_cache()
+    if shared_cache is None:
+        return True
+    return shared_cache.add("uniauth:rate-limit:%s" % name, now, interval)
+
+
+def _get_account_user_key(institution_id, cas_id):
+    """
+    Returns the key under which the user of the InstitutionAccount
+    with the provided institution and CAS ID is cached. The CAS ID
+    is hashed, as it may contain characters not allowed in keys.
+    """
+    digest = hashlib.sha256(cas_id.encode("utf-8")).hexdigest()
+    return "uniauth:account-user:%d:%s" % (institution_id, digest)
+
+
+def cache_account_user(institution_id, cas_id, user_id):
+    """
+    Caches the primary key of the user of the InstitutionAccount
+    with the provided institution and CAS ID, for
+    UNIAUTH_ACCOUNT_CACHE_TIMEOUT seconds.
+
+    If UNIAUTH_CACHE_ALIAS is set, the user is cached in that cache
+    only, so that invalidations are seen by every process at once.
+    """
+    timeout = get_setting("UNIAUTH_ACCOUNT_CACHE_TIMEOUT")
+    if timeout == 0:
+        return
+    key = _get_account_user_key(institution_id, cas_id)
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(key, user_id, timeout)
+        return
+    expires = None if timeout is None else time.time() + timeout
+    with _account_users_lock:
+        _account_users.pop(key, None)
+        _account_users[key] = (expires, user_id)
+        if len(_account_users) > ACCOUNT_USER_CACHE_SIZE:
+            _account_users.popitem(last=False)
+
+
+def get_account_user(institution_id, cas_id):
+    """
+    Returns the primary key of the cached user of the
+    InstitutionAccount with the provided institution and CAS
+    ID, or None if it is not cached.
+    """
+    if get_setting("UNIAUTH_ACCOUNT_CACHE_TIMEOUT") == 0:
+        return None
+    key = _get_account_user_key(institution_id, cas_id)
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        return shared_cache.get(key)
+    with _account_users_lock:
+        entry = _account_users.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= time.time():
+            del _account_users[key]
+            return None
+        # Mark the entry as the most recently used
+        _account_users[key] = _account_users.pop(key)
+        return entry[1]
+
+
+def invalidate_account_user(institution_id, cas_id):
+    """
+    Removes the cached user of the InstitutionAccount with the
+    provided institution and CAS ID, from this process and from
+    the shared cache, if UNIAUTH_CACHE_ALIAS is set.
+    """
+    invalidate_account_users([(institution_id, cas_id)])
+
+
+def invalidate_account_users(accounts):
+    """
+    Removes the cached users of the InstitutionAccounts with the
+    provided (institution ID, CAS ID) pairs at once, from this
+    process and from the shared cache, if UNIAUTH_CACHE_ALIAS is set.
+    """
+    keys = [_get_account_user_key(*x) for x in accounts]
+    if not keys:
+        return
+    with _account_users_lock:
+        for key in keys:
+            _account_users.pop(key, None)
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.delete_many(keys)
+
+
+def _get_validated_ticket_key(institution, ticket, service):
+    """
+    Returns the key under which the result of validating the
+    provided ticket is cached. The ticket is hashed, so it is
+    not stored in the shared cache in the clear.
+    """
+    value = "\n".join((institution.slug, ticket, service))
+    digest = hashlib.sha256(value.encode("utf-8")).hexdigest()
+    return "uniauth:validated-ticket:%s" % digest
+
+
+def get_ticket_session_id(request):
+    """
+    Returns the id binding the tickets validated for the provided
+    request to its session, creating it if necessary. Returns None
+    if the request has no session, or validated tickets are not
+    cached.
+
+    The id is stored in the session's data rather than being its
+    key, since the session key changes when the user logs in.
+    """
+    session = getattr(request, "session", None)
+    if session is None or not get_setting("UNIAUTH_CAS_TICKET_CACHE_TIMEOUT"):
+        return None
+    session_id = session.get(SESSION_TICKET_ID_KEY)
+    if session_id is None:
+        session_id = get_random_string(32)
+        session[SESSION_TICKET_ID_KEY] = session_id
+    return session_id
+
+
+def cache_validated_ticket(
+    institution, ticket, service, session_id, username, attributes
+):
+    """
+    Caches the CAS username and attributes the provided ticket was
+    validated for, for UNIAUTH_CAS_TICKET_CACHE_TIMEOUT seconds.
+
+    Tickets can only be validated once, so this allows a duplicate
+    callback with the same ticket (such as one retried by the
+    browser) to be resolved again, but only from the session that
+    validated it, as identified by session_id (see
+    get_ticket_session_id). Nothing is cached if session_id is
+    None. The result is cached across processes as well if
+    UNIAUTH_CACHE_ALIAS is set.
+    """
+    timeout = get_setting("UNIAUTH_CAS_TICKET_CACHE_TIMEOUT")
+    if not timeout or session_id is None:
+        return
+    key = _get_validated_ticket_key(institution, ticket, service)
+    now = time.time()
+    with _validated_tickets_lock:
+        # Discard the entries that have expired, which are first
+        while _validated_tickets:
+            oldest = next(iter(_validated_tickets))
+            if _validated_tickets[oldest][0] > now:
+                break
+            del _validated_tickets[oldest]
+        _validated_tickets.pop(key, None)
+        _validated_tickets[key] = (
+            now + timeout,
+            session_id,
+            username,
+            attributes,
+        )
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(key, (session_id, username, attributes), timeout)
+
+
+def get_validated_ticket(institution, ticket, service, session_id):
+    """
+    Returns a (username, attributes) tuple for the provided ticket
+    if it was validated for the session identified by session_id
+    within the last UNIAUTH_CAS_TICKET_CACHE_TIMEOUT seconds, or
+    None otherwise. Tickets validated for other sessions are never
+    returned, so a replayed ticket can not be used to log in.
+    """
+    if session_id is None or not get_setting(
+        "UNIAUTH_CAS_TICKET_CACHE_TIMEOUT"
+    ):
+        return None
+    key = _get_validated_ticket_key(institution, ticket, service)
+    entry = _validated_tickets.get(key)
+    if entry is not None and entry[0] > time.time():
+        entry = entry[1:]
+    else:
+        shared_cache = _get_shared_cache()
+        entry = shared_cache.get(key) if shared_cache is not None else None
+    if entry is None or not constant_time_compare(entry[0], session_id):
+        return None
+    return entry[1], entry[2]
+
+
+def clear_institution_cache(broadcast=True):
+    """
+    Empties the institution registry for this process.
+
+    If broadcast is True and UNIAUTH_CACHE_ALIAS is set, the
+    registries of all other processes are invalidated as well.
+    """
+    with _institutions_lock:
+        _institutions["registry"] = None
+        _institutions["generation"] += 1
+        if broadcast:
+            shared_cache = _get_shared_cache()
+            if shared_cache is not None:
+                version = get_random_string(12)
+                shared_cache.set(INSTITUTIONS_VERSION_KEY, version, None)
+                _institutions["version"] = version
+
+
+def get_institution(slug):
+    """
+    Returns the Institution with the provided slug, using the
+    cached institution registry.
+
+    Raises Institution.DoesNotExist if there is no such
+    institution. Unknown slugs are answered from the registry
+    as well, so repeated requests for them do not query the
+    database. The returned instance should be treated as
+    read-only, as it is shared with other requests.
+    """
+    from uniauth.models import Institution
+
+    institution = _get_institution_registry()["by_slug"].get(slug)
+    if institution is None:
+        raise Institution.DoesNotExist(
+            "No institution with slug '%s' exists." % slug
+        )
+    return institution
+
+
+def get_institutions():
+    """
+    Returns a list of all Institutions, loading them
+    from the database only if they are not cached.
+    """
+    return list(_get_institution_registry()["objects"])
+
+
+def get_institution_links():
+    """
+    Returns a list of Institution tuples, with each containing:
+    (name, slug, CAS login url, Profile link URL)
+
+    URLs are computed once per URLconf and script prefix, and
+    are None if the view is not accessible under that URLconf.
+    """
+    registry = _get_institution_registry()
+    urlconf = get_urlconf() or settings.ROOT_URLCONF
+    links_key = (urlconf, get_script_prefix())
+    links = registry["links"].get(links_key)
+    if links is None:
+        links = tuple(
+            (
+                x.name,
+                x.slug,
+                _get_reversed_url_or_none("cas-login", x.slug),
+                _get_reversed_url_or_none("link-from-profile", x.slug),
+            )
+            for x in registry["objects"]
+        )
+        registry["links"][links_key] = links
+    return list(links)
@@ -0,0 +1,131 @@
+"""
+Creates the clients used to talk to institutions' CAS servers.
+
+Each institution's CAS server is given a pooled HTTP session, which
+is shared by all requests and threads in the process, so ticket
+verifications reuse kept-alive connections instead of performing a
+new TLS handshake each time. The pool size, timeouts and retries are
+set by the UNIAUTH_CAS_* settings.
+"""
+
+import threading
+
+import requests
+from cas import CASClient
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from uniauth.utils import get_setting
+
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+
+# Statuses for which verification is retried. Gateway errors (502 and
+# 504) are not retried, as the CAS server behind the gateway may have
+# already validated (and so consumed) the ticket.
+RETRY_STATUSES = (503,)
+
+_sessions_lock = threading.Lock()
+_sessions = {}
+
+
+class CASSession(requests.Session):
+    """
+    Session applying the configured timeouts to every request,
+    and never storing cookies, as it is shared between users.
+
+    Raises an HTTPError for error responses, which the CAS client
+    would otherwise attempt to parse as a validation response.
+    """
+
+    def __init__(self, timeout):
+        super(CASSession, self).__init__()
+        self.timeout = timeout
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        response = super(CASSession, self).request(*args, **kwargs)
+        response.raise_for_status()
+        return response
+
+
+def _create_session():
+    """
+    Returns a new CASSession configured by the UNIAUTH_CAS_* settings.
+
+    Only connection failures and 503 responses are retried: tickets
+    may only be validated once, so a request the server may have
+    processed (such as one that timed out reading, or one a gateway
+    answered with a 502 or 504 status) is never retried. Logins
+    through a briefly unreachable gateway fail rather than risk
+    validating the ticket twice.
+    """
+    retries = Retry(
+        total=get_setting("UNIAUTH_CAS_MAX_RETRIES"),
+        read=0,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=get_setting("UNIAUTH_CAS_RETRY_BACKOFF"),
+        raise_on_status=False,
+    )
+    pool_size = get_setting("UNIAUTH_CAS_POOL_SIZE")
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, max_retries=retries
+    )
+    session = CASSession(
+        timeout=(
+            get_setting("UNIAUTH_CAS_CONNECT_TIMEOUT"),
+            get_setting("UNIAUTH_CAS_READ_TIMEOUT"),
+        )
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_cas_session(institution):
+    """
+    Returns the pooled session used to talk to the provided
+    institution's CAS server, creating it if necessary.
+    """
+    key = (institution.slug, institution.cas_server_url)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _create_session()
+                _sessions[key] = session
+    return session
+
+
+def get_cas_client(institution, service_url):
+    """
+    Returns a CAS client for the provided institution and service
+    URL, which uses the institution's pooled session.
+    """
+    return CASClient(
+        version=2,
+        service_url=service_url,
+        server_url=institution.cas_server_url,
+        session=get_cas_session(institution),
+    )
+
+
+@receiver(setting_changed)
+def clear_cas_sessions(setting=None, **kwargs):
+    """
+    Closes and discards all pooled sessions, so they are created
+    again on next use. Called whenever a CAS setting changes.
+    """
+    if setting is not None and not setting.startswith("UNIAUTH_CAS_"):
+        return
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
@@ -161,7 +161,9 @@ def _prevent_shared_email_and_password(linked_emails, new_password):
         users = (
             get_user_model()
             .objects.filter(
-                uniauth_profile__linked_emails__address__iexact=linked_email,
+                uniauth_profile__linked_emails__normalized_address=(
+                    LinkedEmail.normalize_address(linked_email)
+                ),
                 uniauth_profile__linked_emails__is_verified=True,
                 is_active=True,
             )
@@ -240,7 +242,9 @@ class PasswordResetForm(AuthPasswordResetForm):
         primary email.
         """
         users = get_user_model().objects.filter(
-            uniauth_profile__linked_emails__address__iexact=email,
+            uniauth_profile__linked_emails__normalized_address=(
+                LinkedEmail.normalize_address(email)
+            ),
             uniauth_profile__linked_emails__is_verified=True,
             is_active=True,
         )
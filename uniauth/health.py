@@ -0,0 +1,271 @@
+"""
+Tracks the health of each institution's CAS server, and acts as a
+circuit breaker around ticket verification.
+
+Each process records the outcome and latency of its recent ticket
+verifications per institution. Once enough of them fail (as set by
+the UNIAUTH_CAS_BREAKER_* settings), the institution's circuit is
+opened, and verifications fail fast with CASServerUnavailable rather
+than waiting on the server to time out. After the cooldown, a single
+verification is let through to probe the server: the circuit closes
+if it succeeds, and is opened again otherwise.
+
+If UNIAUTH_CACHE_ALIAS is set, opened circuits are shared with other
+processes, and each process periodically adds its request counts,
+latencies and rejected verifications to per-minute totals, which the
+cas_health command reports. Totals are also published as soon as a
+circuit opens or closes.
+"""
+
+import threading
+import time
+from collections import deque, namedtuple
+
+from uniauth.cache import _get_shared_cache
+from uniauth.utils import get_setting
+
+# Number of recent verifications the failure rate is computed over
+HEALTH_WINDOW_SIZE = 50
+
+# Minimum seconds between each process publishing its totals
+HEALTH_PUBLISH_INTERVAL = 10
+
+# How many seconds published per-minute totals are kept
+HEALTH_RETENTION = 3600
+
+# Totals of the verifications made with an institution's CAS server,
+# and of those rejected without contacting it as its circuit was open
+CASServerStats = namedtuple(
+    "CASServerStats", ["requests", "failures", "latency", "rejections"]
+)
+
+_health_lock = threading.Lock()
+_health = {}
+
+
+class CASServerUnavailable(Exception):
+    """
+    Raised when verifying a ticket with an institution's CAS
+    server is not attempted, as its circuit is open.
+    """
+
+    def __init__(self, institution):
+        self.institution = institution
+        super(CASServerUnavailable, self).__init__(
+            "The CAS server for '%s' is unavailable." % institution.slug
+        )
+
+
+def _get_circuit_key(institution):
+    return "uniauth:cas-circuit:%s" % institution.slug
+
+
+def _get_stats_key(institution, minute):
+    return "uniauth:cas-health:%s:%d" % (institution.slug, minute)
+
+
+def _get_health(institution):
+    """
+    Returns the health dict of the provided institution for this
+    process, creating it if necessary. Must be called with
+    _health_lock held.
+    """
+    health = _health.get(institution.slug)
+    if health is None:
+        health = {
+            "outcomes": deque(maxlen=HEALTH_WINDOW_SIZE),
+            "open_until": None,
+            "probing": False,
+            "unpublished": [0, 0, 0.0, 0],
+            "publish_at": time.time() + HEALTH_PUBLISH_INTERVAL,
+        }
+        _health[institution.slug] = health
+    return health
+
+
+def _open_circuit(health, now):
+    """
+    Opens the circuit of the provided health dict for the
+    cooldown. Must be called with _health_lock held.
+    """
+    health["open_until"] = now + get_setting("UNIAUTH_CAS_BREAKER_COOLDOWN")
+    health["probing"] = False
+
+
+def _take_unpublished(health, now, force=False):
+    """
+    Returns the unpublished CASServerStats of the provided health
+    dict, and resets them, if they are due to be published (or if
+    force is True). Returns None otherwise. Must be called with
+    _health_lock held.
+    """
+    if not force and now < health["publish_at"]:
+        return None
+    stats = CASServerStats(*health["unpublished"])
+    health["unpublished"] = [0, 0, 0.0, 0]
+    health["publish_at"] = now + HEALTH_PUBLISH_INTERVAL
+    return stats
+
+
+def check_circuit(institution):
+    """
+    Raises CASServerUnavailable if the circuit for the provided
+    institution's CAS server is open, and tickets should not be
+    verified with it. Otherwise, the caller must verify the ticket
+    and call record_verification with the outcome.
+
+    If the cooldown of an open circuit has passed, the circuit is
+    half-open: one caller is let through to probe the server, while
+    the others fail fast until it records its outcome. Returns
+    whether the caller is that probe.
+    """
+    if get_setting("UNIAUTH_CAS_BREAKER_FAILURE_RATE") is None:
+        return False
+    now = time.time()
+    with _health_lock:
+        health = _get_health(institution)
+        rejected = health["open_until"] is not None
+        if rejected and not health["probing"]:
+            if now >= health["open_until"]:
+                health["probing"] = True
+                return True
+
+    # Also fail fast if another process opened the circuit
+    shared_cache = _get_shared_cache()
+    if not rejected and shared_cache is not None:
+        open_until = shared_cache.get(_get_circuit_key(institution))
+        rejected = open_until is not None and now < open_until
+    if not rejected:
+        return False
+
+    with _health_lock:
+        health = _get_health(institution)
+        health["unpublished"][3] += 1
+        unpublished = _take_unpublished(health, now)
+    if shared_cache is not None and unpublished is not None:
+        _publish_stats(shared_cache, institution, unpublished, now)
+    raise CASServerUnavailable(institution)
+
+
+def record_verification(institution, succeeded, latency):
+    """
+    Records the outcome of verifying a ticket with the provided
+    institution's CAS server, which took latency seconds, and
+    opens or closes its circuit accordingly.
+
+    Verification succeeds if the server responded, whether or
+    not it accepted the ticket.
+    """
+    failure_rate = get_setting("UNIAUTH_CAS_BREAKER_FAILURE_RATE")
+    now = time.time()
+    opened = closed = False
+    with _health_lock:
+        health = _get_health(institution)
+        outcomes = health["outcomes"]
+        if health["probing"]:
+            # The probe decides whether the circuit closes again
+            if succeeded:
+                health["open_until"] = None
+                health["probing"] = False
+                outcomes.clear()
+                closed = True
+            else:
+                _open_circuit(health, now)
+                opened = True
+        outcomes.append(succeeded)
+
+        # Open the circuit if too many recent verifications failed
+        if failure_rate is not None and health["open_until"] is None:
+            failures = outcomes.count(False)
+            min_requests = get_setting("UNIAUTH_CAS_BREAKER_MIN_REQUESTS")
+            if len(
+                outcomes
+            ) >= min_requests and failures >= failure_rate * len(outcomes):
+                _open_circuit(health, now)
+                opened = True
+
+        stats = health["unpublished"]
+        stats[0] += 1
+        stats[1] += 0 if succeeded else 1
+        stats[2] += latency
+        # Publish right away when the circuit changes state, so the
+        # totals reflect the failures that opened it
+        unpublished = _take_unpublished(health, now, force=opened or closed)
+        open_until = health["open_until"]
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is None:
+        return
+    circuit_key = _get_circuit_key(institution)
+    if opened:
+        timeout = max(int(open_until - now), 1)
+        shared_cache.set(circuit_key, open_until, timeout)
+    elif closed:
+        shared_cache.delete(circuit_key)
+    if unpublished is not None:
+        _publish_stats(shared_cache, institution, unpublished, now)
+
+
+def _publish_stats(shared_cache, institution, stats, now):
+    """
+    Adds the provided stats to the institution's totals for the
+    current minute, in the shared cache.
+    """
+    key = _get_stats_key(institution, int(now // 60))
+    for field, value in (
+        ("requests", stats.requests),
+        ("failures", stats.failures),
+        ("latency", int(stats.latency * 1000)),
+        ("rejections", stats.rejections),
+    ):
+        field_key = "%s:%s" % (key, field)
+        shared_cache.add(field_key, 0, HEALTH_RETENTION)
+        try:
+            shared_cache.incr(field_key, value)
+        except ValueError:
+            # The key expired since it was added
+            shared_cache.set(field_key, value, HEALTH_RETENTION)
+
+
+def get_circuit_open_until(institution):
+    """
+    Returns the time until which the circuit of the provided
+    institution's CAS server is open, as shared by any process,
+    or None if it is closed.
+    """
+    open_until = None
+    with _health_lock:
+        health = _health.get(institution.slug)
+        if health is not None:
+            open_until = health["open_until"]
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_open_until = shared_cache.get(_get_circuit_key(institution))
+        if shared_open_until is not None:
+            open_until = max(open_until or 0, shared_open_until)
+    if open_until is not None and open_until <= time.time():
+        return None
+    return open_until
+
+
+def get_published_stats(institution, minutes):
+    """
+    Returns the CASServerStats published by all processes for the
+    provided institution over the last few minutes, with latency in
+    seconds. Returns None if UNIAUTH_CACHE_ALIAS is not set.
+    """
+    shared_cache = _get_shared_cache()
+    if shared_cache is None:
+        return None
+    current_minute = int(time.time() // 60)
+    keys = []
+    for minute in range(current_minute - minutes + 1, current_minute + 1):
+        key = _get_stats_key(institution, minute)
+        keys.extend("%s:%s" % (key, x) for x in CASServerStats._fields)
+    values = shared_cache.get_many(keys)
+    num_fields = len(CASServerStats._fields)
+    totals = [0] * num_fields
+    for i, key in enumerate(keys):
+        totals[i % num_fields] += values.get(key, 0)
+    stats = CASServerStats(*totals)
+    return stats._replace(latency=stats.latency / 1000.0)
@@ -0,0 +1,178 @@
+"""
+Runs the merges performed when linking accounts as background jobs.
+
+If the UNIAUTH_DEFER_MERGES setting is True, the link views record
+the institution account link immediately, and schedule the merge of
+the unlinked user with schedule_merge() instead of performing it
+during the request. Each merge is tracked by a MergeJob, whose
+idempotency key ensures retried requests do not merge twice.
+
+Jobs run in a process-wide thread pool by default. To run them with
+a task queue instead, set UNIAUTH_MERGE_EXECUTOR to the dotted path
+of a callable that accepts a MergeJob pk, and arranges for
+run_merge_job() to be called with it.
+
+Jobs that failed, or were left pending or running by a process that
+died, can be run again with the retry_merge_jobs command.
+"""
+
+import logging
+import threading
+
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+from uniauth.merge import merge_model_instances
+from uniauth.models import MergeJob
+from uniauth.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Error recorded on failed jobs, whose details are logged instead
+MERGE_FAILED_ERROR = "The merge could not be completed."
+
+_thread_pool_lock = threading.Lock()
+_thread_pool = {"executor": None}
+
+
+def _get_thread_pool():
+    """
+    Returns the thread pool used to run merge jobs when no
+    UNIAUTH_MERGE_EXECUTOR is set, creating it if necessary.
+    """
+    with _thread_pool_lock:
+        if _thread_pool["executor"] is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            _thread_pool["executor"] = ThreadPoolExecutor(
+                max_workers=get_setting("UNIAUTH_MERGE_MAX_WORKERS")
+            )
+        return _thread_pool["executor"]
+
+
+def _run_in_thread(job_pk):
+    """
+    Runs the merge job with the provided pk from a pool thread,
+    closing the thread's database connections afterwards.
+    """
+    try:
+        run_merge_job(job_pk)
+    except Exception:
+        logger.exception("Could not run merge job %s", job_pk)
+    finally:
+        connections.close_all()
+
+
+def _submit(job_pk):
+    """
+    Hands the merge job with the provided pk to the executor.
+    """
+    executor = get_setting("UNIAUTH_MERGE_EXECUTOR")
+    if executor:
+        import_string(executor)(job_pk)
+    else:
+        _get_thread_pool().submit(_run_in_thread, job_pk)
+
+
+def get_merge_idempotency_key(primary_user, alias_user, key=None):
+    """
+    Returns the idempotency key of the job merging alias_user
+    into primary_user. If a client-provided key is passed, it
+    is used instead of the pks of the users, but is still
+    scoped to primary_user so it can not refer to the jobs of
+    other users.
+    """
+    if key:
+        return "%s:%s" % (primary_user.pk, key)
+    return "%s:%s" % (primary_user.pk, alias_user.pk)
+
+
+def schedule_merge(primary_user, alias_user, idempotency_key=None):
+    """
+    Schedules a background job merging alias_user into
+    primary_user, and returns its MergeJob.
+
+    If a job with the same idempotency key already exists, it
+    is returned instead, and is only run again if it failed.
+    The job is submitted once the current transaction commits.
+    """
+    key = get_merge_idempotency_key(primary_user, alias_user, idempotency_key)
+    with transaction.atomic():
+        job, created = MergeJob.objects.select_for_update().get_or_create(
+            idempotency_key=key,
+            defaults={
+                "profile": primary_user.uniauth_profile,
+                "alias_user_pk": str(alias_user.pk),
+            },
+        )
+        if not created:
+            if job.status != MergeJob.STATUS_FAILED:
+                return job
+            job.status = MergeJob.STATUS_PENDING
+            job.error = ""
+            job.save(update_fields=["status", "error", "updated"])
+    transaction.on_commit(lambda: _submit(job.pk))
+    return job
+
+
+def run_merge_job(job_pk):
+    """
+    Performs the merge described by the MergeJob with the
+    provided pk, and returns the updated job.
+
+    Does nothing if the job is not pending, so it is safe to
+    call more than once for the same job. If the user being
+    merged in no longer exists, the job simply succeeds.
+    """
+    with transaction.atomic():
+        job = MergeJob.objects.select_for_update().get(pk=job_pk)
+        if job.status != MergeJob.STATUS_PENDING:
+            return job
+        job.status = MergeJob.STATUS_RUNNING
+        job.save(update_fields=["status", "updated"])
+
+    user_model = get_user_model()
+    try:
+        with transaction.atomic():
+            primary_user = job.profile.user
+            alias_user = user_model._default_manager.filter(
+                pk=job.alias_user_pk
+            ).first()
+            if alias_user is not None:
+                merge_model_instances(primary_user, [alias_user])
+    except Exception:
+        # The exception may describe the database, so it is only logged
+        logger.exception("Merge job %s failed", job_pk)
+        job.status = MergeJob.STATUS_FAILED
+        job.error = MERGE_FAILED_ERROR
+    else:
+        job.status = MergeJob.STATUS_SUCCEEDED
+    job.save(update_fields=["status", "error", "updated"])
+    return job
+
+
+def retry_merge_job(job_pk, stale_before=None):
+    """
+    Runs the MergeJob with the provided pk again if it failed, or
+    if it is pending or running but was last updated before the
+    stale_before datetime (e.g. because the process running it
+    died), and returns the updated job.
+
+    Does nothing if the job is not eligible to be retried, so it
+    is safe to call for jobs another process is retrying.
+    """
+    with transaction.atomic():
+        job = MergeJob.objects.select_for_update().get(pk=job_pk)
+        stale = (
+            stale_before is not None
+            and job.status
+            in (MergeJob.STATUS_PENDING, MergeJob.STATUS_RUNNING)
+            and job.updated < stale_before
+        )
+        if job.status != MergeJob.STATUS_FAILED and not stale:
+            return job
+        job.status = MergeJob.STATUS_PENDING
+        job.error = ""
+        job.save(update_fields=["status", "error", "updated"])
+    return run_merge_job(job_pk)
@@ -9,6 +9,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.core.validators import URLValidator
 from django.utils.text import slugify
 
+from uniauth.cache import clear_institution_cache
 from uniauth.models import Institution
 
 
@@ -61,3 +62,5 @@ class Command(BaseCommand):
             institution.cas_server_url = cas_server_url
             institution.save()
             self.stdout.write("Updated institution '%s'.\n" % str(institution))
+
+        clear_institution_cache()
@@ -0,0 +1,81 @@
+"""
+This command is used to report the health of each institution's
+CAS server.
+
+For each institution, reports whether its circuit is open (in which
+case logins through it fail fast), along with the number of tickets
+verified over the last --minutes minutes, the percentage of those
+that failed, the average verification latency, and the number of
+logins rejected without contacting the server. Statistics are
+published by each process every few seconds, through the cache named
+by the UNIAUTH_CACHE_ALIAS setting, which must be set.
+
+Execution: python manage.py cas_health
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from uniauth.health import get_circuit_open_until, get_published_stats
+from uniauth.models import Institution
+from uniauth.utils import get_setting
+
+
+class Command(BaseCommand):
+    help = "Reports the health of each institution's CAS server."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--minutes",
+            type=int,
+            default=5,
+            help="Report statistics for this many past minutes.",
+        )
+
+    def handle(self, *args, **options):
+        minutes = options["minutes"]
+        if minutes < 1:
+            raise CommandError("--minutes must be a positive integer.")
+        if not get_setting("UNIAUTH_CACHE_ALIAS"):
+            raise CommandError(
+                "UNIAUTH_CACHE_ALIAS must be set to share CAS server "
+                "health between processes."
+            )
+
+        self.stdout.write(
+            "%-30s %-16s %8s %8s %10s %8s\n"
+            % (
+                "Institution",
+                "Circuit",
+                "Requests",
+                "Errors",
+                "Latency",
+                "Rejected",
+            )
+        )
+        for institution in Institution.objects.order_by("slug"):
+            open_until = get_circuit_open_until(institution)
+            if open_until is None:
+                circuit = "closed"
+            else:
+                circuit = "open (%ds)" % max(open_until - time.time(), 0)
+            stats = get_published_stats(institution, minutes)
+            if stats.requests:
+                error_rate = "%.1f%%" % (
+                    100.0 * stats.failures / stats.requests
+                )
+                latency = "%.0f ms" % (1000 * stats.latency / stats.requests)
+            else:
+                error_rate = latency = "-"
+            self.stdout.write(
+                "%-30s %-16s %8d %8s %10s %8d\n"
+                % (
+                    institution.slug,
+                    circuit,
+                    stats.requests,
+                    error_rate,
+                    latency,
+                    stats.rejections,
+                )
+            )
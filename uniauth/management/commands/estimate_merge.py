@@ -0,0 +1,69 @@
+"""
+This command is used to estimate the work merging users would do.
+
+Reports, for each relation merge_model_instances() would process when
+merging the alias users into the primary user, the number of rows that
+would be moved and the estimated number of queries, followed by the
+number of rows that would be written (and locked) in each table.
+Nothing is written to the database.
+
+Execution: python manage.py estimate_merge <primary> <alias> [<alias> ...]
+"""
+
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from uniauth.merge import estimate_merge
+
+
+class Command(BaseCommand):
+    help = "Estimates the work merging users would do, without merging."
+
+    def add_arguments(self, parser):
+        parser.add_argument("primary", help="Username of the primary user.")
+        parser.add_argument(
+            "aliases", nargs="+", help="Usernames of the users to merge."
+        )
+
+    def _get_user(self, username):
+        user_model = get_user_model()
+        try:
+            return user_model._default_manager.get_by_natural_key(username)
+        except user_model.DoesNotExist:
+            raise CommandError("No user with username '%s' exists." % username)
+
+    def handle(self, *args, **options):
+        primary = self._get_user(options["primary"])
+        aliases = [self._get_user(x) for x in options["aliases"]]
+        if primary in aliases:
+            raise CommandError("The primary user can not also be an alias.")
+
+        estimates = estimate_merge(primary, aliases)
+        locks = OrderedDict()
+        for estimate in estimates:
+            self.stdout.write(
+                "%-12s %-40s %8d rows %6d queries\n"
+                % (
+                    estimate.kind,
+                    estimate.path,
+                    estimate.rows,
+                    estimate.queries,
+                )
+            )
+            if estimate.rows:
+                locks[estimate.model] = (
+                    locks.get(estimate.model, 0) + estimate.rows
+                )
+
+        self.stdout.write(
+            "Total: %d rows, %d queries.\n"
+            % (
+                sum(x.rows for x in estimates),
+                sum(x.queries for x in estimates),
+            )
+        )
+        self.stdout.write("Rows written (locked) per table:\n")
+        for model, rows in locks.items():
+            self.stdout.write("  %s: %d\n" % (model, rows))
@@ -4,12 +4,27 @@ This command is used to flush old temporary accounts from the database.
 Users with a username prefix of "tmp-" more than the specified number of
 days old will be deleted. The default number of days is 1.
 
+If any of the batching options are provided, users are deleted in
+chunks of --batch-size users, each in its own transaction, optionally
+sleeping between chunks. Progress can be saved to --progress-file, so
+an interrupted flush resumes where it left off when run again.
+
 Execution: python manage.py flush_tmp_users [days]
 """
 
+import os
+import time
+
 from django.core.management.base import BaseCommand, CommandError
 
-from uniauth.utils import flush_old_tmp_users, get_input
+from uniauth.utils import (
+    flush_old_tmp_users,
+    flush_old_tmp_users_in_batches,
+    get_input,
+)
+
+# The batch size used if batching options are provided without one
+DEFAULT_BATCH_SIZE = 1000
 
 
 class Command(BaseCommand):
@@ -17,16 +32,119 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("days", type=int, nargs="?", default=1)
+        parser.add_argument(
+            "--noinput",
+            "--no-input",
+            action="store_false",
+            dest="interactive",
+            help="Do not prompt for confirmation before deleting.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Delete at most this many users per transaction.",
+        )
+        parser.add_argument(
+            "--sleep-between-batches",
+            type=float,
+            default=0,
+            help="Seconds to sleep between batches.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Report the users that would be deleted, without "
+            "deleting them.",
+        )
+        parser.add_argument(
+            "--start-pk",
+            default=None,
+            help="Only consider users with a greater primary key.",
+        )
+        parser.add_argument(
+            "--progress-file",
+            default=None,
+            help="File storing the primary key of the last deleted "
+            "user, used to resume an interrupted flush.",
+        )
 
     def handle(self, *args, **options):
         days = options["days"]
-
-        answer = get_input(
-            "Are you sure you want to delete all temporary"
-            + "users more than %d days old?\nAnswer [y/n]:" % days
+        batch_size = options["batch_size"]
+        batched = (
+            batch_size is not None
+            or options["sleep_between_batches"]
+            or options["dry_run"]
+            or options["start_pk"] is not None
+            or options["progress_file"] is not None
         )
-        if answer == "y" or answer == "yes":
+        if batch_size is not None and batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+
+        if options["interactive"] and not options["dry_run"]:
+            answer = get_input(
+                "Are you sure you want to delete all temporary "
+                + "users more than %d days old?\nAnswer [y/n]:" % days
+            )
+            if answer != "y" and answer != "yes":
+                self.stdout.write("Canceled.\n")
+                return
+
+        if not batched:
             num_deleted = flush_old_tmp_users(days=days)
-            self.stdout.write("Deleted %d temporary users.\n")
+            self.stdout.write("Deleted %d temporary users.\n" % num_deleted)
         else:
-            self.stdout.write("Canceled.\n")
+            self._flush_in_batches(
+                days, batch_size or DEFAULT_BATCH_SIZE, options
+            )
+
+    def _flush_in_batches(self, days, batch_size, options):
+        dry_run = options["dry_run"]
+        progress_file = options["progress_file"]
+        sleep_seconds = options["sleep_between_batches"]
+        verb = "Found" if dry_run else "Deleted"
+
+        # Resume from the saved progress, if there is any
+        start_pk = options["start_pk"]
+        if (
+            start_pk is None
+            and progress_file
+            and os.path.exists(progress_file)
+        ):
+            with open(progress_file) as f:
+                start_pk = f.read().strip() or None
+            if start_pk is not None:
+                self.stdout.write("Resuming after pk %s.\n" % start_pk)
+
+        total = 0
+        start_time = time.time()
+        batches = flush_old_tmp_users_in_batches(
+            days=days,
+            batch_size=batch_size,
+            start_pk=start_pk,
+            dry_run=dry_run,
+        )
+        for last_pk, num_users in batches:
+            total += num_users
+            elapsed = time.time() - start_time
+            self.stdout.write(
+                "%s %d temporary users (%d total, up to pk %s, %.1f rows/sec).\n"
+                % (verb, num_users, total, last_pk, total / max(elapsed, 1e-6))
+            )
+            if progress_file and not dry_run:
+                with open(progress_file, "w") as f:
+                    f.write(str(last_pk))
+            if sleep_seconds:
+                time.sleep(sleep_seconds)
+
+        # The flush is complete, so there is nothing left to resume
+        if progress_file and not dry_run and os.path.exists(progress_file):
+            os.remove(progress_file)
+
+        elapsed = time.time() - start_time
+        self.stdout.write(
+            "%s %d temporary users in %.1f seconds (%.1f rows/sec).\n"
+            % (verb, total, elapsed, total / max(elapsed, 1e-6))
+        )
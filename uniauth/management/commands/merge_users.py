@@ -0,0 +1,200 @@
+"""
+This command is used to merge many pairs of users at once, such as
+when consolidating the unlinked "cas-<slug>-<id>" users created before
+an institution was migrated into the accounts they belong to.
+
+Reads (primary, alias) pairs of usernames from a CSV file (with an
+optional "primary,alias" header) or a JSONL file (with "primary" and
+"alias" keys), and merges each alias user into its primary user in
+chunks of --batch-size pairs, each in its own transaction. Institution
+accounts of unlinked alias users are linked to the primary user's
+profile. Progress can be saved to --progress-file, so an interrupted
+run resumes where it left off when run again.
+
+To merge with several processes in parallel, run the command once per
+process with the same --workers count and a different --worker-index
+(and --progress-file). Pairs are split between workers by primary user,
+so no user should be both a primary and an alias in the input file.
+
+Execution: python manage.py merge_users <file>
+"""
+
+import csv
+import io
+import json
+import os
+import time
+import zlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from uniauth.utils import get_input, merge_users_in_batches
+
+
+class Command(BaseCommand):
+    help = "Merges the pairs of users listed in a CSV or JSONL file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("file")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            default=None,
+            help="Format of the file. Inferred from its extension "
+            "if not provided.",
+        )
+        parser.add_argument(
+            "--noinput",
+            "--no-input",
+            action="store_false",
+            dest="interactive",
+            help="Do not prompt for confirmation before merging.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Merge at most this many pairs per transaction.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Total number of processes merging the file.",
+        )
+        parser.add_argument(
+            "--worker-index",
+            type=int,
+            default=0,
+            help="Index of this process, from 0 to --workers - 1.",
+        )
+        parser.add_argument(
+            "--progress-file",
+            default=None,
+            help="File storing the line number of the last merged "
+            "pair, used to resume an interrupted run.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["file"]
+        batch_size = options["batch_size"]
+        workers = options["workers"]
+        worker_index = options["worker_index"]
+        progress_file = options["progress_file"]
+        if not os.path.exists(path):
+            raise CommandError("File '%s' does not exist." % path)
+        if batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+        if workers < 1 or not 0 <= worker_index < workers:
+            raise CommandError(
+                "--worker-index must be between 0 and --workers - 1."
+            )
+        file_format = options["format"]
+        if file_format is None:
+            extension = os.path.splitext(path)[1].lower()
+            file_format = (
+                "jsonl" if extension in (".jsonl", ".json") else "csv"
+            )
+
+        if options["interactive"]:
+            answer = get_input(
+                "Are you sure you want to merge the users listed in "
+                + "'%s'?\nThe alias users will be deleted.\n" % path
+                + "Answer [y/n]:"
+            )
+            if answer != "y" and answer != "yes":
+                self.stdout.write("Canceled.\n")
+                return
+
+        # Resume from the saved progress, if there is any
+        start_line = 0
+        if progress_file and os.path.exists(progress_file):
+            with open(progress_file) as f:
+                start_line = int(f.read().strip() or 0)
+            if start_line:
+                self.stdout.write("Resuming after line %d.\n" % start_line)
+
+        with io.open(path, encoding="utf-8", newline="") as f:
+            pairs = (
+                x
+                for x in self._read_pairs(f, file_format)
+                if x[0] > start_line
+                and self._get_worker(x[1], workers) == worker_index
+            )
+            self._merge(pairs, batch_size, progress_file)
+
+    def _read_pairs(self, f, file_format):
+        """
+        Yields a (line number, primary, alias) tuple for each
+        pair of usernames in the provided file.
+        """
+        if file_format == "csv":
+            reader = csv.reader(f)
+            for row in reader:
+                if not row or row == ["primary", "alias"]:
+                    continue
+                if len(row) != 2:
+                    raise CommandError(
+                        "Line %d does not have 2 columns." % reader.line_num
+                    )
+                yield reader.line_num, row[0].strip(), row[1].strip()
+        else:
+            for line_num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    pair = json.loads(line)
+                    primary, alias = pair["primary"], pair["alias"]
+                except (ValueError, KeyError, TypeError):
+                    raise CommandError(
+                        "Line %d is not an object with 'primary' and "
+                        "'alias' keys." % line_num
+                    )
+                yield line_num, primary, alias
+
+    def _get_worker(self, primary_username, workers):
+        """
+        Returns the index of the worker that merges
+        into the user with the provided username.
+        """
+        return zlib.crc32(primary_username.encode("utf-8")) % workers
+
+    def _merge(self, pairs, batch_size, progress_file):
+        total_merged = 0
+        total_skipped = 0
+        total_failed = 0
+        start_time = time.time()
+        batches = merge_users_in_batches(pairs, batch_size=batch_size)
+        for last_line, num_merged, num_skipped, failures in batches:
+            total_merged += num_merged
+            total_skipped += num_skipped
+            total_failed += len(failures)
+            for line_num, error in failures:
+                self.stderr.write("Line %d: %s\n" % (line_num, error))
+            total = total_merged + total_skipped + total_failed
+            elapsed = time.time() - start_time
+            self.stdout.write(
+                "Merged %d pairs (%d skipped, %d failed, %d total, "
+                "up to line %d, %.1f pairs/sec).\n"
+                % (
+                    num_merged,
+                    num_skipped,
+                    len(failures),
+                    total,
+                    last_line,
+                    total / max(elapsed, 1e-6),
+                )
+            )
+            if progress_file:
+                with open(progress_file, "w") as f:
+                    f.write(str(last_line))
+
+        # The run is complete, so there is nothing left to resume
+        if progress_file and os.path.exists(progress_file):
+            os.remove(progress_file)
+
+        elapsed = time.time() - start_time
+        self.stdout.write(
+            "Merged %d pairs (%d skipped, %d failed) in %.1f seconds.\n"
+            % (total_merged, total_skipped, total_failed, elapsed)
+        )
@@ -2,15 +2,21 @@
 This command is used to migrate a project previously using
 CAS for authentication over to Uniauth.
 
+Users are migrated in chunks of --batch-size users, each in its own
+transaction. Users that already have a UserProfile are not touched,
+so an interrupted migration can be resumed by running it again.
+Users whose username would be too long once prefixed with
+"cas-<slug>-" are reported, and left unmigrated.
+
 Execution: python manage.py migrate_cas <slug>
 """
 
-from django.contrib.auth import get_user_model
+import time
+
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
-from uniauth.models import Institution, InstitutionAccount, UserProfile
-from uniauth.utils import get_input
+from uniauth.models import Institution
+from uniauth.utils import get_input, migrate_cas_users_in_batches
 
 
 class Command(BaseCommand):
@@ -18,41 +24,81 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("slug")
+        parser.add_argument(
+            "--noinput",
+            "--no-input",
+            action="store_false",
+            dest="interactive",
+            help="Do not prompt for confirmation before migrating.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Migrate at most this many users per transaction.",
+        )
 
-    @transaction.atomic
     def handle(self, *args, **options):
         slug = options["slug"]
+        batch_size = options["batch_size"]
 
         try:
             institution = Institution.objects.get(slug=slug)
         except Institution.DoesNotExist:
             raise CommandError("No institution with slug '%s' exists." % slug)
+        if batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
 
-        message = (
-            "This command is intended to migrate projects "
-            "previously using CAS for authentication to using Uniauth.\n\nYou "
-            "should only proceed with this command if your project was "
-            "previously using CAS for authentication, and the usernames for "
-            "all existing Users are equivalent to their CAS ID. This command "
-            "will create UserProfiles for each user with the Institution "
-            "specified by the slug argument.\n\nDo you still wish to "
-            "continue?\n\nAnswer [y/n]: "
+        if options["interactive"]:
+            message = (
+                "This command is intended to migrate projects "
+                "previously using CAS for authentication to using Uniauth.\n\n"
+                "You should only proceed with this command if your project "
+                "was previously using CAS for authentication, and the "
+                "usernames for all existing Users are equivalent to their CAS "
+                "ID. This command will create UserProfiles and "
+                "InstitutionAccounts for each user with the Institution "
+                "specified by the slug argument.\n\nDo you still wish to "
+                "continue?\n\nAnswer [y/n]: "
+            )
+            answer = get_input(message)
+
+            if answer != "y" and answer != "yes":
+                self.stdout.write("\nCanceled.\n")
+                return
+
+        self.stdout.write("\nProceeding...\n")
+        total = 0
+        total_skipped = 0
+        start_time = time.time()
+        batches = migrate_cas_users_in_batches(
+            institution, batch_size=batch_size
+        )
+        for last_pk, num_users, num_accounts, skipped in batches:
+            total += num_users
+            total_skipped += len(skipped)
+            for username in skipped:
+                self.stdout.write(
+                    "Could not migrate user, as the prefixed username "
+                    "would be too long: %s\n" % username
+                )
+            elapsed = time.time() - start_time
+            self.stdout.write(
+                "Migrated %d users, linking %d accounts (%d total, up to "
+                "pk %s, %.1f rows/sec).\n"
+                % (
+                    num_users,
+                    num_accounts,
+                    total,
+                    last_pk,
+                    total / max(elapsed, 1e-6),
+                )
+            )
+        elapsed = time.time() - start_time
+        self.stdout.write(
+            "Done! Migrated %d users in %.1f seconds.\n" % (total, elapsed)
         )
-        answer = get_input(message)
-
-        if answer != "y" and answer != "yes":
-            self.stdout.write("\nCanceled.\n")
-            return
-
-        self.stdout.write("\nProceeding... ")
-        for user in get_user_model().objects.all():
-            # Skip users that already have UserProfiles
-            if hasattr(user, "uniauth_profile"):
-                continue
-            # Update the username to the proper format
-            cas_id = user.username
-            user.username = "cas-%s-%s" % (slug, cas_id)
-            user.save()
-            # Add the profile
-            profile = UserProfile.objects.create(user=user)
-        self.stdout.write("Done!\n")
+        if total_skipped > 0:
+            self.stdout.write(
+                "\n%d users could not be migrated.\n" % total_skipped
+            )
@@ -2,58 +2,121 @@
 This command is used to migrate a project previously using
 custom User authentication over to Uniauth.
 
+Users are migrated in chunks of --batch-size users, each in its own
+transaction. Users that already have a UserProfile are not touched,
+so an interrupted migration can be resumed by running it again. To
+migrate in parallel, run the command in several processes, each with
+a different primary key range given by --min-pk and --max-pk.
+
 Execution: python manage.py migrate_custom
 """
 
-from django.contrib.auth import get_user_model
-from django.core.management.base import BaseCommand
-from django.db import transaction
+import io
+import time
+
+from django.core.management.base import BaseCommand, CommandError
 
-from uniauth.models import LinkedEmail, UserProfile
-from uniauth.utils import get_input
+from uniauth.utils import get_input, migrate_custom_users_in_batches
 
 
 class Command(BaseCommand):
     help = "Migrates a project using custom User auhentication to Uniauth."
 
-    @transaction.atomic
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--noinput",
+            "--no-input",
+            action="store_false",
+            dest="interactive",
+            help="Do not prompt for confirmation before migrating.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Migrate at most this many users per transaction.",
+        )
+        parser.add_argument(
+            "--min-pk",
+            default=None,
+            help="Only migrate users with at least this primary key.",
+        )
+        parser.add_argument(
+            "--max-pk",
+            default=None,
+            help="Only migrate users with at most this primary key.",
+        )
+        parser.add_argument(
+            "--skipped-file",
+            default=None,
+            help="File to write the users that could not be migrated "
+            "to, one per line, instead of printing them.",
+        )
+
     def handle(self, *args, **options):
-        message = (
-            "This command is intended to migrate projects "
-            "previously using custom User authentication to using Uniauth.\n\n"
-            "You should only proceed with this command if your project had "
-            "users sign up with a username / email address and password. This "
-            "command will create UserProfile for each user with a username or "
-            "email address, and a non-blank password. A verified LinkedEmail "
-            "will also be created if the email field is non-blank.\n\n"
-            "Do you still wish to continue?\n\nAnswer [y/n]: "
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+
+        if options["interactive"]:
+            message = (
+                "This command is intended to migrate projects "
+                "previously using custom User authentication to using "
+                "Uniauth.\n\nYou should only proceed with this command if "
+                "your project had users sign up with a username / email "
+                "address and password. This command will create UserProfile "
+                "for each user with a username or email address, and a "
+                "non-blank password. A verified LinkedEmail will also be "
+                "created if the email field is non-blank.\n\n"
+                "Do you still wish to continue?\n\nAnswer [y/n]: "
+            )
+            answer = get_input(message)
+
+            if answer != "y" and answer != "yes":
+                self.stdout.write("\nCanceled.\n")
+                return
+
+        skipped_file = None
+        if options["skipped_file"]:
+            skipped_file = io.open(
+                options["skipped_file"], "w", encoding="utf-8"
+            )
+        try:
+            self._migrate(batch_size, options, skipped_file)
+        finally:
+            if skipped_file is not None:
+                skipped_file.close()
+
+    def _migrate(self, batch_size, options, skipped_file):
+        self.stdout.write("\nProceeding...\n")
+        total = 0
+        total_skipped = 0
+        start_time = time.time()
+        batches = migrate_custom_users_in_batches(
+            batch_size=batch_size,
+            min_pk=options["min_pk"],
+            max_pk=options["max_pk"],
+        )
+        for last_pk, num_users, skipped in batches:
+            total += num_users
+            total_skipped += len(skipped)
+            for identifier in skipped:
+                if skipped_file is not None:
+                    skipped_file.write("%s\n" % identifier)
+                else:
+                    self.stdout.write(
+                        "Could not migrate user: %s\n" % identifier
+                    )
+            elapsed = time.time() - start_time
+            self.stdout.write(
+                "Migrated %d users (%d total, up to pk %s, %.1f rows/sec).\n"
+                % (num_users, total, last_pk, total / max(elapsed, 1e-6))
+            )
+        elapsed = time.time() - start_time
+        self.stdout.write(
+            "Done! Migrated %d users in %.1f seconds.\n" % (total, elapsed)
         )
-        answer = get_input(message)
-
-        if answer != "y" and answer != "yes":
-            self.stdout.write("\nCanceled.\n")
-            return
-
-        self.stdout.write("\nProceeding... ")
-        skipped = []
-        for user in get_user_model().objects.all():
-            # Skip users that already have UserProfiles
-            if hasattr(user, "uniauth_profile"):
-                continue
-            # Skip users lacking a username/email address or password
-            if (not user.username and not user.email) or not user.password:
-                skipped.append(user.username or user.email or "(none)")
-                continue
-            # Add the profile + LinkedEmail if email field is non-blank
-            profile = UserProfile.objects.create(user=user)
-            if user.email:
-                LinkedEmail.objects.create(
-                    profile=profile, address=user.email, is_verified=True
-                )
-        self.stdout.write("Done!\n")
-
-        if len(skipped) > 0:
+        if total_skipped > 0:
             self.stdout.write(
-                "\nThe following users could not be "
-                + "migrated: %s\n" % str(skipped)
+                "\n%d users could not be migrated.\n" % total_skipped
             )
@@ -0,0 +1,126 @@
+"""
+This command is used to create many users at once, such as when
+onboarding an entire institution.
+
+Reads users from a CSV file with a header row, or a JSONL file with
+one object per line. The "username", "email", "password" (or
+"password_hash"), "linked_emails" and "institution_accounts" keys are
+recognized, and any other keys are set as fields of the User. In CSV
+files, linked emails are separated by semicolons, and institution
+accounts are given as "<slug>:<cas_id>" and separated by semicolons.
+In JSONL files, both are lists, with each account a [slug, cas_id]
+pair.
+
+Users are created in chunks of --batch-size users, along with their
+UserProfiles, verified LinkedEmails and InstitutionAccounts. Users
+that conflict with existing ones are skipped and reported.
+
+Execution: python manage.py provision_users <file>
+"""
+
+import csv
+import io
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from uniauth.utils import provision_users_in_batches
+
+
+class Command(BaseCommand):
+    help = "Creates the users listed in a CSV or JSONL file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("file")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            default=None,
+            help="Format of the file. Inferred from its extension "
+            "if not provided.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Create at most this many users per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["file"]
+        batch_size = options["batch_size"]
+        if not os.path.exists(path):
+            raise CommandError("File '%s' does not exist." % path)
+        if batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+        file_format = options["format"]
+        if file_format is None:
+            extension = os.path.splitext(path)[1].lower()
+            file_format = (
+                "jsonl" if extension in (".jsonl", ".json") else "csv"
+            )
+
+        total = 0
+        total_skipped = 0
+        start_time = time.time()
+        with io.open(path, encoding="utf-8", newline="") as f:
+            batches = provision_users_in_batches(
+                self._read_records(f, file_format), batch_size=batch_size
+            )
+            for last_line, num_users, skipped in batches:
+                total += num_users
+                total_skipped += len(skipped)
+                for line_num, reason in skipped:
+                    self.stderr.write("Line %d: %s\n" % (line_num, reason))
+                elapsed = time.time() - start_time
+                self.stdout.write(
+                    "Created %d users (%d skipped, %d total, up to line %d, "
+                    "%.1f rows/sec).\n"
+                    % (
+                        num_users,
+                        len(skipped),
+                        total,
+                        last_line,
+                        total / max(elapsed, 1e-6),
+                    )
+                )
+
+        elapsed = time.time() - start_time
+        self.stdout.write(
+            "Created %d users (%d skipped) in %.1f seconds.\n"
+            % (total, total_skipped, elapsed)
+        )
+
+    def _read_records(self, f, file_format):
+        """
+        Yields a (line number, record) tuple for
+        each user described in the provided file.
+        """
+        if file_format == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                record = dict((k, v) for k, v in row.items() if k and v)
+                if "linked_emails" in record:
+                    record["linked_emails"] = record["linked_emails"].split(
+                        ";"
+                    )
+                if "institution_accounts" in record:
+                    record["institution_accounts"] = [
+                        x.strip().split(":", 1)
+                        for x in record["institution_accounts"].split(";")
+                        if x.strip()
+                    ]
+                yield reader.line_num, record
+        else:
+            for line_num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise CommandError("Line %d is not valid JSON." % line_num)
+                if not isinstance(record, dict):
+                    raise CommandError("Line %d is not an object." % line_num)
+                yield line_num, record
@@ -6,6 +6,7 @@ Execution: python manage.py remove_institution <slug>
 
 from django.core.management.base import BaseCommand, CommandError
 
+from uniauth.cache import clear_institution_cache
 from uniauth.models import Institution
 from uniauth.utils import get_input
 
@@ -32,6 +33,7 @@ class Command(BaseCommand):
         )
         if answer == "y" or answer == "yes":
             institution.delete()
+            clear_institution_cache()
             self.stdout.write("Deleted institution '%s'.\n" % str(institution))
         else:
             self.stdout.write("Canceled.\n")
@@ -0,0 +1,77 @@
+"""
+This command is used to run deferred merge jobs (see the
+UNIAUTH_DEFER_MERGES setting) that did not complete again.
+
+Failed jobs are retried, along with pending or running jobs that have
+not been updated for --stale-minutes minutes, such as those left
+behind by a process that died. Jobs are run one at a time, in this
+process, with uniauth.jobs.retry_merge_job.
+
+Execution: python manage.py retry_merge_jobs
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+from uniauth.jobs import retry_merge_job
+from uniauth.models import MergeJob
+
+
+class Command(BaseCommand):
+    help = "Runs failed and stale deferred merge jobs again."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--stale-minutes",
+            type=int,
+            default=60,
+            help="Also retry pending or running jobs not updated for "
+            "this many minutes.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Report the jobs that would be retried, without "
+            "running them.",
+        )
+
+    def handle(self, *args, **options):
+        stale_minutes = options["stale_minutes"]
+        if stale_minutes < 1:
+            raise CommandError("--stale-minutes must be a positive integer.")
+        stale_before = timezone.now() - timedelta(minutes=stale_minutes)
+        job_pks = list(
+            MergeJob.objects.filter(
+                Q(status=MergeJob.STATUS_FAILED)
+                | Q(
+                    status__in=[
+                        MergeJob.STATUS_PENDING,
+                        MergeJob.STATUS_RUNNING,
+                    ],
+                    updated__lt=stale_before,
+                )
+            )
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        if options["dry_run"]:
+            self.stdout.write("Found %d merge jobs to retry.\n" % len(job_pks))
+            return
+
+        num_succeeded = 0
+        num_failed = 0
+        for job_pk in job_pks:
+            job = retry_merge_job(job_pk, stale_before=stale_before)
+            if job.status == MergeJob.STATUS_SUCCEEDED:
+                num_succeeded += 1
+            elif job.status == MergeJob.STATUS_FAILED:
+                num_failed += 1
+                self.stderr.write("Merge job %s failed again.\n" % job_pk)
+        self.stdout.write(
+            "Retried %d merge jobs: %d succeeded, %d failed.\n"
+            % (len(job_pks), num_succeeded, num_failed)
+        )
@@ -3,27 +3,320 @@ Handles the merging of two or more model instances.
 
 Adapted from the django-extensions package:
 https://github.com/django-extensions/django-extensions
+
+Related rows are re-pointed to the primary object with set-based
+queries (one UPDATE per relation, rather than one save() per row).
+Models that rely on save() side effects may opt out of this by being
+listed in the UNIAUTH_MERGE_SAVE_MODELS setting.
+
+The relations touched for each model are described by the plan
+returned from get_merge_plan(), which is computed once and cached.
+The work a merge would do can be estimated beforehand, without
+writing anything, with estimate_merge().
 """
 
+from collections import namedtuple
+
 from django.apps import apps
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
 
 from uniauth.utils import get_setting
 
+# Describes how a single relation of a model is merged. The
+# field_name is the name of the field on the related (or through)
+# model which refers back to the merged model, and is None for
+# many-to-many relations with an auto-created through model. For
+# other many-to-many relations, target_field_name is the name of
+# the through model's field referring to the related model.
+MergeRelation = namedtuple(
+    "MergeRelation",
+    [
+        "field",
+        "accessor_name",
+        "field_name",
+        "related_model",
+        "through",
+        "target_field_name",
+    ],
+)
+
+# Describes everything merge_model_instances() touches for a model:
+# its many-to-many relations, reverse foreign keys, one-to-one and
+# foreign key fields (which are merged recursively, in order), and
+# the generic foreign keys that may refer to it.
+MergePlan = namedtuple(
+    "MergePlan",
+    ["model", "many_to_many", "one_to_many", "to_one", "generic"],
+)
+
+# Describes the work merge_model_instances() would do for a single
+# relation (or deletion) when merging, as estimated by
+# estimate_merge(). The path is the dotted list of accessors leading
+# to the relation from the primary object, kind is one of "generic",
+# "many_to_many", "one_to_many", "to_one", "one_to_one" or "delete",
+# and model is the label of the model whose rows would be written
+# (and locked): rows is the number of such rows, and queries the
+# estimated number of queries made.
+MergeEstimate = namedtuple(
+    "MergeEstimate", ["path", "kind", "model", "rows", "queries"]
+)
+
+# Cache of MergePlans, keyed by model class
+_merge_plans = {}
+
+# Cache of the GenericForeignKeys in all models, and of the
+# subset that can refer to each content type, keyed by the
+# content type's natural key. Only populated once the app
+# registry is ready, as the set of models is fixed after that.
+_generic_fields = {"all": None, "by_content_type": {}}
+
 
 def _get_generic_fields():
     """
-    Return a list of all GenericForeignKeys in all models.
+    Return a tuple of all GenericForeignKeys in all models.
+    """
+    generic_fields = _generic_fields["all"]
+    if generic_fields is None:
+        generic_fields = []
+        for model in apps.get_models():
+            for field_name, field in model.__dict__.items():
+                if isinstance(field, GenericForeignKey):
+                    generic_fields.append(field)
+        generic_fields = tuple(generic_fields)
+        if apps.ready:
+            _generic_fields["all"] = generic_fields
+    return generic_fields
+
+
+def _can_refer_to(field, content_type):
+    """
+    Returns whether the provided GenericForeignKey may refer to
+    objects of the provided content type, according to the
+    limit_choices_to of its content type field.
+    """
+    ct_field = field.model._meta.get_field(field.ct_field)
+    if not ct_field.is_relation:
+        return True
+    limit_choices_to = ct_field.get_limit_choices_to()
+    if not limit_choices_to:
+        return True
+    return (
+        content_type.__class__._default_manager.db_manager(
+            content_type._state.db
+        )
+        .complex_filter(limit_choices_to)
+        .filter(pk=content_type.pk)
+        .exists()
+    )
+
+
+def _get_generic_fields_for(model):
+    """
+    Return a tuple of the GenericForeignKeys in all models which
+    can refer to instances of the provided model.
     """
-    generic_fields = []
-    for model in apps.get_models():
-        for field_name, field in model.__dict__.items():
-            if isinstance(field, GenericForeignKey):
-                generic_fields.append(field)
+    content_type = ContentType.objects.get_for_model(
+        model, for_concrete_model=False
+    )
+    key = content_type.natural_key()
+    generic_fields = _generic_fields["by_content_type"].get(key)
+    if generic_fields is None:
+        generic_fields = tuple(
+            x
+            for x in _get_generic_fields()
+            if _can_refer_to(
+                x,
+                ContentType.objects.get_for_model(
+                    model, for_concrete_model=x.for_concrete_model
+                ),
+            )
+        )
+        if apps.ready:
+            _generic_fields["by_content_type"][key] = generic_fields
     return generic_fields
 
 
+def _get_accessor_name(field):
+    """
+    Returns the name of the attribute used to access the provided
+    relation from instances of the model it was retrieved from.
+    """
+    if field.auto_created and not field.concrete:
+        return field.get_accessor_name()
+    return field.name
+
+
+def _get_merge_relation(field):
+    """
+    Returns the MergeRelation describing the provided field.
+    """
+    through = None
+    target_field_name = None
+    if field.many_to_many:
+        if field.concrete:
+            through = field.remote_field.through
+            through_field_name = field.m2m_field_name()
+            target_field_name = field.m2m_reverse_field_name()
+        else:
+            through = field.through
+            through_field_name = field.field.m2m_reverse_field_name()
+            target_field_name = field.field.m2m_field_name()
+        if through._meta.auto_created:
+            through_field_name = target_field_name = None
+        field_name = through_field_name
+    elif field.one_to_many:
+        field_name = field.field.name
+    else:
+        field_name = field.name
+    return MergeRelation(
+        field=field,
+        accessor_name=_get_accessor_name(field),
+        field_name=field_name,
+        related_model=field.related_model,
+        through=through,
+        target_field_name=target_field_name,
+    )
+
+
+def get_merge_plan(model):
+    """
+    Returns the MergePlan for the provided model class, which lists
+    the relations merge_model_instances() will move from the alias
+    objects to the primary object, in the order they are processed.
+
+    Plans are computed once per model and cached. They are immutable,
+    so they may be safely inspected by callers.
+    """
+    plan = _merge_plans.get(model)
+    if plan is not None:
+        return plan
+
+    many_to_many = []
+    one_to_many = []
+    to_one = []
+    for field in model._meta.get_fields():
+        if not field.is_relation:
+            continue
+        relation = _get_merge_relation(field)
+        # Skip reverse relations hidden with a related_name ending in '+'
+        if relation.accessor_name is None:
+            continue
+        if field.many_to_many:
+            many_to_many.append(relation)
+        elif field.one_to_many:
+            # Generic relations are handled by their generic foreign keys
+            if field.auto_created:
+                one_to_many.append(relation)
+        elif field.one_to_one or field.many_to_one:
+            to_one.append(relation)
+
+    plan = MergePlan(
+        model=model,
+        many_to_many=tuple(many_to_many),
+        one_to_many=tuple(one_to_many),
+        to_one=tuple(to_one),
+        generic=_get_generic_fields_for(model),
+    )
+    if apps.ready:
+        _merge_plans[model] = plan
+    return plan
+
+
+def _merge_with_save(model):
+    """
+    Returns whether instances of the provided model must be
+    re-pointed one at a time with save(), rather than in bulk.
+    """
+    return model._meta.label in get_setting("UNIAUTH_MERGE_SAVE_MODELS")
+
+
+def _merge_many_to_many(primary_object, alias_object, relation):
+    """
+    Moves the alias object's relations through the provided
+    many-to-many relation over to the primary object.
+    """
+    related_objects = getattr(alias_object, relation.accessor_name, None)
+    if related_objects is None:
+        return
+
+    # Handle regular M2M relationships: add all of the alias'
+    # related objects to the primary object at once
+    if relation.field_name is None:
+        related_pks = list(related_objects.values_list("pk", flat=True))
+        if related_pks:
+            getattr(primary_object, relation.accessor_name).add(*related_pks)
+            related_objects.clear()
+        return
+
+    # Handle M2M relationships with a 'through' model, by
+    # re-attaching the through model rows to the primary_object.
+    # Rows for objects the primary object is already related to
+    # are deleted first, as the through model may only allow one
+    # row per pair (as the auto-created through models do).
+    field_name = relation.field_name
+    target_field_name = relation.target_field_name
+    manager = relation.through._default_manager
+    primary_targets = list(
+        manager.filter(**{field_name: primary_object}).values_list(
+            target_field_name, flat=True
+        )
+    )
+    through_instances = manager.filter(**{field_name: alias_object})
+    if primary_targets:
+        through_instances.filter(
+            **{target_field_name + "__in": primary_targets}
+        ).delete()
+    if _merge_with_save(relation.through):
+        for instance in through_instances:
+            setattr(instance, field_name, primary_object)
+            instance.save()
+    else:
+        through_instances.update(**{field_name: primary_object})
+
+
+def _merge_one_to_many(primary_object, alias_object, relation):
+    """
+    Re-points the objects referring to the alias object through
+    the provided reverse foreign key to the primary object.
+    """
+    related_objects = getattr(alias_object, relation.accessor_name, None)
+    if related_objects is None:
+        return
+    field_name = relation.field_name
+    if _merge_with_save(relation.related_model):
+        for obj in related_objects.all():
+            setattr(obj, field_name, primary_object)
+            obj.save()
+    else:
+        related_objects.all().update(**{field_name: primary_object})
+
+
+def _merge_generic(primary_object, alias_objects, field):
+    """
+    Re-points the objects referring to any of the alias objects
+    through the provided generic foreign key to the primary object.
+    """
+    filter_kwargs = {}
+    filter_kwargs[field.fk_field + "__in"] = [
+        x._get_pk_val() for x in alias_objects
+    ]
+    filter_kwargs[field.ct_field] = field.get_content_type(alias_objects[0])
+    related_objects = field.model._default_manager.filter(**filter_kwargs)
+    if _merge_with_save(field.model):
+        for generic_related_object in related_objects:
+            setattr(generic_related_object, field.name, primary_object)
+            generic_related_object.save()
+    else:
+        related_objects.update(
+            **{
+                field.fk_field: primary_object._get_pk_val(),
+                field.ct_field: field.get_content_type(primary_object),
+            }
+        )
+
+
 @transaction.atomic()
 def merge_model_instances(primary_object, alias_objects, field_trace=[]):
     """
@@ -33,22 +326,15 @@ def merge_model_instances(primary_object, alias_objects, field_trace=[]):
 
     Performs recursive merging of related One-to-One fields.
     """
-    generic_fields = _get_generic_fields()
-
-    # get related fields
-    related_fields = list(
-        filter(
-            lambda x: x.is_relation is True, primary_object._meta.get_fields()
-        )
-    )
+    alias_objects = list(alias_objects)
+    if not alias_objects:
+        return primary_object, [], 0
+    plan = get_merge_plan(primary_object.__class__)
 
-    many_to_many_fields = list(
-        filter(lambda x: x.many_to_many is True, related_fields)
-    )
-
-    related_fields = list(
-        filter(lambda x: x.many_to_many is False, related_fields)
-    )
+    # Only the generic foreign keys which can refer to this
+    # model need to be considered
+    for field in plan.generic:
+        _merge_generic(primary_object, alias_objects, field)
 
     # Loop through all alias objects and migrate their references to the
     # primary object
@@ -57,90 +343,196 @@ def merge_model_instances(primary_object, alias_objects, field_trace=[]):
     for alias_object in alias_objects:
         # Migrate all foreign key references from alias object to primary
         # object.
-        for many_to_many_field in many_to_many_fields:
-            alias_varname = many_to_many_field.name
-            related_objects = getattr(alias_object, alias_varname, None)
+        for relation in plan.many_to_many:
+            _merge_many_to_many(primary_object, alias_object, relation)
+
+        for relation in plan.one_to_many:
+            _merge_one_to_many(primary_object, alias_object, relation)
+
+        for relation in plan.to_one:
+            alias_varname = relation.accessor_name
+            related_object = getattr(alias_object, alias_varname, None)
+            primary_related_object = getattr(
+                primary_object, alias_varname, None
+            )
+            if related_object is None:
+                continue
+            elif primary_related_object is None:
+                setattr(primary_object, alias_varname, related_object)
+                primary_object.save()
+            elif relation.field.one_to_one:
+                # Perform recursive merging for one-to-one fields
+                if get_setting("UNIAUTH_PERFORM_RECURSIVE_MERGING"):
+                    if relation.field in field_trace:
+                        continue
+                    updated_trace = field_trace + [
+                        relation.field,
+                        relation.field.remote_field,
+                    ]
+                    merge_model_instances(
+                        primary_related_object,
+                        [related_object],
+                        updated_trace,
+                    )
+                else:
+                    related_object.delete()
+
+        if alias_object.id:
+            deleted_objects += [alias_object]
+            alias_object.delete()
+            deleted_objects_count += 1
+
+    return primary_object, deleted_objects, deleted_objects_count
+
+
+def _estimate_repoint(path, kind, model, rows):
+    """
+    Returns the MergeEstimate for re-pointing the provided number
+    of rows of the provided model, either in bulk or with save().
+    """
+    if _merge_with_save(model):
+        queries = 1 + rows
+    else:
+        queries = 1
+    return MergeEstimate(path, kind, model._meta.label, rows, queries)
+
+
+def estimate_merge(primary_object, alias_objects, field_trace=[], prefix=""):
+    """
+    Estimates the work merge_model_instances() would do to merge
+    the alias objects into the primary object, without writing
+    anything to the database.
+
+    Returns a list of MergeEstimates, one per relation the merge
+    would process (and one per deleted alias object), in the order
+    the merge would process them. Recursive one-to-one merges are
+    included, with their paths prefixed by the accessor name of
+    the one-to-one relation.
+    """
+    alias_objects = list(alias_objects)
+    if not alias_objects:
+        return []
+    plan = get_merge_plan(primary_object.__class__)
+    estimates = []
+
+    for field in plan.generic:
+        rows = field.model._default_manager.filter(
+            **{
+                field.fk_field
+                + "__in": [x._get_pk_val() for x in alias_objects],
+                field.ct_field: field.get_content_type(alias_objects[0]),
+            }
+        ).count()
+        estimates.append(
+            _estimate_repoint(
+                prefix + field.model._meta.label + "." + field.name,
+                "generic",
+                field.model,
+                rows,
+            )
+        )
+
+    for alias_object in alias_objects:
+        for relation in plan.many_to_many:
+            related_objects = getattr(
+                alias_object, relation.accessor_name, None
+            )
             if related_objects is None:
                 continue
-            for obj in related_objects.all():
-                try:
-                    # Handle regular M2M relationships.
-                    getattr(alias_object, alias_varname).remove(obj)
-                    getattr(primary_object, alias_varname).add(obj)
-                except AttributeError:
-                    # Handle M2M relationships with a 'through' model.
-                    # This does not delete the 'through model.
-                    through_model = getattr(
-                        alias_object, alias_varname
-                    ).through
-                    kwargs = {
-                        many_to_many_field.m2m_reverse_field_name(): obj,
-                        many_to_many_field.m2m_field_name(): alias_object,
-                    }
-                    through_model_instances = through_model.objects.filter(
-                        **kwargs
+            path = prefix + relation.accessor_name
+            if relation.field_name is None:
+                # One query to list the related objects, and if there
+                # are any, two to add them and one to clear them
+                rows = related_objects.count()
+                estimates.append(
+                    MergeEstimate(
+                        path,
+                        "many_to_many",
+                        relation.through._meta.label,
+                        rows,
+                        4 if rows else 1,
                     )
-                    for instance in through_model_instances:
-                        # Re-attach the through model to the primary_object
-                        setattr(
-                            instance,
-                            many_to_many_field.m2m_field_name(),
-                            primary_object,
-                        )
-                        instance.save()
-
-        for related_field in related_fields:
-            if related_field.one_to_many:
-                alias_varname = related_field.get_accessor_name()
-                related_objects = getattr(alias_object, alias_varname, None)
-                if related_objects is None:
-                    continue
-                for obj in related_objects.all():
-                    field_name = related_field.field.name
-                    setattr(obj, field_name, primary_object)
-                    obj.save()
-            elif related_field.one_to_one or related_field.many_to_one:
-                alias_varname = related_field.name
-                related_object = getattr(alias_object, alias_varname, None)
-                primary_related_object = getattr(
-                    primary_object, alias_varname, None
                 )
-                if related_object is None:
-                    continue
-                elif primary_related_object is None:
-                    setattr(primary_object, alias_varname, related_object)
-                    primary_object.save()
-                elif related_field.one_to_one:
-                    # Perform recursive merging for one-to-one fields
-                    if get_setting("UNIAUTH_PERFORM_RECURSIVE_MERGING"):
-                        if related_field in field_trace:
-                            continue
-                        updated_trace = field_trace + [
-                            related_field,
-                            related_field.remote_field,
-                        ]
-                        merge_model_instances(
+            else:
+                rows = relation.through._default_manager.filter(
+                    **{relation.field_name: alias_object}
+                ).count()
+                # One more query to list the primary object's related
+                # objects, and possibly one to delete shared ones
+                estimate = _estimate_repoint(
+                    path, "many_to_many", relation.through, rows
+                )
+                estimates.append(
+                    estimate._replace(queries=estimate.queries + 2)
+                )
+
+        for relation in plan.one_to_many:
+            related_objects = getattr(
+                alias_object, relation.accessor_name, None
+            )
+            if related_objects is None:
+                continue
+            estimates.append(
+                _estimate_repoint(
+                    prefix + relation.accessor_name,
+                    "one_to_many",
+                    relation.related_model,
+                    related_objects.count(),
+                )
+            )
+
+        for relation in plan.to_one:
+            alias_varname = relation.accessor_name
+            related_object = getattr(alias_object, alias_varname, None)
+            primary_related_object = getattr(
+                primary_object, alias_varname, None
+            )
+            path = prefix + alias_varname
+            if related_object is None:
+                continue
+            elif primary_related_object is None:
+                estimates.append(
+                    MergeEstimate(
+                        path, "to_one", primary_object._meta.label, 1, 1
+                    )
+                )
+            elif relation.field.one_to_one:
+                if get_setting("UNIAUTH_PERFORM_RECURSIVE_MERGING"):
+                    if relation.field in field_trace:
+                        continue
+                    updated_trace = field_trace + [
+                        relation.field,
+                        relation.field.remote_field,
+                    ]
+                    estimates.extend(
+                        estimate_merge(
                             primary_related_object,
                             [related_object],
                             updated_trace,
+                            path + ".",
                         )
-                    else:
-                        related_object.delete()
-
-        for field in generic_fields:
-            filter_kwargs = {}
-            filter_kwargs[field.fk_field] = alias_object._get_pk_val()
-            filter_kwargs[field.ct_field] = field.get_content_type(
-                alias_object
-            )
-            related_objects = field.model.objects.filter(**filter_kwargs)
-            for generic_related_object in related_objects:
-                setattr(generic_related_object, field.name, primary_object)
-                generic_related_object.save()
+                    )
+                else:
+                    estimates.append(
+                        MergeEstimate(
+                            path,
+                            "one_to_one",
+                            related_object._meta.label,
+                            1,
+                            1 + len(related_object._meta.related_objects),
+                        )
+                    )
 
-        if alias_object.id:
-            deleted_objects += [alias_object]
-            alias_object.delete()
-            deleted_objects_count += 1
+        # Deleting the alias checks each relation referring to it
+        if alias_object.pk:
+            estimates.append(
+                MergeEstimate(
+                    prefix.rstrip(".") or alias_object._meta.model_name,
+                    "delete",
+                    alias_object._meta.label,
+                    1,
+                    1 + len(alias_object._meta.related_objects),
+                )
+            )
 
-    return primary_object, deleted_objects, deleted_objects_count
+    return estimates
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-16 20:50
+
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def populate_normalized_address(apps, schema_editor):
+    LinkedEmail = apps.get_model("uniauth", "LinkedEmail")
+    LinkedEmail.objects.using(schema_editor.connection.alias).update(
+        normalized_address=Lower("address")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("uniauth", "0003_auto_20221107_2353"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="linkedemail",
+            name="normalized_address",
+            field=models.EmailField(
+                blank=True, default="", editable=False, max_length=254
+            ),
+        ),
+        migrations.RunPython(
+            populate_normalized_address, migrations.RunPython.noop
+        ),
+        migrations.AddIndex(
+            model_name="linkedemail",
+            index=models.Index(
+                fields=["address", "is_verified"],
+                name="uniauth_lin_address_bac713_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="linkedemail",
+            index=models.Index(
+                fields=["normalized_address", "is_verified"],
+                name="uniauth_lin_normali_c32c27_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("uniauth", "0005_mergejob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InstitutionAccountAttributes",
+            fields=[
+                (
+                    "account",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="cas_attributes",
+                        serialize=False,
+                        to="uniauth.institutionaccount",
+                    ),
+                ),
+                ("attributes", models.TextField(blank=True, default="{}")),
+                (
+                    "attributes_hash",
+                    models.CharField(blank=True, max_length=64),
+                ),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name_plural": "institution account attributes",
+            },
+        ),
+    ]
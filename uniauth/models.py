@@ -1,10 +1,11 @@
+import json
 from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 
@@ -70,14 +71,31 @@ def create_user_profile(sender, instance, created, **kwargs):
 def clear_old_tmp_users(sender, instance, created, **kwargs):
     """
     Deletes temporary users more than PASSWORD_RESET_TIMEOUT_DAYS
-    old when a User is created.
+    old when a User is created, according to the
+    UNIAUTH_TMP_USER_SWEEP_MODE setting:
+      - "always": Deletes all such users on every creation
+      - "throttled": Deletes at most one batch of such users, at
+        most once every UNIAUTH_TMP_USER_SWEEP_INTERVAL seconds
+      - "command": Does nothing, leaving the deletion to the
+        flush_tmp_users command
 
     Does nothing if the user model does not have date_joined field.
     """
     if created:
         user_model = get_user_model()
         if hasattr(user_model, "date_joined"):
-            from uniauth.utils import get_setting
+            from uniauth.cache import acquire_rate_limit
+            from uniauth.utils import delete_in_batches, get_setting
+
+            sweep_mode = get_setting("UNIAUTH_TMP_USER_SWEEP_MODE")
+            if sweep_mode == "command":
+                return
+            max_batches = None
+            if sweep_mode == "throttled":
+                interval = get_setting("UNIAUTH_TMP_USER_SWEEP_INTERVAL")
+                if not acquire_rate_limit("clear-old-tmp-users", interval):
+                    return
+                max_batches = 1
 
             timeout_days = timedelta(
                 days=get_setting("PASSWORD_RESET_TIMEOUT_DAYS")
@@ -85,9 +103,14 @@ def clear_old_tmp_users(sender, instance, created, **kwargs):
             tmp_expire_date = (timezone.now() - timeout_days).replace(
                 hour=0, minute=0, second=0, microsecond=0
             )
-            user_model.objects.filter(
+            old_tmp_users = user_model.objects.filter(
                 username__startswith="tmp-", date_joined__lt=tmp_expire_date
-            ).delete()
+            )
+            delete_in_batches(
+                old_tmp_users,
+                get_setting("UNIAUTH_TMP_USER_SWEEP_BATCH_SIZE"),
+                max_batches=max_batches,
+            )
 
 
 class LinkedEmail(models.Model):
@@ -106,9 +129,29 @@ class LinkedEmail(models.Model):
     # The email address
     address = models.EmailField(null=False, blank=False)
 
+    # Lowercased copy of the address, kept in sync on save
+    # so case-insensitive lookups can use an index
+    normalized_address = models.EmailField(
+        null=False, blank=True, default="", editable=False
+    )
+
     # Whether the linked email is verified
     is_verified = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["address", "is_verified"]),
+            models.Index(fields=["normalized_address", "is_verified"]),
+        ]
+
+    @staticmethod
+    def normalize_address(address):
+        """
+        Returns the form of the provided address stored in
+        normalized_address, for use in case-insensitive lookups.
+        """
+        return address.lower() if address else address
+
     def clean(self):
         """
         Ensures an email can't be linked and verified for multiple
@@ -144,6 +187,18 @@ class LinkedEmail(models.Model):
             )
         super(LinkedEmail, self).clean()
 
+    def save(self, *args, **kwargs):
+        """
+        Keeps normalized_address in sync with the address.
+        """
+        self.normalized_address = self.normalize_address(self.address) or ""
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "address" in update_fields:
+            kwargs["update_fields"] = list(update_fields) + [
+                "normalized_address"
+            ]
+        super(LinkedEmail, self).save(*args, **kwargs)
+
     def __str__(self):
         try:
             return "%s | %s" % (self.profile, self.address)
@@ -175,6 +230,20 @@ class Institution(models.Model):
             return "NULL"
 
 
+@receiver(post_save, sender=Institution)
+@receiver(post_delete, sender=Institution)
+def invalidate_institution_cache(sender, **kwargs):
+    """
+    Invalidates the cached institution registry whenever an
+    Institution is changed. The registry is cleared again once
+    the transaction commits, in case it was reloaded before then.
+    """
+    from uniauth.cache import clear_institution_cache
+
+    clear_institution_cache()
+    transaction.on_commit(clear_institution_cache)
+
+
 class InstitutionAccount(models.Model):
     """
     Relates users to the accounts they have at
@@ -208,3 +277,148 @@ class InstitutionAccount(models.Model):
             return "%s | %s | account" % (self.profile, self.institution)
         except:
             return "NULL"
+
+
+@receiver(pre_save, sender=InstitutionAccount)
+def invalidate_previous_account_user_cache(
+    sender, instance, raw=False, **kwargs
+):
+    """
+    Invalidates the cached user of an InstitutionAccount before
+    it is changed, in case its institution or CAS ID changes.
+    """
+    if raw or instance.pk is None:
+        return
+    previous = (
+        InstitutionAccount.objects.filter(pk=instance.pk)
+        .values_list("institution_id", "cas_id")
+        .first()
+    )
+    if previous is not None:
+        _invalidate_account_user(*previous)
+
+
+@receiver(post_save, sender=InstitutionAccount)
+@receiver(post_delete, sender=InstitutionAccount)
+def invalidate_account_user_cache(sender, instance, **kwargs):
+    """
+    Invalidates the cached user of an InstitutionAccount whenever
+    it is linked, changed or removed.
+    """
+    _invalidate_account_user(instance.institution_id, instance.cas_id)
+
+
+def _invalidate_account_user(institution_id, cas_id):
+    """
+    Invalidates the cached user of the InstitutionAccount with the
+    provided institution and CAS ID. The user is invalidated again
+    once the transaction commits, in case it was cached before then.
+    """
+    _invalidate_account_users([(institution_id, cas_id)])
+
+
+def _invalidate_account_users(accounts):
+    """
+    Invalidates the cached users of the InstitutionAccounts with
+    the provided (institution ID, CAS ID) pairs, like
+    _invalidate_account_user, for accounts removed in bulk.
+    """
+    from uniauth.cache import invalidate_account_users
+
+    accounts = list(accounts)
+    invalidate_account_users(accounts)
+    transaction.on_commit(lambda: invalidate_account_users(accounts))
+
+
+class InstitutionAccountAttributes(models.Model):
+    """
+    Stores the latest attributes returned by the CAS server
+    when the account was logged into, if the
+    UNIAUTH_PERSIST_CAS_ATTRIBUTES setting is True.
+    """
+
+    # The account the attributes are for
+    account = models.OneToOneField(
+        "InstitutionAccount",
+        related_name="cas_attributes",
+        on_delete=models.CASCADE,
+        primary_key=True,
+    )
+
+    # The attributes, serialized as JSON
+    attributes = models.TextField(null=False, blank=True, default="{}")
+
+    # SHA-256 hash of the serialized attributes, so unchanged
+    # attributes are not written again
+    attributes_hash = models.CharField(max_length=64, null=False, blank=True)
+
+    # When the attributes last changed
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "institution account attributes"
+
+    def get_attributes(self):
+        """
+        Returns the stored attributes as a dict.
+        """
+        return json.loads(self.attributes)
+
+    def __str__(self):
+        try:
+            return "%s | attributes" % self.account
+        except:
+            return "NULL"
+
+
+class MergeJob(models.Model):
+    """
+    Tracks the merge of a user into a Uniauth profile's
+    user that was deferred to a background job.
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCEEDED, "Succeeded"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    # Identifies the merge, so retried requests reuse the same job
+    idempotency_key = models.CharField(
+        max_length=255, null=False, blank=False, unique=True
+    )
+
+    # The profile whose user the other user is merged into
+    profile = models.ForeignKey(
+        "UserProfile",
+        related_name="merge_jobs",
+        on_delete=models.CASCADE,
+        null=False,
+    )
+
+    # Primary key of the user being merged in, which
+    # is deleted once the merge is complete
+    alias_user_pk = models.CharField(max_length=255, null=False, blank=False)
+
+    # The current state of the job
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING
+    )
+
+    # Description of the error that caused the job to fail, if any
+    error = models.TextField(null=False, blank=True, default="")
+
+    # When the job was created and last updated
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        try:
+            return "%s | %s | merge" % (self.profile, self.status)
+        except:
+            return "NULL"
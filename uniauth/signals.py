@@ -0,0 +1,14 @@
+"""
+Signals sent by Uniauth.
+"""
+
+from django.dispatch import Signal
+
+# Sent by the LinkedEmail backends after each password
+# authentication attempt, with the following arguments:
+#   request: The request being authenticated (may be None)
+#   num_candidates: Number of users whose password could be checked
+#   num_checked: Number of users whose password was checked
+#   duration: Time taken by the attempt, in seconds
+#   succeeded: Whether a user was authenticated
+password_check_completed = Signal()
@@ -3,6 +3,13 @@ try:
 except ImportError:
     from django.urls import re_path as url
 from uniauth import views
+from uniauth.utils import get_setting
+
+# Use the async variants of the CAS views if they were opted into
+if get_setting("UNIAUTH_USE_ASYNC_CAS_VIEWS"):
+    from uniauth import async_views as cas_views
+else:
+    cas_views = views
 
 app_name = "uniauth"
 
@@ -10,7 +17,7 @@ urlpatterns = [
     url(r"^login/$", views.login, name="login"),
     url(
         r"^cas-login/(?P<institution>[a-z0-9\-]+)/$",
-        views.cas_login,
+        cas_views.cas_login,
         name="cas-login",
     ),
     url(r"^logout/$", views.logout, name="logout"),
@@ -19,9 +26,15 @@ urlpatterns = [
     url(r"^link-to-profile/$", views.link_to_profile, name="link-to-profile"),
     url(
         r"^link-from-profile/(?P<institution>[a-z0-9\-]+)/$",
-        views.link_from_profile,
+        cas_views.link_from_profile,
         name="link-from-profile",
     ),
+    url(r"^merge-status/$", views.merge_status, name="merge-status"),
+    url(
+        r"^merge-status/(?P<job_id>[0-9]+)/$",
+        views.merge_status,
+        name="merge-status",
+    ),
     url(
         r"^verify-token/(?P<pk_base64>[0-9A-Za-z_\-]+)/(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,32})/$",
         views.verify_token,
@@ -17,14 +17,26 @@ if get_setting("UNIAUTH_LOGIN_DISPLAY_STANDARD"):
     ) % "UNIAUTH_LOGIN_DISPLAY_STANDARD"
     raise ImproperlyConfigured(err_msg)
 
+# Use the async variant of the CAS login view if it was opted into
+if get_setting("UNIAUTH_USE_ASYNC_CAS_VIEWS"):
+    from uniauth import async_views as cas_views
+else:
+    cas_views = views
+
 app_name = "uniauth"
 
 urlpatterns = [
     url(r"^login/$", views.login, name="login"),
     url(
         r"^cas-login/(?P<institution>[a-z0-9\-]+)/$",
-        views.cas_login,
+        cas_views.cas_login,
         name="cas-login",
     ),
     url(r"^logout/$", views.logout, name="logout"),
+    url(r"^merge-status/$", views.merge_status, name="merge-status"),
+    url(
+        r"^merge-status/(?P<job_id>[0-9]+)/$",
+        views.merge_status,
+        name="merge-status",
+    ),
 ]
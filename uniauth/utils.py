@@ -1,7 +1,22 @@
+import re
+from collections import namedtuple
 from datetime import timedelta
+from itertools import islice
 
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME, get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import (
+    ImproperlyConfigured,
+    ObjectDoesNotExist,
+    ValidationError,
+)
+from django.core.signals import setting_changed
+from django.core.validators import validate_email
+from django.db import DatabaseError, IntegrityError, router, transaction
+from django.db.models.deletion import Collector
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
 from django.shortcuts import resolve_url
 from django.utils import timezone
 from django.utils.crypto import get_random_string
@@ -21,41 +36,126 @@ try:
 except ImportError:
     from urllib.parse import urlencode, urlunparse
 
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
 
 # The default value for all settings used by Uniauth
 DEFAULT_SETTING_VALUES = {
     "LOGIN_URL": "/accounts/login/",
     "PASSWORD_RESET_TIMEOUT_DAYS": 3,
+    "UNIAUTH_ACCOUNT_CACHE_TIMEOUT": 300,
     "UNIAUTH_ALLOW_STANDALONE_ACCOUNTS": True,
     "UNIAUTH_ALLOW_SHARED_EMAILS": True,
+    "UNIAUTH_CACHE_ALIAS": None,
+    "UNIAUTH_CAS_ATTRIBUTES": None,
+    "UNIAUTH_CAS_ATTRIBUTES_MAX_SIZE": None,
+    "UNIAUTH_CAS_ATTRIBUTES_STORE": "session",
+    "UNIAUTH_CAS_BREAKER_COOLDOWN": 30,
+    "UNIAUTH_CAS_BREAKER_FAILURE_RATE": 0.5,
+    "UNIAUTH_CAS_BREAKER_MIN_REQUESTS": 10,
+    "UNIAUTH_CAS_CONNECT_TIMEOUT": 5,
+    "UNIAUTH_CAS_MAX_RETRIES": 2,
+    "UNIAUTH_CAS_POOL_SIZE": 10,
+    "UNIAUTH_CAS_READ_TIMEOUT": 10,
+    "UNIAUTH_CAS_RETRY_BACKOFF": 0.5,
+    "UNIAUTH_CAS_TICKET_CACHE_TIMEOUT": 0,
+    "UNIAUTH_DEFER_MERGES": False,
     "UNIAUTH_FROM_EMAIL": "uniauth@example.com",
+    "UNIAUTH_INSTITUTION_CACHE_TIMEOUT": 300,
     "UNIAUTH_LOGIN_DISPLAY_STANDARD": True,
     "UNIAUTH_LOGIN_DISPLAY_CAS": True,
     "UNIAUTH_LOGIN_REDIRECT_URL": "/",
     "UNIAUTH_LOGOUT_CAS_COMPLETELY": False,
     "UNIAUTH_LOGOUT_REDIRECT_URL": None,
     "UNIAUTH_MAX_LINKED_EMAILS": 20,
+    "UNIAUTH_MAX_LOGIN_CANDIDATES": 10,
+    "UNIAUTH_MERGE_EXECUTOR": None,
+    "UNIAUTH_MERGE_MAX_WORKERS": 2,
+    "UNIAUTH_MERGE_SAVE_MODELS": [],
     "UNIAUTH_PERFORM_RECURSIVE_MERGING": True,
+    "UNIAUTH_PERSIST_CAS_ATTRIBUTES": False,
+    "UNIAUTH_TMP_USER_SWEEP_BATCH_SIZE": 1000,
+    "UNIAUTH_TMP_USER_SWEEP_INTERVAL": 300,
+    "UNIAUTH_TMP_USER_SWEEP_MODE": "always",
+    "UNIAUTH_USE_ASYNC_CAS_VIEWS": False,
     "UNIAUTH_USE_JWT_AUTH": False,
 }
 
 
+# Holds the value of every setting used by Uniauth as attributes
+Settings = namedtuple("Settings", sorted(DEFAULT_SETTING_VALUES))
+
+# The values the UNIAUTH_CAS_ATTRIBUTES_STORE setting may take
+CAS_ATTRIBUTE_STORES = ("session", "cache")
+
+# The values the UNIAUTH_TMP_USER_SWEEP_MODE setting may take
+TMP_USER_SWEEP_MODES = ("always", "throttled", "command")
+
+# Cache of the resolved Settings, cleared when a setting changes
+_settings = {"values": None}
+
+
 def choose_username(email):
     """
     Chooses a unique username for the provided user.
 
-    Sets the username to the email parameter umodified if
-    possible, otherwise adds a numerical suffix to the email.
+    Sets the username to the email parameter unmodified if
+    possible, otherwise adds a numerical suffix to the email,
+    one greater than the largest suffix already in use. Both
+    are determined with a single query, however many users
+    share the email address.
     """
+    from django.db.models import Case, IntegerField, Q, Value, When
+    from django.db.models.functions import Length
 
-    def get_suffix(number):
-        return "" if number == 1 else "_" + str(number).zfill(3)
+    prefix = email + "_"
+    manager = get_user_model()._default_manager
 
-    user_model = get_user_model()
+    # Load the email itself (if taken) first, followed by the
+    # largest numerical suffix: longer usernames have larger ones
+    usernames = list(
+        manager.filter(
+            Q(username=email)
+            | Q(username__regex=r"^%s[0-9]+$" % re.escape(prefix))
+        )
+        .order_by(
+            Case(
+                When(username=email, then=Value(0)),
+                default=Value(1),
+                output_field=IntegerField(),
+            ),
+            Length("username").desc(),
+            "-username",
+        )
+        .values_list("username", flat=True)[:2]
+    )
+    if not usernames or usernames[0] != email:
+        return email
     num = 1
-    while user_model.objects.filter(username=email + get_suffix(num)).exists():
-        num += 1
-    return email + get_suffix(num)
+    if len(usernames) > 1:
+        num = int(usernames[1][len(prefix) :])
+    return prefix + str(max(num + 1, 2)).zfill(3)
+
+
+def save_with_unique_username(user, email, max_attempts=5):
+    """
+    Saves the provided user with a unique username chosen for the
+    provided email address. If another user takes the username
+    before the save completes, a new one is chosen and the save
+    is retried, up to max_attempts times.
+    """
+    for attempt in range(max_attempts):
+        user.username = choose_username(email)
+        try:
+            with transaction.atomic():
+                user.save()
+            return user
+        except IntegrityError:
+            if attempt == max_attempts - 1:
+                raise
 
 
 def decode_pk(encoded_pk):
@@ -79,6 +179,30 @@ def encode_pk(pk):
     return encoded
 
 
+def delete_in_batches(queryset, batch_size, max_batches=None):
+    """
+    Deletes the objects in the provided queryset in chunks of at
+    most batch_size primary keys, so no single delete has to
+    collect and lock an unbounded number of rows.
+
+    If max_batches is provided, stops after that many chunks.
+    Returns the number of queryset objects deleted.
+    """
+    model = queryset.model
+    num_deleted = 0
+    num_batches = 0
+    while max_batches is None or num_batches < max_batches:
+        pks = list(
+            queryset.order_by("pk").values_list("pk", flat=True)[:batch_size]
+        )
+        if not pks:
+            break
+        model._default_manager.filter(pk__in=pks).delete()
+        num_deleted += len(pks)
+        num_batches += 1
+    return num_deleted
+
+
 def flush_old_tmp_users(days=1):
     """
     Delete temporary users more than the specified number of days old.
@@ -95,6 +219,670 @@ def flush_old_tmp_users(days=1):
     return num_deleted
 
 
+def _has_other_receivers(signal, model, own_receivers):
+    """
+    Returns whether the signal has receivers for the provided model
+    other than the functions in own_receivers. Receivers connected
+    with a dispatch_uid are always considered other receivers.
+    """
+    if not signal.has_listeners(model):
+        return False
+    own_ids = set(id(x) for x in own_receivers)
+    sender_ids = (id(model), id(None))
+    for receiver_entry in signal.receivers:
+        receiver_id, sender_id = receiver_entry[0]
+        if sender_id in sender_ids and receiver_id not in own_ids:
+            return True
+    return False
+
+
+def _can_raw_delete(model, cleared_fields, own_receivers=()):
+    """
+    Returns whether rows of the provided model can be deleted with
+    a raw DELETE query, without going through Django's collector:
+    there must be no delete signal receivers for the model other
+    than those in own_receivers (whose work the caller does itself),
+    and no relations pointing at it other than those in
+    cleared_fields, whose rows have already been deleted.
+    """
+    for signal in (pre_delete, post_delete, m2m_changed):
+        if _has_other_receivers(signal, model, own_receivers):
+            return False
+    for related_object in model._meta.related_objects:
+        if related_object.field not in cleared_fields:
+            return False
+    return True
+
+
+def _delete_tmp_users(user_pks):
+    """
+    Deletes the temporary users with the provided primary keys.
+
+    The users' LinkedEmails, MergeJobs, InstitutionAccounts (along
+    with their attributes) and UserProfiles are deleted with raw
+    queries first where it is safe to do so, so Django's collector
+    does not have to load them into memory. The cached users of the
+    accounts are invalidated in bulk, in place of their post_delete
+    receiver.
+    """
+    from uniauth.models import (
+        InstitutionAccount,
+        InstitutionAccountAttributes,
+        LinkedEmail,
+        MergeJob,
+        UserProfile,
+        _invalidate_account_users,
+        invalidate_account_user_cache,
+    )
+
+    user_model = get_user_model()
+    using = router.db_for_write(user_model)
+    with transaction.atomic(using=using):
+        collector = Collector(using=using)
+        cleared_fields = []
+        for model, field_name, lookup in (
+            (LinkedEmail, "profile", "profile__user__in"),
+            (MergeJob, "profile", "profile__user__in"),
+            (
+                InstitutionAccountAttributes,
+                "account",
+                "account__profile__user__in",
+            ),
+        ):
+            related = model._default_manager.using(using).filter(
+                **{lookup: user_pks}
+            )
+            if collector.can_fast_delete(related):
+                related._raw_delete(using)
+                cleared_fields.append(model._meta.get_field(field_name))
+        if _can_raw_delete(
+            InstitutionAccount,
+            cleared_fields,
+            own_receivers=[invalidate_account_user_cache],
+        ):
+            accounts = InstitutionAccount._default_manager.using(using).filter(
+                profile__user__in=user_pks
+            )
+            _invalidate_account_users(
+                accounts.values_list("institution_id", "cas_id")
+            )
+            accounts._raw_delete(using)
+            cleared_fields.append(
+                InstitutionAccount._meta.get_field("profile")
+            )
+        if _can_raw_delete(UserProfile, cleared_fields):
+            profiles = UserProfile._default_manager.using(using).filter(
+                user__in=user_pks
+            )
+            profiles._raw_delete(using)
+        user_model._default_manager.using(using).filter(
+            pk__in=user_pks
+        ).delete()
+
+
+def flush_old_tmp_users_in_batches(
+    days=1, batch_size=1000, start_pk=None, dry_run=False
+):
+    """
+    Deletes temporary users more than the specified number of days
+    old in chunks of at most batch_size users, in increasing primary
+    key order. Each chunk is deleted in its own transaction.
+
+    If start_pk is provided, only users with a greater primary key
+    are deleted, allowing an interrupted flush to be resumed. If
+    dry_run is True, the users are found but not deleted.
+
+    Yields a (last_pk, num_users) tuple after each chunk.
+    """
+    user_model = get_user_model()
+    old_tmp_users = user_model.objects.filter(
+        username__startswith="tmp-",
+        date_joined__lte=timezone.now() - timedelta(days=days),
+    ).order_by("pk")
+    last_pk = start_pk
+    while True:
+        batch = old_tmp_users
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        user_pks = list(batch.values_list("pk", flat=True)[:batch_size])
+        if not user_pks:
+            break
+        if not dry_run:
+            _delete_tmp_users(user_pks)
+        last_pk = user_pks[-1]
+        yield last_pk, len(user_pks)
+
+
+def migrate_cas_users_in_batches(institution, batch_size=1000):
+    """
+    Migrates users without a UserProfile, whose usernames are their
+    CAS IDs for the provided institution, in chunks of at most
+    batch_size users, in increasing primary key order. Each chunk
+    is migrated in its own transaction, using a fixed number of
+    queries regardless of its size.
+
+    Each user's username is prefixed with "cas-<slug>-", and a
+    UserProfile and InstitutionAccount are created for them. No
+    InstitutionAccount is created if the institution already has
+    one with the same CAS ID, or if the CAS ID is too long to store.
+    Users whose prefixed username would be too long to store are
+    skipped, and left unmigrated.
+
+    Yields a (last_pk, num_users, num_accounts, skipped) tuple after
+    each chunk, where skipped lists the usernames of the skipped users.
+    """
+    from django.db.models import F, Value
+    from django.db.models.functions import Concat
+
+    from uniauth.models import InstitutionAccount, UserProfile
+
+    user_model = get_user_model()
+    unmigrated_users = user_model._default_manager.filter(
+        uniauth_profile__isnull=True
+    ).order_by("pk")
+    prefix = "cas-%s-" % institution.slug
+    max_cas_id_length = InstitutionAccount._meta.get_field("cas_id").max_length
+    max_username_length = user_model._meta.get_field("username").max_length
+    last_pk = None
+    while True:
+        batch = unmigrated_users
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        users = list(batch.values_list("pk", "username")[:batch_size])
+        if not users:
+            break
+        last_pk = users[-1][0]
+
+        # Skip users whose username would not fit once prefixed, which
+        # would fail the whole update on most databases
+        skipped = []
+        if max_username_length is not None:
+            max_length = max_username_length - len(prefix)
+            skipped = [x[1] for x in users if len(x[1]) > max_length]
+            users = [x for x in users if len(x[1]) <= max_length]
+        user_pks = [x[0] for x in users]
+        with transaction.atomic():
+            user_model._default_manager.filter(pk__in=user_pks).update(
+                username=Concat(Value(prefix), F("username"))
+            )
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=x) for x in user_pks]
+            )
+            profile_pks = dict(
+                UserProfile.objects.filter(user__in=user_pks).values_list(
+                    "user", "pk"
+                )
+            )
+            linkable_users = [
+                x for x in users if len(x[1]) <= max_cas_id_length
+            ]
+            existing_cas_ids = set(
+                InstitutionAccount.objects.filter(
+                    institution=institution,
+                    cas_id__in=[x[1] for x in linkable_users],
+                ).values_list("cas_id", flat=True)
+            )
+            accounts = InstitutionAccount.objects.bulk_create(
+                [
+                    InstitutionAccount(
+                        profile_id=profile_pks[pk],
+                        institution=institution,
+                        cas_id=cas_id,
+                    )
+                    for pk, cas_id in linkable_users
+                    if cas_id not in existing_cas_ids
+                ]
+            )
+        yield last_pk, len(user_pks), len(accounts), skipped
+
+
+def migrate_custom_users_in_batches(batch_size=1000, min_pk=None, max_pk=None):
+    """
+    Migrates users without a UserProfile, who signed up with a
+    username / email address and password, in chunks of at most
+    batch_size users, in increasing primary key order. Each chunk
+    is migrated in its own transaction, using a fixed number of
+    queries regardless of its size.
+
+    A UserProfile is created for each user with a username or email
+    address and a non-blank password, as well as a verified
+    LinkedEmail if their email is non-blank. If min_pk or max_pk
+    are provided, only users with primary keys in that (inclusive)
+    range are considered, so that ranges may be migrated in parallel.
+
+    Yields a (last_pk, num_users, skipped) tuple after each chunk,
+    where skipped lists the username (or email address) of each
+    user in the chunk who could not be migrated.
+    """
+    from django.db.models import BooleanField, Case, Q, Value, When
+
+    from uniauth.models import LinkedEmail, UserProfile
+
+    user_model = get_user_model()
+    unmigrated_users = user_model._default_manager.filter(
+        uniauth_profile__isnull=True
+    ).order_by("pk")
+    if min_pk is not None:
+        unmigrated_users = unmigrated_users.filter(pk__gte=min_pk)
+    if max_pk is not None:
+        unmigrated_users = unmigrated_users.filter(pk__lte=max_pk)
+    is_eligible = (
+        (~Q(username="") | ~Q(email=""))
+        & Q(password__isnull=False)
+        & ~Q(password="")
+    )
+    unmigrated_users = unmigrated_users.annotate(
+        is_eligible=Case(
+            When(is_eligible, then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField(),
+        )
+    )
+    last_pk = None
+    while True:
+        batch = unmigrated_users
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        users = list(
+            batch.values_list("pk", "username", "email", "is_eligible")[
+                :batch_size
+            ]
+        )
+        if not users:
+            break
+        eligible_users = [x for x in users if x[3]]
+        skipped = [x[1] or x[2] or "(none)" for x in users if not x[3]]
+        with transaction.atomic():
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=x[0]) for x in eligible_users]
+            )
+            profile_pks = dict(
+                UserProfile.objects.filter(
+                    user__in=[x[0] for x in eligible_users if x[2]]
+                ).values_list("user", "pk")
+            )
+            # LinkedEmail.save() is bypassed, so set normalized_address here
+            LinkedEmail.objects.bulk_create(
+                [
+                    LinkedEmail(
+                        profile_id=profile_pks[x[0]],
+                        address=x[2],
+                        normalized_address=LinkedEmail.normalize_address(x[2]),
+                        is_verified=True,
+                    )
+                    for x in eligible_users
+                    if x[2]
+                ]
+            )
+        last_pk = users[-1][0]
+        yield last_pk, len(eligible_users), skipped
+
+
+def _clean_record_string(value, name):
+    """
+    Returns the stripped value of a field of a record passed to
+    provision_users_in_batches, or an empty string if it is None.
+
+    Raises ValueError if the value is not a string.
+    """
+    if value is None:
+        return ""
+    if not isinstance(value, _string_types):
+        raise ValueError("%s must be a string." % name)
+    return value.strip()
+
+
+def _clean_record_list(value, name):
+    """
+    Returns the value of a field of a record passed to
+    provision_users_in_batches, or an empty list if it is None.
+
+    Raises ValueError if the value is not a list.
+    """
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        raise ValueError("%s must be a list." % name)
+    return value
+
+
+def _clean_record_email(address):
+    """
+    Raises ValueError if the provided address is not a valid email.
+    """
+    try:
+        validate_email(address)
+    except ValidationError:
+        raise ValueError("'%s' is not a valid email address." % address)
+
+
+def _prepare_provisioned_user(record, institutions):
+    """
+    Normalizes a record passed to provision_users_in_batches into a
+    (user, linked_emails, accounts) tuple, where user is an unsaved
+    User and accounts is a list of (Institution, cas_id) tuples.
+
+    Raises ValueError if the record is invalid.
+    """
+    from uniauth.cache import get_institution
+    from uniauth.models import Institution, InstitutionAccount, LinkedEmail
+
+    if not isinstance(record, dict):
+        raise ValueError("The record must be an object.")
+    max_cas_id_length = InstitutionAccount._meta.get_field("cas_id").max_length
+    record = dict(record)
+    email = _clean_record_string(record.pop("email", None), "The email")
+    username = _clean_record_string(
+        record.pop("username", None), "The username"
+    )
+    username = username or email
+    if not username:
+        raise ValueError("A username or email address is required.")
+    if email:
+        _clean_record_email(email)
+
+    linked_emails = [email] if email else []
+    normalized_addresses = set(
+        LinkedEmail.normalize_address(x) for x in linked_emails
+    )
+    for address in _clean_record_list(
+        record.pop("linked_emails", None), "Linked emails"
+    ):
+        address = _clean_record_string(address, "Each linked email")
+        if not address:
+            continue
+        _clean_record_email(address)
+        normalized_address = LinkedEmail.normalize_address(address)
+        if normalized_address not in normalized_addresses:
+            linked_emails.append(address)
+            normalized_addresses.add(normalized_address)
+
+    accounts = []
+    for account in _clean_record_list(
+        record.pop("institution_accounts", None), "Institution accounts"
+    ):
+        if not isinstance(account, (list, tuple)) or len(account) != 2:
+            raise ValueError(
+                "Each institution account must be a (slug, CAS ID) pair."
+            )
+        slug = _clean_record_string(account[0], "Each institution slug")
+        cas_id = _clean_record_string(account[1], "Each CAS ID")
+        if not slug or not cas_id:
+            raise ValueError(
+                "Each institution account must be a (slug, CAS ID) pair."
+            )
+        if len(cas_id) > max_cas_id_length:
+            raise ValueError(
+                "CAS ID '%s' is longer than %d characters."
+                % (cas_id, max_cas_id_length)
+            )
+        if slug not in institutions:
+            try:
+                institutions[slug] = get_institution(slug)
+            except Institution.DoesNotExist:
+                raise ValueError(
+                    "No institution with slug '%s' exists." % slug
+                )
+        accounts.append((institutions[slug], cas_id))
+
+    password = record.pop("password", None)
+    if "password_hash" in record:
+        record["password"] = record.pop("password_hash")
+    else:
+        record["password"] = make_password(password or None)
+    try:
+        user = get_user_model()(username=username, email=email, **record)
+    except TypeError as e:
+        raise ValueError(str(e))
+    return user, linked_emails, accounts
+
+
+def provision_users_in_batches(records, batch_size=1000):
+    """
+    Creates users, along with their UserProfiles, verified
+    LinkedEmails and InstitutionAccounts, in chunks of at most
+    batch_size users. Each chunk is created in its own transaction
+    with bulk_create, using a fixed number of queries regardless
+    of its size, and without sending the User post_save signal.
+
+    Accepts an iterable of (key, record) tuples, where the key
+    identifies the record (such as its line number in an input
+    file), and the record is a dict which may contain:
+      - username: Defaults to the email address if not provided
+      - email: The primary email address, which is linked as well
+      - password: The raw password, or password_hash: the encoded
+        password. The password is unusable if neither is provided.
+      - linked_emails: Additional email addresses to link
+      - institution_accounts: (institution slug, CAS ID) pairs
+      - Any other fields of the User model
+    Records are provisioned entirely or not at all. Records whose
+    username, primary email, or institution accounts are already
+    taken (or are repeated in an earlier record) are skipped, as
+    are records with linked emails already verified for another
+    user if UNIAUTH_ALLOW_SHARED_EMAILS is False. Email addresses
+    are compared case-insensitively. Invalid records, such as those
+    with fields of the wrong type or malformed email addresses, are
+    skipped as well.
+
+    Yields a (last_key, num_users, skipped) tuple after each chunk,
+    where skipped is a list of (key, reason) tuples.
+    """
+    from django.db.models.functions import Lower
+
+    from uniauth.models import InstitutionAccount, LinkedEmail, UserProfile
+
+    manager = get_user_model()._default_manager
+    allow_shared_emails = get_setting("UNIAUTH_ALLOW_SHARED_EMAILS")
+    institutions = {}
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+
+        skipped = []
+        prepared = []
+        for key, record in batch:
+            try:
+                prepared.append(
+                    (key,) + _prepare_provisioned_user(record, institutions)
+                )
+            except ValueError as e:
+                skipped.append((key, str(e)))
+
+        # Find the rows conflicting with any record at once. Earlier
+        # chunks are committed, so only this chunk needs checking.
+        taken_usernames = set(
+            manager.filter(
+                username__in=[x[1].username for x in prepared]
+            ).values_list("username", flat=True)
+        )
+        # Emails and linked emails are compared case-insensitively
+        taken_emails = set(
+            LinkedEmail.normalize_address(x)
+            for x in manager.annotate(uniauth_normalized_email=Lower("email"))
+            .filter(
+                uniauth_normalized_email__in=[
+                    LinkedEmail.normalize_address(x[1].email)
+                    for x in prepared
+                    if x[1].email
+                ]
+            )
+            .values_list("email", flat=True)
+        )
+        taken_accounts = set(
+            InstitutionAccount.objects.filter(
+                cas_id__in=set(y[1] for x in prepared for y in x[3])
+            ).values_list("institution", "cas_id")
+        )
+        taken_addresses = set()
+        if not allow_shared_emails:
+            taken_addresses.update(
+                LinkedEmail.objects.filter(
+                    normalized_address__in=[
+                        LinkedEmail.normalize_address(y)
+                        for x in prepared
+                        for y in x[2]
+                    ],
+                    is_verified=True,
+                ).values_list("normalized_address", flat=True)
+            )
+
+        users = []
+        for key, user, linked_emails, accounts in prepared:
+            account_keys = set((x[0].pk, x[1]) for x in accounts)
+            normalized_email = LinkedEmail.normalize_address(user.email)
+            normalized_addresses = set(
+                LinkedEmail.normalize_address(x) for x in linked_emails
+            )
+            if user.username in taken_usernames:
+                skipped.append(
+                    (key, "Username '%s' is taken." % user.username)
+                )
+            elif user.email and normalized_email in taken_emails:
+                skipped.append((key, "Email '%s' is taken." % user.email))
+            elif account_keys & taken_accounts:
+                skipped.append((key, "An institution account is taken."))
+            elif taken_addresses & normalized_addresses:
+                skipped.append((key, "A linked email is taken."))
+            else:
+                taken_usernames.add(user.username)
+                if user.email:
+                    taken_emails.add(normalized_email)
+                taken_accounts.update(account_keys)
+                if not allow_shared_emails:
+                    taken_addresses.update(normalized_addresses)
+                users.append((user, linked_emails, accounts))
+
+        with transaction.atomic():
+            manager.bulk_create([x[0] for x in users])
+            user_pks = dict(
+                manager.filter(
+                    username__in=[x[0].username for x in users]
+                ).values_list("username", "pk")
+            )
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=user_pks[x[0].username]) for x in users]
+            )
+            profile_pks = dict(
+                UserProfile.objects.filter(
+                    user__in=user_pks.values()
+                ).values_list("user", "pk")
+            )
+            linked_email_objects = []
+            account_objects = []
+            for user, linked_emails, accounts in users:
+                profile_pk = profile_pks[user_pks[user.username]]
+                for address in linked_emails:
+                    linked_email_objects.append(
+                        LinkedEmail(
+                            profile_id=profile_pk,
+                            address=address,
+                            normalized_address=LinkedEmail.normalize_address(
+                                address
+                            ),
+                            is_verified=True,
+                        )
+                    )
+                for institution, cas_id in accounts:
+                    account_objects.append(
+                        InstitutionAccount(
+                            profile_id=profile_pk,
+                            institution=institution,
+                            cas_id=cas_id,
+                        )
+                    )
+            LinkedEmail.objects.bulk_create(linked_email_objects)
+            InstitutionAccount.objects.bulk_create(account_objects)
+        yield batch[-1][0], len(users), skipped
+
+
+def _merge_user_pair(primary_username, alias_username):
+    """
+    Merges the user with the alias username into the user with
+    the primary username, linking the alias' institution account
+    to the primary user's profile if it is an unlinked one.
+
+    Returns whether the users were merged: False is returned if
+    the alias user does not exist (e.g. it was already merged).
+    Raises ValueError if the users can not be merged. Must be
+    called in a transaction, which should be rolled back if an
+    exception is raised.
+    """
+    from uniauth.cache import get_institution
+    from uniauth.merge import merge_model_instances
+    from uniauth.models import InstitutionAccount
+
+    manager = get_user_model()._default_manager
+    try:
+        alias_user = manager.get_by_natural_key(alias_username)
+    except manager.model.DoesNotExist:
+        return False
+    try:
+        primary_user = manager.get_by_natural_key(primary_username)
+    except manager.model.DoesNotExist:
+        raise ValueError(
+            "No user with username '%s' exists." % primary_username
+        )
+    if primary_user.pk == alias_user.pk:
+        raise ValueError(
+            "Can not merge user '%s' into itself." % alias_username
+        )
+
+    merge_model_instances(primary_user, [alias_user])
+    if is_unlinked_account(alias_user):
+        username_split = get_account_username_split(alias_username)
+        InstitutionAccount.objects.get_or_create(
+            profile=primary_user.uniauth_profile,
+            institution=get_institution(username_split[1]),
+            cas_id=username_split[2],
+        )
+    return True
+
+
+def merge_users_in_batches(pairs, batch_size=100):
+    """
+    Merges users in chunks of at most batch_size pairs, each
+    chunk in its own transaction.
+
+    Accepts an iterable of (key, primary_username, alias_username)
+    tuples, where the key identifies the pair (such as its line
+    number in an input file). Each merge is made in its own
+    savepoint, so a failed merge does not prevent the rest of its
+    chunk from being committed. Pairs whose alias user no longer
+    exists are skipped, so repeating a merge has no effect.
+
+    Yields a (last_key, num_merged, num_skipped, failures) tuple
+    after each chunk, where failures is a list of (key, error)
+    tuples.
+    """
+    pairs = iter(pairs)
+    while True:
+        batch = list(islice(pairs, batch_size))
+        if not batch:
+            break
+        num_merged = 0
+        num_skipped = 0
+        failures = []
+        with transaction.atomic():
+            for key, primary_username, alias_username in batch:
+                # Look up and merge each pair in its own savepoint, so
+                # a database error does not abort the whole chunk
+                try:
+                    with transaction.atomic():
+                        merged = _merge_user_pair(
+                            primary_username, alias_username
+                        )
+                except (ValueError, ObjectDoesNotExist, DatabaseError) as e:
+                    failures.append((key, str(e)))
+                    continue
+                if merged:
+                    num_merged += 1
+                else:
+                    num_skipped += 1
+        yield batch[-1][0], num_merged, num_skipped, failures
+
+
 def get_account_username_split(username):
     """
     Accepts the username for an unlinked InstitutionAccount
@@ -189,16 +977,114 @@ def get_service_url(request, redirect_url=None):
     return service_url
 
 
+def _validate_settings(values):
+    """
+    Raises ImproperlyConfigured if the provided Settings
+    are not a valid configuration for Uniauth.
+    """
+    if not (
+        values.UNIAUTH_LOGIN_DISPLAY_STANDARD
+        or values.UNIAUTH_LOGIN_DISPLAY_CAS
+    ):
+        raise ImproperlyConfigured(
+            "At least one of '%s' and '%s' must be True."
+            % ("UNIAUTH_LOGIN_DISPLAY_STANDARD", "UNIAUTH_LOGIN_DISPLAY_CAS")
+        )
+    if values.UNIAUTH_TMP_USER_SWEEP_MODE not in TMP_USER_SWEEP_MODES:
+        raise ImproperlyConfigured(
+            "'UNIAUTH_TMP_USER_SWEEP_MODE' must be one of: %s."
+            % ", ".join(TMP_USER_SWEEP_MODES)
+        )
+    if values.UNIAUTH_CAS_ATTRIBUTES_STORE not in CAS_ATTRIBUTE_STORES:
+        raise ImproperlyConfigured(
+            "'UNIAUTH_CAS_ATTRIBUTES_STORE' must be one of: %s."
+            % ", ".join(CAS_ATTRIBUTE_STORES)
+        )
+    if (
+        values.UNIAUTH_CAS_ATTRIBUTES_STORE == "cache"
+        and not values.UNIAUTH_CACHE_ALIAS
+    ):
+        raise ImproperlyConfigured(
+            "'UNIAUTH_CACHE_ALIAS' must be set when "
+            "'UNIAUTH_CAS_ATTRIBUTES_STORE' is 'cache'."
+        )
+    failure_rate = values.UNIAUTH_CAS_BREAKER_FAILURE_RATE
+    if failure_rate is not None and not 0 < failure_rate <= 1:
+        raise ImproperlyConfigured(
+            "'UNIAUTH_CAS_BREAKER_FAILURE_RATE' must be None, or "
+            "between 0 (exclusive) and 1."
+        )
+    for setting_name in (
+        "UNIAUTH_CAS_BREAKER_MIN_REQUESTS",
+        "UNIAUTH_CAS_POOL_SIZE",
+        "UNIAUTH_MERGE_MAX_WORKERS",
+        "UNIAUTH_TMP_USER_SWEEP_BATCH_SIZE",
+    ):
+        if getattr(values, setting_name) < 1:
+            raise ImproperlyConfigured(
+                "'%s' must be a positive integer." % setting_name
+            )
+    for setting_name in (
+        "UNIAUTH_CAS_BREAKER_COOLDOWN",
+        "UNIAUTH_CAS_CONNECT_TIMEOUT",
+        "UNIAUTH_CAS_MAX_RETRIES",
+        "UNIAUTH_CAS_READ_TIMEOUT",
+        "UNIAUTH_CAS_RETRY_BACKOFF",
+        "UNIAUTH_CAS_TICKET_CACHE_TIMEOUT",
+    ):
+        if getattr(values, setting_name) < 0:
+            raise ImproperlyConfigured(
+                "'%s' must not be negative." % setting_name
+            )
+    account_cache_timeout = values.UNIAUTH_ACCOUNT_CACHE_TIMEOUT
+    if account_cache_timeout is not None and account_cache_timeout < 0:
+        raise ImproperlyConfigured(
+            "'UNIAUTH_ACCOUNT_CACHE_TIMEOUT' must be None or not negative."
+        )
+
+
+def get_settings():
+    """
+    Returns a Settings tuple with the value of every setting
+    used by Uniauth, as would be returned by get_setting.
+
+    The settings are resolved and validated once, then cached
+    until one of them changes (see reset_settings). Raises
+    ImproperlyConfigured if they are not valid.
+    """
+    values = _settings["values"]
+    if values is None:
+        values = Settings(
+            **dict(
+                (x, getattr(settings, x, DEFAULT_SETTING_VALUES[x]))
+                for x in Settings._fields
+            )
+        )
+        _validate_settings(values)
+        _settings["values"] = values
+    return values
+
+
+@receiver(setting_changed)
+def reset_settings(setting=None, **kwargs):
+    """
+    Clears the cached settings, so they are resolved again on the
+    next access. Called whenever one of them changes, such as
+    with override_settings in tests.
+    """
+    if setting is None or setting in DEFAULT_SETTING_VALUES:
+        _settings["values"] = None
+
+
 def get_setting(setting_name):
     """
     Returns the value of the setting with the provided name
     if set. Returns the value in DEFAULT_SETTING_VALUES
     otherwise.
     """
-    try:
-        return getattr(settings, setting_name)
-    except AttributeError:
-        return DEFAULT_SETTING_VALUES[setting_name]
+    if setting_name not in DEFAULT_SETTING_VALUES:
+        raise KeyError(setting_name)
+    return getattr(get_settings(), setting_name)
 
 
 def is_tmp_user(user):
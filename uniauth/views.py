@@ -16,6 +16,7 @@ from django.contrib.auth.views import (
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ImproperlyConfigured, PermissionDenied
 from django.core.mail import EmailMessage
+from django.db import transaction
 from django.http import (
     Http404,
     HttpResponseBadRequest,
@@ -25,12 +26,12 @@ from django.http import (
 from django.shortcuts import render
 from django.template.loader import render_to_string
 from django.urls import reverse, reverse_lazy
-from django.urls.exceptions import NoReverseMatch
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 from django.views.decorators.debug import sensitive_post_parameters
 from rest_framework import status
 
+from uniauth.cache import get_institution, get_institution_links
 from uniauth.decorators import login_required
 from uniauth.forms import (
     AddLinkedEmailForm,
@@ -42,11 +43,17 @@ from uniauth.forms import (
     SetPasswordForm,
     SignupForm,
 )
+from uniauth.health import CASServerUnavailable
+from uniauth.jobs import schedule_merge
 from uniauth.merge import merge_model_instances
-from uniauth.models import Institution, InstitutionAccount, LinkedEmail
+from uniauth.models import (
+    Institution,
+    InstitutionAccount,
+    LinkedEmail,
+    MergeJob,
+)
 from uniauth.tokens import get_jwt_tokens_for_user, token_generator
 from uniauth.utils import (
-    choose_username,
     decode_pk,
     encode_pk,
     get_account_username_split,
@@ -57,6 +64,7 @@ from uniauth.utils import (
     get_setting,
     is_tmp_user,
     is_unlinked_account,
+    save_with_unique_username,
 )
 
 try:
@@ -73,30 +81,9 @@ def _get_global_context(request):
     """
     context = {}
 
-    # Returns the reverse lookup URL of the provided view with
-    # the provided slug argument. Returns None if the view is
-    # not accessible under the current configuration
-    def get_reversed_url_or_none(view_name, slug):
-        try:
-            return reverse("uniauth:%s" % view_name, args=[slug])
-        except NoReverseMatch:
-            return None
-
     # Add a list of Institution tuples, with each containing:
     # (name, slug, CAS login url, Profile link URL)
-    institutions = Institution.objects.all()
-    institutions = list(
-        map(
-            lambda x: (
-                x.name,
-                x.slug,
-                get_reversed_url_or_none("cas-login", x.slug),
-                get_reversed_url_or_none("link-from-profile", x.slug),
-            ),
-            institutions,
-        )
-    )
-    context["institutions"] = institutions
+    context["institutions"] = get_institution_links()
 
     # Add the query parameters, as a string
     query_params = urlencode(request.GET)
@@ -168,13 +155,8 @@ def login(request):
     display_cas = get_setting("UNIAUTH_LOGIN_DISPLAY_CAS")
     num_institutions = len(context["institutions"])
 
-    # Ensure the login settings are configured correctly
-    if not display_standard and not display_cas:
-        err_msg = "At least one of '%s' and '%s' must be True." % (
-            "UNIAUTH_LOGIN_DISPLAY_STANDARD",
-            "UNIAUTH_LOGIN_DISPLAY_CAS",
-        )
-        raise ImproperlyConfigured(err_msg)
+    # Ensure there are institutions to log into. The settings
+    # themselves are validated when they are loaded.
     if display_cas and num_institutions == 0:
         err_msg = (
             "'%s' is True, but there are no Institutions in the "
@@ -225,19 +207,30 @@ def login(request):
         return render(request, "uniauth/login.html", context)
 
 
-def cas_login(request, institution):
+def _cas_unavailable(request, institution, next_url):
     """
-    Redirects to the CAS login URL, or verifies the
-    CAS ticket, if provided.
+    Renders the page explaining the institution's CAS server
+    is unavailable, shown while its circuit is open.
+    """
+    context = _get_global_context(request)
+    context["institution"] = institution
+    context["next_url"] = next_url
+    return render(request, "uniauth/cas-unavailable.html", context, status=503)
 
-    Accepts the slug of the institution to log in to.
+
+def _begin_cas_login(request, institution):
+    """
+    Performs the steps of the cas_login view that come before
+    verifying the ticket, which are shared with its async variant.
+
+    Returns an (institution, next_url, service_url, response) tuple.
+    If response is not None, it should be returned immediately.
     """
     next_url = request.GET.get("next")
-    ticket = request.GET.get("ticket")
 
     # Ensure there is an institution with the provided slug
     try:
-        institution = Institution.objects.get(slug=institution)
+        institution = get_institution(institution)
     except Institution.DoesNotExist:
         raise Http404
 
@@ -246,40 +239,67 @@ def cas_login(request, institution):
 
     # If the user is already authenticated, proceed to next page
     if request.user.is_authenticated:
-        return _login_success(request, request.user, next_url)
+        response = _login_success(request, request.user, next_url)
+        return institution, next_url, None, response
 
     service_url = get_service_url(request, next_url)
-    client = CASClient(
-        version=2,
-        service_url=service_url,
-        server_url=institution.cas_server_url,
+
+    # If no ticket was provided, redirect to the
+    # login URL for the institution's CAS server
+    if not request.GET.get("ticket"):
+        client = CASClient(
+            version=2,
+            service_url=service_url,
+            server_url=institution.cas_server_url,
+        )
+        response = HttpResponseRedirect(client.get_login_url())
+        return institution, next_url, service_url, response
+
+    return institution, next_url, service_url, None
+
+
+def _finish_cas_login(request, institution, next_url, user):
+    """
+    Logs in the user authenticated by the cas_login view (or its
+    async variant), or raises PermissionDenied if there is none.
+    """
+    # Authentication successful: setup session + proceed
+    if user:
+        if not request.session.exists(request.session.session_key):
+            request.session.create()
+        auth_login(request, user)
+        request.session["auth-method"] = "cas-" + institution.slug
+        return _login_success(request, user, next_url, ["ticket"])
+
+    # Authentication failed: raise permission denied
+    else:
+        raise PermissionDenied("Verification of CAS ticket failed.")
+
+
+def cas_login(request, institution):
+    """
+    Redirects to the CAS login URL, or verifies the
+    CAS ticket, if provided.
+
+    Accepts the slug of the institution to log in to.
+    """
+    institution, next_url, service_url, response = _begin_cas_login(
+        request, institution
     )
+    if response is not None:
+        return response
 
-    # If a ticket was provided, attempt to authenticate with it
-    if ticket:
+    # A ticket was provided, so attempt to authenticate with it
+    try:
         user = authenticate(
             request=request,
             institution=institution,
-            ticket=ticket,
+            ticket=request.GET["ticket"],
             service=service_url,
         )
-
-        # Authentication successful: setup session + proceed
-        if user:
-            if not request.session.exists(request.session.session_key):
-                request.session.create()
-            auth_login(request, user)
-            request.session["auth-method"] = "cas-" + institution.slug
-            return _login_success(request, user, next_url, ["ticket"])
-
-        # Authentication failed: raise permission denied
-        else:
-            raise PermissionDenied("Verification of CAS ticket failed.")
-
-    # If no ticket was provided, redirect to the
-    # login URL for the institution's CAS server
-    else:
-        return HttpResponseRedirect(client.get_login_url())
+    except CASServerUnavailable:
+        return _cas_unavailable(request, institution, next_url)
+    return _finish_cas_login(request, institution, next_url, user)
 
 
 def logout(request):
@@ -311,7 +331,7 @@ def logout(request):
     institution = None
     if auth_method and auth_method.startswith("cas-"):
         try:
-            institution = Institution.objects.get(slug=auth_method[4:])
+            institution = get_institution(auth_method[4:])
         except Institution.DoesNotExist:
             pass
 
@@ -566,13 +586,51 @@ def _add_institution_account(profile, slug, cas_id):
     """
     Accepts an institution slug and cas ID and links an
     InsitutionAccount to the provided Uniauth user.
+
+    Does nothing if the account is already linked to the user,
+    as when a request linking it is retried while its merge is
+    deferred (and the unlinked user still exists).
     """
-    institution = Institution.objects.get(slug=slug)
-    InstitutionAccount.objects.create(
+    institution = get_institution(slug)
+    InstitutionAccount.objects.get_or_create(
         profile=profile, institution=institution, cas_id=cas_id
     )
 
 
+def _link_unlinked_account(request, user, unlinked_user):
+    """
+    Merges the unlinked user into the provided Uniauth user, and
+    links the institution account described by the unlinked
+    user's username to the user's profile.
+
+    If UNIAUTH_DEFER_MERGES is True, the institution account is
+    linked immediately, and the merge is scheduled as a background
+    job, using the request's Idempotency-Key header (if provided)
+    to identify it. The MergeJob is returned in that case, and its
+    id is stored in the session, so the client can poll its status
+    from the merge_status view. None is returned otherwise.
+    """
+    username_split = get_account_username_split(unlinked_user.username)
+    if not get_setting("UNIAUTH_DEFER_MERGES"):
+        merge_model_instances(user, [unlinked_user])
+        _add_institution_account(
+            user.uniauth_profile, username_split[1], username_split[2]
+        )
+        return None
+
+    with transaction.atomic():
+        _add_institution_account(
+            user.uniauth_profile, username_split[1], username_split[2]
+        )
+        job = schedule_merge(
+            user,
+            unlinked_user,
+            request.META.get("HTTP_IDEMPOTENCY_KEY"),
+        )
+    request.session["merge-job-id"] = job.pk
+    return job
+
+
 def link_to_profile(request):
     """
     If the user is a temporary one who was logged in via
@@ -623,14 +681,13 @@ def link_to_profile(request):
             auth_login(request, user)
 
             # Merge the unlinked account into the logged in profile,
-            # then add the institution account described by the username
-            merge_model_instances(user, [unlinked_user])
-            _add_institution_account(
-                user.uniauth_profile, username_split[1], username_split[2]
+            # and add the institution account described by the username
+            context["merge_job"] = _link_unlinked_account(
+                request, user, unlinked_user
             )
 
             slug = username_split[1]
-            context["institution"] = Institution.objects.get(slug=slug)
+            context["institution"] = get_institution(slug)
             return render(request, "uniauth/link-success.html", context)
 
         # Authentication failed: render form errors
@@ -645,18 +702,19 @@ def link_to_profile(request):
         return render(request, "uniauth/link-to-profile.html", context)
 
 
-def link_from_profile(request, institution):
+def _begin_link_from_profile(request, institution):
     """
-    Attempts to authenticate a CAS account for the provided
-    institution, and links it to the current Uniauth profile
-    if successful.
+    Performs the steps of the link_from_profile view that come before
+    verifying the ticket, which are shared with its async variant.
+
+    Returns an (institution, next_url, service_url, response) tuple.
+    If response is not None, it should be returned immediately.
     """
     next_url = request.GET.get("next")
-    ticket = request.GET.get("ticket")
 
     # Ensure there is an institution with the provided slug
     try:
-        institution = Institution.objects.get(slug=institution)
+        institution = get_institution(institution)
     except Institution.DoesNotExist:
         raise Http404
 
@@ -673,43 +731,64 @@ def link_from_profile(request, institution):
         raise PermissionDenied("Must be logged in as verified Uniauth user.")
 
     service_url = get_service_url(request, next_url)
-    client = CASClient(
-        version=2,
-        service_url=service_url,
-        server_url=institution.cas_server_url,
-    )
 
-    # If a ticket was provided, attempt to authenticate with it
-    if ticket:
-        user = authenticate(
-            request=request,
-            institution=institution,
-            ticket=ticket,
-            service=service_url,
+    # If no ticket was provided, redirect to the
+    # login URL for the institution's CAS server
+    if not request.GET.get("ticket"):
+        client = CASClient(
+            version=2,
+            service_url=service_url,
+            server_url=institution.cas_server_url,
         )
+        response = HttpResponseRedirect(client.get_login_url())
+        return institution, next_url, service_url, response
 
-        # Authentication successful: link to Uniauth profile if
-        # the institution account has not been linked yet + proceed
-        if user:
-            if is_unlinked_account(user):
-                merge_model_instances(request.user, [user])
-                username_split = get_account_username_split(user.username)
-                _add_institution_account(
-                    request.user.uniauth_profile,
-                    username_split[1],
-                    username_split[2],
-                )
+    return institution, next_url, service_url, None
 
-            return HttpResponseRedirect(next_url)
 
-        # Authentication failed: raise permission denied
-        else:
-            raise PermissionDenied("Verification of CAS ticket failed")
+def _finish_link_from_profile(request, next_url, user):
+    """
+    Links the institution account authenticated by the
+    link_from_profile view (or its async variant) to the
+    current Uniauth profile, or raises PermissionDenied if
+    authentication failed.
+    """
+    # Authentication successful: link to Uniauth profile if
+    # the institution account has not been linked yet + proceed
+    if user:
+        if is_unlinked_account(user):
+            _link_unlinked_account(request, request.user, user)
 
-    # If no ticket was provided, redirect to the
-    # login URL for the institution's CAS server
+        return HttpResponseRedirect(next_url)
+
+    # Authentication failed: raise permission denied
     else:
-        return HttpResponseRedirect(client.get_login_url())
+        raise PermissionDenied("Verification of CAS ticket failed")
+
+
+def link_from_profile(request, institution):
+    """
+    Attempts to authenticate a CAS account for the provided
+    institution, and links it to the current Uniauth profile
+    if successful.
+    """
+    institution, next_url, service_url, response = _begin_link_from_profile(
+        request, institution
+    )
+    if response is not None:
+        return response
+
+    # A ticket was provided, so attempt to authenticate with it
+    try:
+        user = authenticate(
+            request=request,
+            institution=institution,
+            ticket=request.GET["ticket"],
+            service=service_url,
+        )
+    except CASServerUnavailable:
+        return _cas_unavailable(request, institution, next_url)
+    return _finish_link_from_profile(request, next_url, user)
 
 
 def verify_token(request, pk_base64, token):
@@ -759,8 +838,7 @@ def verify_token(request, pk_base64, token):
 
             # Change the email + username to the verified email
             user.email = email.address
-            user.username = choose_username(user.email)
-            user.save()
+            save_with_unique_username(user, user.email)
 
             # If the user was created via CAS, add the institution
             # account described by the temporary username
@@ -872,6 +950,24 @@ class PasswordResetVerifyDone(PasswordResetCompleteView):
         return context
 
 
+@login_required
+def merge_status(request, job_id=None):
+    """
+    Returns the status of the merge job with the provided id
+    as JSON, if it belongs to the current user. If no id is
+    provided, the job last scheduled in this session is used.
+    """
+    if job_id is None:
+        job_id = request.session.get("merge-job-id")
+    try:
+        job = MergeJob.objects.get(pk=job_id, profile__user=request.user.pk)
+    except MergeJob.DoesNotExist:
+        return JsonResponse({}, status=status.HTTP_404_NOT_FOUND)
+    return JsonResponse(
+        {"id": job.pk, "status": job.status}, status=status.HTTP_200_OK
+    )
+
+
 def get_jwt_tokens_from_session(request):
     if request.method == "GET":
         refresh = request.session.pop("jwt-refresh", None)